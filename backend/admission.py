@@ -0,0 +1,170 @@
+import os
+import math
+import time
+import heapq
+import asyncio
+import itertools
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List
+
+import metrics
+from providers import DeadlineExceeded, remaining_time
+
+# Lower number = served first. Cheap single-protocol queries go ahead of
+# comparisons (one large multi-protocol prompt), batch items go last.
+PRIORITIES = {"query": 0, "compare": 1, "batch": 2}
+
+
+class Overloaded(Exception):
+    """The LLM scheduler turned a request away. Mapped to HTTP 429 (rejected on arrival
+    or displaced from the queue) or 503 (waited past LLM_QUEUE_TIMEOUT), with Retry-After."""
+
+    def __init__(self, reason: str, status_code: int, retry_after: int):
+        self.status_code = status_code
+        self.retry_after = retry_after
+        super().__init__(reason)
+
+
+class _Waiter:
+    def __init__(self, priority_class: str, seq: int):
+        self.priority_class = priority_class
+        self.seq = seq
+        self.enqueued = time.perf_counter()
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    def __lt__(self, other: "_Waiter") -> bool:
+        return (PRIORITIES[self.priority_class], self.seq) < (PRIORITIES[other.priority_class], other.seq)
+
+
+class LLMScheduler:
+    """Admission control in front of LLM generations.
+
+    At most `slots` generations run at once. Further requests wait in a
+    priority queue of at most `max_queue` entries (queries before
+    comparisons before batch items, FIFO within a class). A full queue
+    rejects the newcomer, unless a lower-priority request is waiting, which is
+    then displaced instead. A request that waits longer than `queue_timeout`,
+    or than its request deadline allows, gives up. Rejections are fast and
+    carry a Retry-After estimate, so overload doesn't turn into unbounded
+    latency for everyone.
+    """
+
+    def __init__(self, slots: int = 8, max_queue: int = 32, queue_timeout: float = 10.0):
+        self.slots = max(1, slots)
+        self.max_queue = max(0, max_queue)
+        self.queue_timeout = queue_timeout
+        self.in_use = 0
+        self._queue: List[_Waiter] = []
+        self._seq = itertools.count()
+        # Moving average of how long a generation holds its slot, for Retry-After
+        self._hold_s = 2.0
+        self.counters: Dict[str, Dict[str, int]] = {
+            name: {"admitted": 0, "queued": 0, "rejected": 0, "displaced": 0, "timed_out": 0}
+            for name in PRIORITIES
+        }
+
+    def _count(self, priority_class: str, outcome: str):
+        self.counters[priority_class][outcome] += 1
+        metrics.ADMISSIONS.inc(priority=priority_class, outcome=outcome)
+
+    def retry_after(self) -> int:
+        """Seconds until a slot is likely free for a new request, at least 1."""
+        return max(1, math.ceil(self._hold_s * (len(self._waiting()) + 1) / self.slots))
+
+    def _waiting(self) -> List[_Waiter]:
+        return [w for w in self._queue if not w.future.done()]
+
+    def _enqueue(self, priority_class: str) -> _Waiter:
+        # Drop entries that gave up, were displaced or were cancelled
+        waiting = self._waiting()
+        if len(waiting) < len(self._queue):
+            self._queue = waiting
+            heapq.heapify(self._queue)
+        if len(waiting) >= self.max_queue:
+            worst = max(waiting, default=None)
+            if worst is None or PRIORITIES[worst.priority_class] <= PRIORITIES[priority_class]:
+                self._count(priority_class, "rejected")
+                raise Overloaded("LLM queue is full", 429, self.retry_after())
+            self._count(worst.priority_class, "displaced")
+            worst.future.set_exception(
+                Overloaded("Displaced from the LLM queue by higher-priority requests", 429, self.retry_after())
+            )
+        waiter = _Waiter(priority_class, next(self._seq))
+        heapq.heappush(self._queue, waiter)
+        self._count(priority_class, "queued")
+        return waiter
+
+    def _release(self):
+        self.in_use -= 1
+        # Hand the slot to the best waiter still waiting
+        while self._queue:
+            waiter = heapq.heappop(self._queue)
+            if not waiter.future.done():
+                self.in_use += 1
+                waiter.future.set_result(None)
+                return
+
+    async def _wait(self, waiter: _Waiter):
+        timeout, deadline_bound = self.queue_timeout, False
+        left = remaining_time()
+        if left is not None and left < timeout:
+            timeout, deadline_bound = left, True
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(timeout, 0))
+        except asyncio.TimeoutError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                return  # the slot arrived as the wait ran out
+            waiter.future.cancel()
+            if deadline_bound:
+                raise DeadlineExceeded("queue", "Request deadline exceeded")
+            self._count(waiter.priority_class, "timed_out")
+            raise Overloaded(f"Waited {self.queue_timeout:.1f}s for an LLM slot", 503, self.retry_after())
+        except asyncio.CancelledError:
+            # The caller went away; give back a slot it may just have been handed
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self._release()
+            else:
+                waiter.future.cancel()
+            raise
+
+    @asynccontextmanager
+    async def slot(self, priority_class: str = "query") -> AsyncIterator[None]:
+        """Holds one LLM slot for the block, waiting in the queue if none is free."""
+        with metrics.stage("queue"):
+            if self.in_use < self.slots and not self._waiting():
+                self.in_use += 1
+            else:
+                await self._wait(self._enqueue(priority_class))
+        self._count(priority_class, "admitted")
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._hold_s = 0.8 * self._hold_s + 0.2 * (time.perf_counter() - start)
+            self._release()
+
+    def depth(self) -> Dict[str, int]:
+        depth = {name: 0 for name in PRIORITIES}
+        for waiter in self._waiting():
+            depth[waiter.priority_class] += 1
+        return depth
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "slots": self.slots,
+            "in_use": self.in_use,
+            "max_queue": self.max_queue,
+            "queue_timeout_s": self.queue_timeout,
+            "queue_depth": self.depth(),
+            "avg_hold_s": round(self._hold_s, 3),
+            "classes": {name: dict(counts) for name, counts in self.counters.items()},
+        }
+
+
+def llm_scheduler_from_env() -> LLMScheduler:
+    """LLM_CONCURRENCY, LLM_QUEUE_SIZE and LLM_QUEUE_TIMEOUT configure admission control."""
+    return LLMScheduler(
+        slots=int(os.environ.get("LLM_CONCURRENCY", "8")),
+        max_queue=int(os.environ.get("LLM_QUEUE_SIZE", "32")),
+        queue_timeout=float(os.environ.get("LLM_QUEUE_TIMEOUT", "10")),
+    )
@@ -0,0 +1,511 @@
+import os
+import re
+import asyncio
+import json
+import time
+import sqlite3
+import threading
+from array import array
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes a query for cache keys: trims, collapses whitespace, case-folds."""
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+def open_cache_db(path: str) -> sqlite3.Connection:
+    """Opens a cache's SQLite file for use by several worker processes at once.
+    WAL lets readers proceed during a write; busy_timeout waits out another writer."""
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False, timeout=5.0)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU cache with optional TTL (seconds) and hit/miss counters."""
+
+    def __init__(self, max_size: int = 1024, ttl: Optional[float] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Any, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _expired(self, stored_at: float) -> bool:
+        return self.ttl is not None and time.time() - stored_at > self.ttl
+
+    def get(self, key) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._expired(entry[1]):
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, stored_at: Optional[float] = None):
+        with self._lock:
+            self._data[key] = (value, stored_at or time.time())
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def pop(self, key) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+            return None if entry is None else entry[0]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+
+class EmbeddingCache(LRUCache):
+    """LRU cache of query embeddings keyed on (model, normalized text).
+
+    If `path` is given, entries are also written to a SQLite file so the cache
+    survives restarts and is shared by worker processes using the same file;
+    the in-memory LRU stays the first lookup tier. The file is bounded too:
+    expired rows are deleted when it is opened, and every `prune_interval`
+    writes it is cut back to the newest `max_size` rows. The async methods
+    read and write the file in a worker thread, off the event loop.
+    """
+
+    def __init__(self, max_size: int = 10000, ttl: Optional[float] = None, path: Optional[str] = None,
+                 prune_interval: int = 100):
+        super().__init__(max_size=max_size, ttl=ttl)
+        self.path = path
+        self.prune_interval = max(1, prune_interval)
+        self.disk_hits = 0
+        self.disk_pruned = 0
+        self._writes = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()  # the in-memory tier keeps its own lock, so it never waits on disk
+        if path:
+            self._db = open_cache_db(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings ("
+                "key TEXT PRIMARY KEY, vector BLOB NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_stored_at ON embeddings (stored_at)")
+            with self._db_lock:
+                self._prune()
+
+    def _prune(self):
+        """Deletes expired rows and all but the newest max_size. Called with the db lock held."""
+        removed = 0
+        if self.ttl is not None:
+            removed += self._db.execute("DELETE FROM embeddings WHERE stored_at < ?",
+                                        (time.time() - self.ttl,)).rowcount
+        removed += self._db.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY stored_at DESC LIMIT -1 OFFSET ?)", (self.max_size,)
+        ).rowcount
+        self._db.commit()
+        self.disk_pruned += removed
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        return f"{model}\x1f{normalize_text(text)}"
+
+    def _read_rows(self, keys: List[str]) -> List[Optional[tuple]]:
+        with self._db_lock:
+            return [self._db.execute("SELECT vector, stored_at FROM embeddings WHERE key = ?", (key,)).fetchone()
+                    for key in keys]
+
+    def _promote(self, key: str, row: Optional[tuple]) -> Optional[List[float]]:
+        if row is None or self._expired(row[1]):
+            return None
+        vector = array("d", row[0]).tolist()
+        # Promote to the in-memory tier; the earlier miss is reclassified as a hit.
+        self.put(key, vector, stored_at=row[1])
+        with self._lock:
+            self.misses -= 1
+            self.hits += 1
+            self.disk_hits += 1
+        return vector
+
+    def _write_rows(self, rows: List[tuple]):
+        """Writes (key, vector, stored_at) rows in one transaction, pruning every prune_interval writes."""
+        with self._db_lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, vector, stored_at) VALUES (?, ?, ?)",
+                [(key, array("d", vector).tobytes(), stored_at) for key, vector, stored_at in rows],
+            )
+            self._db.commit()
+            before = self._writes
+            self._writes += len(rows)
+            if self._writes // self.prune_interval > before // self.prune_interval:
+                self._prune()
+
+    def _put_memory(self, text: str, model: str, vector: List[float]) -> tuple:
+        key, stored_at = self.make_key(text, model), time.time()
+        self.put(key, vector, stored_at=stored_at)
+        return key, vector, stored_at
+
+    def get_vector(self, text: str, model: str) -> Optional[List[float]]:
+        key = self.make_key(text, model)
+        vector = self.get(key)
+        if vector is not None or self._db is None:
+            return vector
+        return self._promote(key, self._read_rows([key])[0])
+
+    async def aget_vectors(self, texts: List[str], model: str) -> List[Optional[List[float]]]:
+        """Looks up many texts; in-memory misses are read from the file in one worker-thread call."""
+        keys = [self.make_key(text, model) for text in texts]
+        vectors = [self.get(key) for key in keys]
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        if self._db is not None and misses:
+            rows = await asyncio.to_thread(self._read_rows, [keys[i] for i in misses])
+            for i, row in zip(misses, rows):
+                vectors[i] = self._promote(keys[i], row)
+        return vectors
+
+    def put_vector(self, text: str, model: str, vector: List[float]):
+        row = self._put_memory(text, model, vector)
+        if self._db is not None:
+            self._write_rows([row])
+
+    async def aput_vectors(self, items: List[tuple]):
+        """Stores (text, model, vector) items; the file gets them in one write, in a worker thread."""
+        rows = [self._put_memory(text, model, vector) for text, model, vector in items]
+        if self._db is not None and rows:
+            await asyncio.to_thread(self._write_rows, rows)
+
+    def clear(self):
+        super().clear()
+        if self._db is not None:
+            with self._db_lock:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        stats = super().stats()
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_pruned"] = self.disk_pruned
+        stats["persistent"] = self._db is not None
+        return stats
+
+
+class CachedEmbeddings:
+    """Wraps an embeddings client (e.g. OpenAIEmbeddings) with an EmbeddingCache.
+
+    Query embeddings go through the cache; document embeddings are passed through
+    since ingestion text is rarely repeated.
+    """
+
+    def __init__(self, embeddings, cache: EmbeddingCache, model: Optional[str] = None):
+        self.embeddings = embeddings
+        self.cache = cache
+        self.model = model or getattr(embeddings, "model", type(embeddings).__name__)
+
+    def embed_query(self, text: str) -> List[float]:
+        vector = self.cache.get_vector(text, self.model)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self.cache.put_vector(text, self.model, vector)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        vector, = await self.cache.aget_vectors([text], self.model)
+        if vector is None:
+            vector = await self.embeddings.aembed_query(text)
+            await self.cache.aput_vectors([(text, self.model, vector)])
+        return vector
+
+    async def aembed_queries(self, texts: List[str]) -> List[List[float]]:
+        """Embeds many queries, sending every cache miss in a single embed_documents call."""
+        vectors = await self.cache.aget_vectors(texts, self.model)
+        misses = [i for i, vector in enumerate(vectors) if vector is None]
+        if misses:
+            fresh = await self.embeddings.aembed_documents([texts[i] for i in misses])
+            for i, vector in zip(misses, fresh):
+                vectors[i] = vector
+            await self.cache.aput_vectors([(texts[i], self.model, vectors[i]) for i in misses])
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return await self.embeddings.aembed_documents(texts)
+
+
+class SemanticAnswerCache:
+    """Caches generated answers per protocol, matched by question-embedding similarity.
+
+    A lookup hits when a stored question for the same protocol has cosine
+    similarity >= `threshold` with the new question, so paraphrases share one
+    generation. Entries are evicted LRU (`max_size`) and by age (`ttl`), and
+    `invalidate()` drops them when the corpus is re-ingested.
+
+    If `path` is given, answers and invalidations are also written to a SQLite
+    file. Every lookup first pulls rows other processes added since the last
+    one (two indexed reads), so worker processes sharing the file share the
+    cache; matching stays in memory. The async methods do the file reads and
+    writes in a worker thread and only the in-memory matching on the event loop.
+    """
+
+    def __init__(self, threshold: float = 0.98, max_size: int = 1000, ttl: Optional[float] = None,
+                 path: Optional[str] = None):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+        self.shared_loaded = 0
+        self._entries: "OrderedDict[int, Dict[str, Any]]" = OrderedDict()
+        self._matrices: Dict[str, tuple] = {}  # protocol -> (entry ids, unit-vector matrix, stored_at)
+        self._next_id = 0
+        self._invalidations = 0  # local drops; a store that raced one is not added
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()  # held for file I/O only, never together with _lock
+        self._last_answer = 0
+        self._last_invalidation = 0
+        if path:
+            self._db = open_cache_db(path)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS answers (id INTEGER PRIMARY KEY AUTOINCREMENT, protocol TEXT NOT NULL, "
+                "vector BLOB NOT NULL, answer TEXT NOT NULL, sources TEXT NOT NULL, "
+                "generation_time_s REAL NOT NULL, stored_at REAL NOT NULL)"
+            )
+            # protocol NULL = every protocol
+            self._db.execute("CREATE TABLE IF NOT EXISTS invalidations (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                             "protocol TEXT)")
+            self._db.commit()
+            row = self._db.execute("SELECT MAX(id) FROM invalidations").fetchone()
+            self._last_invalidation = row[0] or 0
+            self._sync()
+
+    def _matrix(self, protocol: str):
+        if protocol not in self._matrices:
+            ids = [i for i, e in self._entries.items() if e["protocol"] == protocol]
+            vectors = np.stack([self._entries[i]["vector"] for i in ids]) if ids else None
+            stored_at = np.array([self._entries[i]["stored_at"] for i in ids])
+            self._matrices[protocol] = (ids, vectors, stored_at)
+        return self._matrices[protocol]
+
+    def _remove(self, entry_id: int):
+        entry = self._entries.pop(entry_id)
+        self._matrices.pop(entry["protocol"], None)
+
+    def _drop_local(self, protocol: Optional[str]) -> int:
+        ids = [i for i, e in self._entries.items() if protocol is None or e["protocol"] == protocol]
+        for i in ids:
+            self._remove(i)
+        self._invalidations += 1
+        return len(ids)
+
+    def _sync(self):
+        """Applies invalidations, then loads answers, that other processes wrote since the last sync.
+        Reads the file under the db lock, then applies the rows under the cache lock."""
+        if self._db is None:
+            return
+        with self._db_lock:
+            invalidations = self._db.execute(
+                "SELECT id, protocol FROM invalidations WHERE id > ? ORDER BY id", (self._last_invalidation,)
+            ).fetchall()
+            rows = self._db.execute(
+                "SELECT id, protocol, vector, answer, sources, generation_time_s, stored_at FROM answers "
+                "WHERE id > ? ORDER BY id DESC LIMIT ?", (self._last_answer, self.max_size)
+            ).fetchall()
+        with self._lock:
+            for row_id, protocol in invalidations:
+                if row_id > self._last_invalidation:
+                    self._drop_local(protocol)
+                    self._last_invalidation = row_id
+            for row_id, protocol, vector, answer, sources, generation_time_s, stored_at in reversed(rows):
+                # A concurrent sync may have applied these rows already
+                if row_id <= self._last_answer:
+                    continue
+                self._last_answer = row_id
+                if row_id in self._entries or (self.ttl is not None and time.time() - stored_at > self.ttl):
+                    continue
+                self._add(row_id, protocol, np.frombuffer(vector, dtype=np.float32), answer, json.loads(sources),
+                          generation_time_s, stored_at)
+                self.shared_loaded += 1
+
+    def _add(self, entry_id: int, protocol: str, unit: np.ndarray, answer: str, sources: List[Dict],
+             generation_time_s: float, stored_at: float):
+        self._entries[entry_id] = {
+            "protocol": protocol,
+            "vector": unit,
+            "answer": answer,
+            "sources": sources,
+            "generation_time_s": generation_time_s,
+            "stored_at": stored_at,
+        }
+        self._matrices.pop(protocol, None)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+
+    def _match(self, protocol: str, vector: List[float]) -> Optional[Dict[str, Any]]:
+        """Closest unexpired in-memory entry above the threshold, or None."""
+        query = np.asarray(vector, dtype=np.float32)
+        query /= np.linalg.norm(query) or 1.0
+        with self._lock:
+            ids, matrix, stored_at = self._matrix(protocol)
+            if matrix is not None:
+                scores = matrix @ query
+                if self.ttl is not None:
+                    # Expired rows are dropped before ranking so a valid runner-up can still hit
+                    expired = time.time() - stored_at > self.ttl
+                    for i in np.flatnonzero(expired):
+                        self._remove(ids[i])
+                    scores[expired] = -np.inf
+                best = int(np.argmax(scores))
+                entry = self._entries.get(ids[best])
+                if entry is not None and scores[best] >= self.threshold:
+                    self._entries.move_to_end(ids[best])
+                    self.hits += 1
+                    self.saved_seconds += entry["generation_time_s"]
+                    return {**entry, "similarity": float(scores[best])}
+            self.misses += 1
+            return None
+
+    def lookup(self, protocol: str, vector: List[float]) -> Optional[Dict[str, Any]]:
+        """Returns the closest unexpired cached entry above the threshold, or None."""
+        self._sync()
+        return self._match(protocol, vector)
+
+    async def alookup(self, protocol: str, vector: List[float]) -> Optional[Dict[str, Any]]:
+        """lookup() for the event loop: the shared file is read in a worker thread."""
+        if self._db is not None:
+            await asyncio.to_thread(self._sync)
+        return self._match(protocol, vector)
+
+    def _persist(self, protocol: str, unit: np.ndarray, answer: str, sources: List[Dict],
+                 generation_time_s: float, stored_at: float) -> int:
+        """Writes one answer to the shared file and returns its row id."""
+        with self._db_lock:
+            entry_id = self._db.execute(
+                "INSERT INTO answers (protocol, vector, answer, sources, generation_time_s, stored_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (protocol, unit.tobytes(), answer, json.dumps(sources), generation_time_s, stored_at)
+            ).lastrowid
+            # Keep the file to the newest max_size answers
+            self._db.execute("DELETE FROM answers WHERE id <= ?", (entry_id - self.max_size,))
+            self._db.commit()
+        return entry_id
+
+    def _new_id(self) -> int:
+        with self._lock:
+            self._next_id += 1
+            return self._next_id - 1
+
+    def _add_stored(self, invalidations: int, entry_id: int, protocol: str, unit: np.ndarray, answer: str,
+                    sources: List[Dict], generation_time_s: float, stored_at: float):
+        with self._lock:
+            # An invalidation while the row was being written has already deleted it from the file
+            if self._invalidations == invalidations:
+                self._add(entry_id, protocol, unit, answer, sources, generation_time_s, stored_at)
+
+    def store(self, protocol: str, vector: List[float], answer: str, sources: List[Dict],
+              generation_time_s: float = 0.0):
+        unit = np.asarray(vector, dtype=np.float32)
+        unit /= np.linalg.norm(unit) or 1.0
+        row = (protocol, unit, answer, sources, generation_time_s, time.time())
+        invalidations = self._invalidations
+        entry_id = self._persist(*row) if self._db is not None else self._new_id()
+        self._add_stored(invalidations, entry_id, *row)
+
+    async def astore(self, protocol: str, vector: List[float], answer: str, sources: List[Dict],
+                     generation_time_s: float = 0.0):
+        """store() for the event loop: the shared file is written in a worker thread."""
+        unit = np.asarray(vector, dtype=np.float32)
+        unit /= np.linalg.norm(unit) or 1.0
+        row = (protocol, unit, answer, sources, generation_time_s, time.time())
+        invalidations = self._invalidations
+        entry_id = await asyncio.to_thread(self._persist, *row) if self._db is not None else self._new_id()
+        self._add_stored(invalidations, entry_id, *row)
+
+    def _invalidate_shared(self, protocol: Optional[str]) -> int:
+        """Syncs, then deletes the protocol's answers from the file and records the invalidation.
+        Returns the invalidation's row id."""
+        self._sync()
+        with self._db_lock:
+            if protocol is None:
+                self._db.execute("DELETE FROM answers")
+            else:
+                self._db.execute("DELETE FROM answers WHERE protocol = ?", (protocol,))
+            row_id = self._db.execute("INSERT INTO invalidations (protocol) VALUES (?)", (protocol,)).lastrowid
+            self._db.commit()
+        return row_id
+
+    def _drop_invalidated(self, protocol: Optional[str], row_id: Optional[int]) -> int:
+        with self._lock:
+            # Skip our own row unless another process's invalidation came in between
+            if row_id is not None and row_id == self._last_invalidation + 1:
+                self._last_invalidation = row_id
+            return self._drop_local(protocol)
+
+    def invalidate(self, protocol: Optional[str] = None) -> int:
+        """Drops cached answers for `protocol` (or all protocols). Returns the number removed."""
+        row_id = self._invalidate_shared(protocol) if self._db is not None else None
+        return self._drop_invalidated(protocol, row_id)
+
+    async def ainvalidate(self, protocol: Optional[str] = None) -> int:
+        """invalidate() for the event loop: the shared file is updated in a worker thread."""
+        row_id = await asyncio.to_thread(self._invalidate_shared, protocol) if self._db is not None else None
+        return self._drop_invalidated(protocol, row_id)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "threshold": self.threshold,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "saved_seconds": round(self.saved_seconds, 3),
+            "shared": self._db is not None,
+            "loaded_from_shared": self.shared_loaded,
+        }
+
+
+def answer_cache_from_env() -> SemanticAnswerCache:
+    """Builds the semantic answer cache from ANSWER_CACHE_* environment variables."""
+    ttl = os.environ.get("ANSWER_CACHE_TTL")
+    return SemanticAnswerCache(
+        threshold=float(os.environ.get("ANSWER_CACHE_THRESHOLD", "0.98")),
+        max_size=int(os.environ.get("ANSWER_CACHE_SIZE", "1000")),
+        ttl=float(ttl) if ttl else None,
+        path=os.environ.get("ANSWER_CACHE_PATH") or None,
+    )
+
+
+def embedding_cache_from_env() -> EmbeddingCache:
+    """Builds the query-embedding cache from EMBEDDING_CACHE_* environment variables."""
+    ttl = os.environ.get("EMBEDDING_CACHE_TTL")
+    return EmbeddingCache(
+        max_size=int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000")),
+        ttl=float(ttl) if ttl else None,
+        path=os.environ.get("EMBEDDING_CACHE_PATH") or None,
+    )
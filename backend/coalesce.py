@@ -0,0 +1,104 @@
+import asyncio
+import threading
+from typing import Any, Awaitable, Callable, Dict, Hashable, Optional, Tuple
+
+import metrics
+
+
+class _Call:
+    """One in-flight synchronous computation and its outcome."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """Coalesces concurrent identical calls.
+
+    The first caller for a key (the leader) runs the computation; callers that
+    arrive with the same key while it is in flight wait for it and receive the
+    same result, or the same exception. Nothing is kept once it finishes: this
+    is not a cache, the answer cache handles repeats over time.
+
+    Async calls run as a task of their own, so a leader that gives up
+    (e.g. the client disconnects) does not cancel the callers sharing its
+    result. The shared call runs with the leader's request deadline.
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.leaders = 0
+        self.coalesced = 0
+        self._tasks: Dict[Hashable, asyncio.Future] = {}
+        self._calls: Dict[Hashable, _Call] = {}
+        self._lock = threading.Lock()
+
+    def _count(self, coalesced: bool):
+        with self._lock:
+            if coalesced:
+                self.coalesced += 1
+            else:
+                self.leaders += 1
+        if coalesced:
+            metrics.COALESCED.inc(operation=self.operation)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Returns (result of fn(), whether it was shared with an identical call in flight)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        self._count(not leader)
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def ado(self, key: Hashable, make_call: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """Async version of do; `make_call()` is awaited once per key while in flight."""
+        task = self._tasks.get(key)
+        coalesced = task is not None
+        if task is None:
+            task = asyncio.ensure_future(make_call())
+            self._tasks[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        self._count(coalesced)
+        return await asyncio.shield(task), coalesced
+
+    def _finish(self, key: Hashable, task: asyncio.Future):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled():
+            # Marks the error as retrieved when every caller has already gone
+            task.exception()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._tasks) + len(self._calls),
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "coalesced_rate": round(self.coalesced / total, 4) if total else 0.0,
+        }
+
+
+def caller_result(result: Dict[str, Any], tracker: metrics.RequestTracker, coalesced: bool) -> Dict[str, Any]:
+    """One caller's copy of a possibly shared result, with that caller's own request metadata.
+    A coalesced caller reports the time it waited and no tokens of its own."""
+    return {**result, "metadata": {**result.get("metadata", {}), **tracker.summary(), "coalesced": coalesced}}
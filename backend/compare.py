@@ -1,21 +1,54 @@
 import os
-from typing import List, Dict, Any
-from rag import RAGPipeline
+import time
+from typing import List, Dict, Any, AsyncIterator, Tuple
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+import metrics
+from cache import normalize_text
+from coalesce import SingleFlight, caller_result
+from rag import RAGPipeline, record_llm_usage
+
+COMPARE_SYSTEM_PROMPT = """You are CryptoGuide AI, an expert DeFi research assistant.
+        Compare the following protocols based on the user's question.
+
+        Rules:
+        - Structure your response with clear sections for each protocol.
+        - Highlight key differences and similarities.
+        - Cite sources using square brackets like [1], [2].
+        - Use markdown formatting with headers and bullet points.
+        - If information is missing for a protocol, state that clearly.
+
+        Context:
+        {context}
+        """
+
+# Context blocks kept per protocol in a comparison
+DOCS_PER_PROTOCOL = 3
 
 class ComparisonEngine:
     def __init__(self, rag: RAGPipeline):
         self.rag = rag
+        # Built once and shared by every request
+        self.compare_prompt = ChatPromptTemplate.from_messages([
+            ("system", COMPARE_SYSTEM_PROMPT),
+            ("user", "{question}")
+        ])
+        self.compare_chain = self.compare_prompt | self.rag.llm | StrOutputParser()
+        # Identical (normalized question, protocols) comparisons in flight share one computation
+        self.inflight = SingleFlight("compare")
 
-    def compare_protocols(self, question: str, protocols: List[str]) -> Dict[str, Any]:
-        """Compare multiple protocols on a given topic."""
-        
-        # 1. Retrieve context for each protocol
+    def _build_context(self, protocols: List[str], docs_per_protocol: List[List[Dict]], k: int = DOCS_PER_PROTOCOL):
+        """Packs each protocol's candidates into its share of the comparison token budget
+        (ContextPacker.protocol_budget), then numbers sources across protocols and builds
+        the combined prompt context."""
         all_context = {}
         all_sources = []
         source_counter = 1
+        budget = self.rag.context_packer.protocol_budget(len(protocols))
 
-        for protocol in protocols:
-            docs = self.rag.retrieve_context(question, protocol, k=3)
+        for protocol, docs in zip(protocols, docs_per_protocol):
+            docs = self.rag.pack_context(docs, k, budget)
             if docs:
                 formatted = []
                 for doc in docs:
@@ -34,41 +67,130 @@ class ComparisonEngine:
             else:
                 all_context[protocol] = "No documentation found for this protocol."
 
-        # 2. Build comparison prompt
         context_sections = []
         for protocol, context in all_context.items():
             context_sections.append(f"=== {protocol.upper()} ===\n{context}")
-        
-        combined_context = "\n\n".join(context_sections)
-        
-        from langchain_core.prompts import ChatPromptTemplate
-        from langchain_core.output_parsers import StrOutputParser
 
-        system_prompt = """You are CryptoGuide AI, an expert DeFi research assistant.
-        Compare the following protocols based on the user's question.
-        
-        Rules:
-        - Structure your response with clear sections for each protocol.
-        - Highlight key differences and similarities.
-        - Cite sources using square brackets like [1], [2].
-        - Use markdown formatting with headers and bullet points.
-        - If information is missing for a protocol, state that clearly.
-        
-        Context:
-        {context}
+        return "\n\n".join(context_sections), all_sources
+
+    def retrieve_all(self, question: str, protocols: List[str], k: int = DOCS_PER_PROTOCOL) -> List[List[Dict]]:
+        """Embeds the question once and retrieves every protocol's candidates in one round trip."""
+        with metrics.stage("embed"):
+            query_vector = self.rag.embeddings.embed_query(question)
+        grouped = self.rag.retrieve_multi_by_vector(query_vector, protocols, self.rag.context_packer.fetch_k(k))
+        return [grouped.get(protocol, []) for protocol in protocols]
+
+    async def aretrieve_all(self, question: str, protocols: List[str], k: int = DOCS_PER_PROTOCOL) -> List[List[Dict]]:
+        """Async version of retrieve_all."""
+        query_vector = await self.rag.providers.call("embed", lambda: self.rag.embeddings.aembed_query(question))
+        grouped = await self.rag.aretrieve_multi_by_vector(query_vector, protocols, self.rag.context_packer.fetch_k(k))
+        return [grouped.get(protocol, []) for protocol in protocols]
+
+    @staticmethod
+    def coalesce_key(question: str, protocols: List[str]) -> Tuple[str, Tuple[str, ...]]:
+        # Protocol order is kept: it sets the section and source numbering of the answer
+        return normalize_text(question), tuple(protocols)
+
+    def compare_protocols(self, question: str, protocols: List[str]) -> Dict[str, Any]:
+        """Compare multiple protocols on a given topic.
+
+        Synchronous, for scripts only: like RAGPipeline.generate_answer it
+        bypasses the LLM scheduler and Providers.call limits. The API uses
+        acompare_protocols.
         """
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", system_prompt),
-            ("user", "{question}")
-        ])
-        
+        with metrics.track("compare") as tracker:
+            result, coalesced = self.inflight.do(self.coalesce_key(question, protocols),
+                                                 lambda: self._compare_protocols(question, protocols))
+        return caller_result(result, tracker, coalesced)
+
+    def _compare_protocols(self, question: str, protocols: List[str]) -> Dict[str, Any]:
+        # 1. Retrieve context for each protocol
+        docs_per_protocol = self.retrieve_all(question, protocols)
+
+        # 2. Build comparison prompt
+        combined_context, all_sources = self._build_context(protocols, docs_per_protocol)
+
         # 3. Generate comparison
-        chain = prompt | self.rag.llm | StrOutputParser()
-        answer = chain.invoke({"context": combined_context, "question": question})
-        
+        usage = UsageMetadataCallbackHandler()
+        with metrics.stage("llm"):
+            answer = self.compare_chain.invoke({"context": combined_context, "question": question},
+                                               config={"callbacks": [usage]})
+        record_llm_usage(usage, COMPARE_SYSTEM_PROMPT.format(context=combined_context) + question, answer)
+
         return {
             "answer": answer,
             "protocols": protocols,
-            "sources": all_sources
+            "sources": all_sources,
+        }
+
+    async def acompare_protocols(self, question: str, protocols: List[str]) -> Dict[str, Any]:
+        """Async version of compare_protocols."""
+        with metrics.track("compare") as tracker:
+            result, coalesced = await self.inflight.ado(self.coalesce_key(question, protocols),
+                                                        lambda: self._acompare_protocols(question, protocols))
+        return caller_result(result, tracker, coalesced)
+
+    async def _acompare_protocols(self, question: str, protocols: List[str]) -> Dict[str, Any]:
+        # 1. Retrieve context for each protocol
+        docs_per_protocol = await self.aretrieve_all(question, protocols)
+
+        # 2. Build comparison prompt
+        combined_context, all_sources = self._build_context(protocols, docs_per_protocol)
+
+        # 3. Generate comparison
+        usage = UsageMetadataCallbackHandler()
+        async with self.rag.scheduler.slot("compare"):
+            answer = await self.rag.providers.call(
+                "llm", lambda: self.compare_chain.ainvoke({"context": combined_context, "question": question},
+                                                          config={"callbacks": [usage]})
+            )
+        record_llm_usage(usage, COMPARE_SYSTEM_PROMPT.format(context=combined_context) + question, answer)
+
+        return {
+            "answer": answer,
+            "protocols": protocols,
+            "sources": all_sources,
+        }
+
+    async def astream_comparison(self, question: str, protocols: List[str]) -> AsyncIterator[Tuple[str, Any]]:
+        """Streaming comparison. Yields (event, data) pairs: sources first, then answer tokens, then done."""
+        with metrics.track("compare_stream") as tracker:
+            async for event, data in self._astream_comparison(question, protocols):
+                if event == "done":
+                    data = {**data, **tracker.summary()}
+                yield event, data
+
+    async def _astream_comparison(self, question: str, protocols: List[str]) -> AsyncIterator[Tuple[str, Any]]:
+        start = time.perf_counter()
+
+        # 1. Retrieve context for each protocol
+        docs_per_protocol = await self.aretrieve_all(question, protocols)
+        retrieval_time = time.perf_counter() - start
+
+        # 2. Build comparison prompt; sources go out before generation starts
+        combined_context, all_sources = self._build_context(protocols, docs_per_protocol)
+        yield "sources", all_sources
+
+        # 3. Generate comparison token by token
+        first_token_time = None
+        tokens = []
+        chain = self.compare_chain
+        usage = UsageMetadataCallbackHandler()
+        async with self.rag.scheduler.slot("compare"):
+            stream = chain.astream({"context": combined_context, "question": question},
+                                   config={"callbacks": [usage]})
+            async for token in self.rag.providers.stream("llm", stream):
+                if not token:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start
+                tokens.append(token)
+                yield "token", token
+        record_llm_usage(usage, COMPARE_SYSTEM_PROMPT.format(context=combined_context) + question, "".join(tokens))
+
+        yield "done", {
+            "protocols": protocols,
+            "retrieval_time_s": round(retrieval_time, 3),
+            "time_to_first_token_s": round(first_token_time, 3) if first_token_time is not None else None,
+            "total_time_s": round(time.perf_counter() - start, 3),
         }
@@ -0,0 +1,172 @@
+import os
+from typing import List, Dict, Any, Optional, Tuple
+
+from tokens import count_tokens
+from lexical import tokenize
+
+# Chunks are split with a 100-character overlap (ingest_documents.make_text_splitter),
+# so neighbouring chunks of a page repeat text. Overlaps shorter than this are
+# treated as coincidence rather than shared text.
+MIN_OVERLAP_CHARS = 20
+MAX_OVERLAP_CHARS = 200
+GAP_SEPARATOR = "\n[...]\n"
+
+
+def _overlap(left: str, right: str) -> int:
+    """Length of the longest suffix of `left` that is a prefix of `right` (0 if too short)."""
+    for size in range(min(len(left), len(right), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if left.endswith(right[:size]):
+            return size
+    return 0
+
+
+def _join_pieces(pieces: List[str]) -> Tuple[str, int]:
+    """Stitches one page's chunks back together. Returns (text, characters of duplicate text removed)."""
+    removed = 0
+    # Drop chunks wholly contained in another one (longest first, so exact repeats keep one copy)
+    kept: List[int] = []
+    for i in sorted(range(len(pieces)), key=lambda i: -len(pieces[i])):
+        if any(pieces[i] in pieces[j] for j in kept):
+            removed += len(pieces[i])
+        else:
+            kept.append(i)
+    pieces = [pieces[i] for i in sorted(kept)]
+
+    # Chain chunks whose end overlaps another's start, in either order
+    merged = True
+    while merged and len(pieces) > 1:
+        merged = False
+        for i in range(len(pieces)):
+            for j in range(len(pieces)):
+                if i != j:
+                    size = _overlap(pieces[i], pieces[j])
+                    if size:
+                        pieces[i] = pieces[i] + pieces[j][size:]
+                        removed += size
+                        del pieces[j]
+                        merged = True
+                        break
+            if merged:
+                break
+    return GAP_SEPARATOR.join(pieces), removed
+
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+class ContextPacker:
+    """Turns retrieved chunks into the prompt context.
+
+    1. Chunks from the same source and page are merged into one block, with the
+       text they share (the splitter's overlap, or a chunk contained in another)
+       kept once.
+    2. Blocks are picked by maximal marginal relevance: retrieval relevance,
+       penalised by term overlap with blocks already picked, so near-duplicate
+       passages don't crowd out other evidence.
+    3. Picking stops at `k` blocks or when the next block would not fit the
+       token budget (counted with tiktoken, see tokens.py).
+
+    Retrieval fetches `fetch_factor * k` candidates. At the default of 1, MMR
+    only decides which of the top k to drop when the budget binds; a larger
+    factor gives it a wider pool (scripts/benchmark_context.py measures the trade-off).
+
+    Comparisons pack each protocol separately. Every protocol gets the full
+    single-query budget until their sum would exceed `compare_token_budget`.
+    """
+
+    def __init__(self, token_budget: int = 1500, mmr_lambda: float = 0.7, fetch_factor: int = 1,
+                 compare_token_budget: int = 4500):
+        self.token_budget = token_budget
+        self.mmr_lambda = mmr_lambda
+        self.fetch_factor = max(1, fetch_factor)
+        self.compare_token_budget = compare_token_budget
+
+    def fetch_k(self, k: int) -> int:
+        return k * self.fetch_factor
+
+    def protocol_budget(self, n_protocols: int) -> int:
+        """Context tokens for each protocol of an n-protocol comparison."""
+        return min(self.token_budget, self.compare_token_budget // max(n_protocols, 1))
+
+    @staticmethod
+    def block_tokens(block: Dict) -> int:
+        """Tokens this block costs in the prompt (RAGPipeline.format_docs layout)."""
+        meta = block.get("metadata", {})
+        header = f"[0] SOURCE: {meta.get('source', 'Unknown')} (Page {meta.get('page', '?')})\nCONTENT: "
+        return count_tokens(header + block.get("content", "").replace("\n", " "))
+
+    def merge(self, docs: List[Dict]) -> Tuple[List[Dict], int]:
+        """Merges same-page chunks into blocks, in order of their best-ranked chunk.
+        Returns (blocks, characters of duplicate text removed)."""
+        groups: Dict[Tuple, List[Tuple[int, Dict]]] = {}
+        for rank, doc in enumerate(docs):
+            meta = doc.get("metadata", {})
+            groups.setdefault((meta.get("protocol"), meta.get("source"), meta.get("page")), []).append((rank, doc))
+
+        blocks, removed = [], 0
+        n = len(docs)
+        # Groups are in order of first appearance, i.e. of their best-ranked chunk
+        for members in groups.values():
+            _, best = members[0]
+            # Relevance: the match similarity when the backend reports one, else rank
+            relevance = max(doc.get("similarity", 1.0 - rank / n) for rank, doc in members)
+            if len(members) == 1:
+                content = best.get("content", "")
+            else:
+                content, dropped = _join_pieces([doc.get("content", "") for _, doc in members])
+                removed += dropped
+            blocks.append({**best, "content": content, "similarity": relevance, "chunks": len(members)})
+        return blocks, removed
+
+    def pack(self, docs: List[Dict], k: int, token_budget: Optional[int] = None) -> Tuple[List[Dict], Dict[str, Any]]:
+        """Returns (at most k blocks within the budget, stats)."""
+        budget = self.token_budget if token_budget is None else token_budget
+        blocks, removed = self.merge(docs)
+        costs = [self.block_tokens(b) for b in blocks]
+        terms = [set(tokenize(b.get("content", ""))) for b in blocks]
+
+        selected: List[int] = []
+        used = 0
+        remaining = list(range(len(blocks)))
+        while remaining and len(selected) < k:
+            def mmr(i: int) -> float:
+                redundancy = max((_jaccard(terms[i], terms[j]) for j in selected), default=0.0)
+                return self.mmr_lambda * blocks[i]["similarity"] - (1 - self.mmr_lambda) * redundancy
+
+            best = max(remaining, key=mmr)
+            remaining.remove(best)
+            if used + costs[best] > budget:
+                if selected:
+                    continue
+                # Nothing fits yet: keep the best block, cut down to the budget
+                blocks[best] = self._truncate(blocks[best], budget)
+                costs[best] = self.block_tokens(blocks[best])
+            selected.append(best)
+            used += costs[best]
+
+        stats = {
+            "candidates": len(docs),
+            "blocks": len(selected),
+            "merged_chunks": len(docs) - len(blocks),
+            "duplicate_chars_removed": removed,
+            "tokens": used,
+            "token_budget": budget,
+        }
+        return [blocks[i] for i in selected], stats
+
+    def _truncate(self, block: Dict, budget: int) -> Dict:
+        content = block.get("content", "")
+        while content and self.block_tokens({**block, "content": content}) > budget:
+            content = content[:int(len(content) * 0.9)]
+        return {**block, "content": content}
+
+
+def context_packer_from_env() -> ContextPacker:
+    """CONTEXT_TOKEN_BUDGET, CONTEXT_MMR_LAMBDA, CONTEXT_FETCH_FACTOR and COMPARE_TOKEN_BUDGET tune context packing."""
+    return ContextPacker(
+        token_budget=int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500")),
+        mmr_lambda=float(os.environ.get("CONTEXT_MMR_LAMBDA", "0.7")),
+        fetch_factor=int(os.environ.get("CONTEXT_FETCH_FACTOR", "1")),
+        compare_token_budget=int(os.environ.get("COMPARE_TOKEN_BUDGET", "4500")),
+    )
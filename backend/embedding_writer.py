@@ -0,0 +1,173 @@
+import os
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import List, Dict, Tuple, Iterable, Iterator, Callable, Optional
+
+from tokens import count_tokens
+
+# Limits of the OpenAI embeddings endpoint
+MAX_INPUTS_PER_REQUEST = 2048
+MAX_TOKENS_PER_REQUEST = 300_000
+
+
+def token_batches(items: Iterable[Tuple[str, Dict]], max_tokens: int,
+                  max_items: int = MAX_INPUTS_PER_REQUEST) -> Iterator[List[Tuple[str, Dict, int]]]:
+    """Groups (row_id, chunk) pairs into batches of at most `max_tokens` tokens.
+
+    Yields lists of (row_id, chunk, n_tokens). A single chunk larger than the
+    budget still gets a batch of its own.
+    """
+    batch, batch_tokens = [], 0
+    for row_id, chunk in items:
+        n_tokens = count_tokens(chunk["text"])
+        if batch and (batch_tokens + n_tokens > max_tokens or len(batch) == max_items):
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append((row_id, chunk, n_tokens))
+        batch_tokens += n_tokens
+    if batch:
+        yield batch
+
+
+class EmbeddingClient:
+    """Calls the OpenAI embeddings endpoint directly, with rate-limit-aware retries.
+
+    The SDK's own retries are disabled so that a 429 on any in-flight request
+    puts every thread sharing this client into the same cool-down (honouring
+    Retry-After when the server sends it) instead of each one retrying blindly.
+    """
+
+    def __init__(self, model: str = "text-embedding-ada-002", client=None, max_retries: int = 6,
+                 base_delay: float = 1.0, max_delay: float = 60.0):
+        if client is None:
+            from openai import OpenAI
+            # Reads OPENAI_API_KEY and OPENAI_BASE_URL
+            client = OpenAI(max_retries=0)
+        self.client = client
+        self.model = model
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.stats = {"requests": 0, "rate_limited": 0, "retries": 0}
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def _wait_for_cooldown(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def _retry_delay(self, attempt: int, error: Exception) -> float:
+        response = getattr(error, "response", None)
+        retry_after = response.headers.get("retry-after") if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_delay)
+            except ValueError:
+                pass
+        # Full jitter keeps concurrent batches from retrying in lockstep
+        return random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        import openai
+
+        for attempt in range(self.max_retries + 1):
+            self._wait_for_cooldown()
+            try:
+                with self._lock:
+                    self.stats["requests"] += 1
+                response = self.client.embeddings.create(model=self.model, input=texts)
+                return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
+            except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt, e)
+                with self._lock:
+                    self.stats["retries"] += 1
+                    if isinstance(e, openai.RateLimitError):
+                        self.stats["rate_limited"] += 1
+                        self._resume_at = max(self._resume_at, time.monotonic() + delay)
+                if not isinstance(e, openai.RateLimitError):
+                    time.sleep(delay)
+
+    # LangChain Embeddings-compatible name, for callers that only need the vectors
+    embed_documents = embed
+
+
+class EmbeddingWriter:
+    """Embeds (row_id, chunk) pairs and writes them as `documents` rows.
+
+    Embedding requests are cut by token count rather than item count, up to
+    `max_in_flight` of them run concurrently, and finished rows are written
+    `insert_batch_size` at a time while later batches are still embedding.
+    """
+
+    def __init__(self, embed: Callable[[List[str]], List[List[float]]], write_rows: Callable[[List[Dict]], None],
+                 max_tokens: int = 50_000, max_in_flight: int = 4, insert_batch_size: int = 200):
+        self.embed = embed
+        self.write_rows = write_rows
+        self.max_tokens = min(max_tokens, MAX_TOKENS_PER_REQUEST)
+        self.max_in_flight = max_in_flight
+        self.insert_batch_size = insert_batch_size
+
+    def _embed_batch(self, batch: List[Tuple[str, Dict, int]]) -> List[Dict]:
+        vectors = self.embed([chunk["text"] for _, chunk, _ in batch])
+        return [
+            {"id": row_id, "content": chunk["text"], "metadata": chunk["metadata"],
+             "protocol": chunk["metadata"]["protocol"], "embedding": vector}
+            for (row_id, chunk, _), vector in zip(batch, vectors)
+        ]
+
+    def write(self, items: Iterable[Tuple[str, Dict]]) -> Dict[str, int]:
+        stats = {"rows": 0, "tokens": 0, "embed_batches": 0, "insert_batches": 0}
+        buffer: List[Dict] = []
+
+        def flush(final: bool = False):
+            while len(buffer) >= self.insert_batch_size or (final and buffer):
+                rows = buffer[:self.insert_batch_size]
+                del buffer[:self.insert_batch_size]
+                self.write_rows(rows)
+                stats["rows"] += len(rows)
+                stats["insert_batches"] += 1
+
+        def collect(done):
+            for future in done:
+                buffer.extend(future.result())
+            flush()
+
+        pending = set()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            try:
+                for batch in token_batches(items, self.max_tokens):
+                    if len(pending) >= self.max_in_flight:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        collect(done)
+                    pending.add(pool.submit(self._embed_batch, batch))
+                    stats["tokens"] += sum(n for _, _, n in batch)
+                    stats["embed_batches"] += 1
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            finally:
+                for future in pending:
+                    future.cancel()
+        flush(final=True)
+        return stats
+
+
+def embedding_writer_from_env(write_rows: Callable[[List[Dict]], None],
+                              client: Optional[EmbeddingClient] = None) -> EmbeddingWriter:
+    """EMBED_BATCH_TOKENS, EMBED_MAX_IN_FLIGHT and INSERT_BATCH_SIZE tune the writer."""
+    client = client or EmbeddingClient()
+    return EmbeddingWriter(
+        client.embed,
+        write_rows,
+        max_tokens=int(os.environ.get("EMBED_BATCH_TOKENS", "50000")),
+        max_in_flight=int(os.environ.get("EMBED_MAX_IN_FLIGHT", "4")),
+        insert_batch_size=int(os.environ.get("INSERT_BATCH_SIZE", "200")),
+    )
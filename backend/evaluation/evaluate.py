@@ -7,8 +7,10 @@ import os
 import sys
 import json
 import time
+import asyncio
+import argparse
 from datetime import datetime
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -16,18 +18,21 @@ load_dotenv()
 # Add parent dir so we can import rag
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 from rag import RAGPipeline
+import metrics
+from tokens import count_tokens
+from fixtures import ProviderFixture, record_pipeline, replay_pipeline
 
 # ── Constants ──────────────────────────────────────────────
 EVAL_DIR = os.path.dirname(os.path.abspath(__file__))
 GROUND_TRUTH_PATH = os.path.join(EVAL_DIR, "ground_truth.json")
 REPORT_PATH = os.path.join(EVAL_DIR, "eval_report.md")
+# Test cases evaluated at once (EVAL_CONCURRENCY or --concurrency)
+DEFAULT_CONCURRENCY = int(os.environ.get("EVAL_CONCURRENCY", "4"))
 
 # Rough cost estimates (per 1K tokens)
 COST_EMBED_INPUT = 0.0001     # text-embedding-ada-002
 COST_HAIKU_INPUT = 0.00025    # claude-3-haiku input
 COST_HAIKU_OUTPUT = 0.00125   # claude-3-haiku output
-AVG_INPUT_TOKENS = 1200
-AVG_OUTPUT_TOKENS = 400
 
 
 def load_ground_truth() -> List[Dict]:
@@ -63,75 +68,108 @@ def check_citation_accuracy(answer: str, num_sources: int) -> float:
     return valid / len(citations) if citations else 0.0
 
 
-def estimate_cost() -> float:
-    """Estimate cost per query based on token usage."""
-    input_cost = (AVG_INPUT_TOKENS / 1000) * COST_HAIKU_INPUT
-    output_cost = (AVG_OUTPUT_TOKENS / 1000) * COST_HAIKU_OUTPUT
-    embed_cost = (AVG_INPUT_TOKENS / 1000) * COST_EMBED_INPUT
+def estimate_cost(input_tokens: int, output_tokens: int, embed_tokens: int) -> float:
+    """Cost of one query from its measured LLM tokens and the embedded question's tokens."""
+    input_cost = (input_tokens / 1000) * COST_HAIKU_INPUT
+    output_cost = (output_tokens / 1000) * COST_HAIKU_OUTPUT
+    embed_cost = (embed_tokens / 1000) * COST_EMBED_INPUT
     return input_cost + output_cost + embed_cost
 
 
-def run_evaluation():
-    """Run full evaluation suite against ground truth dataset."""
+async def evaluate_case(rag: RAGPipeline, tc: Dict, total: int, semaphore: asyncio.Semaphore) -> Dict:
+    """Retrieves once, generates from those same documents, and scores the answer."""
+    async with semaphore:
+        with metrics.track("eval") as tracker:
+            start = time.perf_counter()
+
+            # Step 1: Retrieve
+            docs = await rag.aretrieve_context(tc['question'], tc['protocol'])
+            retrieval_time = time.perf_counter() - start
+
+            # Step 2: Generate from the retrieved documents (no second retrieval)
+            gen_start = time.perf_counter()
+            result = await rag.agenerate_from_docs(tc['question'], tc['protocol'], docs)
+            generation_time = time.perf_counter() - gen_start
+            total_time = time.perf_counter() - start
+        tokens = tracker.summary()["tokens"]
+
+    answer = result['answer']
+    sources = result['sources']
+
+    # Metrics
+    retrieval_accurate = check_retrieval_accuracy(docs, tc['expected_source'])
+    keyword_coverage = check_keyword_coverage(answer, tc['expected_keywords'])
+    citation_accuracy = check_citation_accuracy(answer, len(sources))
+    cost = estimate_cost(tokens["input"], tokens["output"], count_tokens(tc['question']))
+
+    status = "✅" if retrieval_accurate else "❌"
+    print(f"[{tc['id']}/{total}] {tc['protocol'].upper()}: {tc['question'][:60]}...\n"
+          f"  {status} Retrieval: {retrieval_accurate} | Keywords: {keyword_coverage:.0%} | "
+          f"Citations: {citation_accuracy:.0%} | Latency: {total_time:.1f}s")
+
+    return {
+        "id": tc['id'],
+        "protocol": tc['protocol'],
+        "question": tc['question'],
+        "category": tc['category'],
+        "retrieval_accurate": retrieval_accurate,
+        "keyword_coverage": keyword_coverage,
+        "citation_accuracy": citation_accuracy,
+        "latency_s": round(total_time, 2),
+        "retrieval_time_s": round(retrieval_time, 2),
+        "generation_time_s": round(generation_time, 2),
+        "input_tokens": tokens["input"],
+        "output_tokens": tokens["output"],
+        "cost_usd": round(cost, 5),
+        "num_sources": len(sources),
+        "answer_preview": answer[:150] + "..."
+    }
+
+
+def run_evaluation(concurrency: int = DEFAULT_CONCURRENCY, record: Optional[str] = None,
+                   replay: Optional[str] = None, replay_latency: bool = False):
+    """Run full evaluation suite against ground truth dataset.
+
+    Up to `concurrency` test cases run at once. With `record`, every provider
+    response is saved to that fixture file; with `replay`, providers answer from
+    it instead (offline and deterministic).
+    """
     print("=" * 60)
     print("CryptoGuide AI — Evaluation Suite")
     print(f"Started: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print("=" * 60)
 
     # Init pipeline
-    rag = RAGPipeline()
+    fixture = None
+    if replay:
+        fixture = ProviderFixture(replay, replay=True, simulate_latency=replay_latency)
+        rag = replay_pipeline(fixture)
+        mode = f"replay ({os.path.basename(replay)})"
+    else:
+        rag = RAGPipeline()
+        mode = "live"
+        if record:
+            fixture = ProviderFixture(record)
+            record_pipeline(rag, fixture)
+            mode = f"live, recording to {os.path.basename(record)}"
     test_cases = load_ground_truth()
+    print(f"Mode: {mode} | Concurrency: {concurrency}\n")
 
-    results = []
-    total_start = time.time()
-
-    for tc in test_cases:
-        print(f"\n[{tc['id']}/{len(test_cases)}] {tc['protocol'].upper()}: {tc['question'][:60]}...")
-
-        # Measure latency
-        start = time.time()
-
-        # Step 1: Retrieve
-        docs = rag.retrieve_context(tc['question'], tc['protocol'])
-        retrieval_time = time.time() - start
-
-        # Step 2: Generate
-        gen_start = time.time()
-        result = rag.generate_answer(tc['question'], tc['protocol'])
-        generation_time = time.time() - gen_start
-        total_time = time.time() - start
-
-        answer = result['answer']
-        sources = result['sources']
-
-        # Metrics
-        retrieval_accurate = check_retrieval_accuracy(docs, tc['expected_source'])
-        keyword_coverage = check_keyword_coverage(answer, tc['expected_keywords'])
-        citation_accuracy = check_citation_accuracy(answer, len(sources))
-        cost = estimate_cost()
-
-        r = {
-            "id": tc['id'],
-            "protocol": tc['protocol'],
-            "question": tc['question'],
-            "category": tc['category'],
-            "retrieval_accurate": retrieval_accurate,
-            "keyword_coverage": keyword_coverage,
-            "citation_accuracy": citation_accuracy,
-            "latency_s": round(total_time, 2),
-            "retrieval_time_s": round(retrieval_time, 2),
-            "generation_time_s": round(generation_time, 2),
-            "cost_usd": round(cost, 5),
-            "num_sources": len(sources),
-            "answer_preview": answer[:150] + "..."
-        }
-        results.append(r)
-
-        status = "✅" if retrieval_accurate else "❌"
-        print(f"  {status} Retrieval: {retrieval_accurate} | Keywords: {keyword_coverage:.0%} | "
-              f"Citations: {citation_accuracy:.0%} | Latency: {total_time:.1f}s")
+    async def run_all() -> List[Dict]:
+        semaphore = asyncio.Semaphore(concurrency)
+        try:
+            return list(await asyncio.gather(
+                *(evaluate_case(rag, tc, len(test_cases), semaphore) for tc in test_cases)
+            ))
+        finally:
+            await rag.providers.aclose()
 
+    total_start = time.time()
+    results = asyncio.run(run_all())
     total_duration = time.time() - total_start
+    if record:
+        fixture.save()
+        print(f"\n🎞  Recorded {fixture.stats()} responses to: {record}")
 
     # Aggregate
     n = len(results)
@@ -170,7 +208,7 @@ def run_evaluation():
 
     # Generate report
     generate_report(results, retrieval_acc, avg_keyword, avg_citation,
-                    avg_latency, avg_cost, total_cost, total_duration, proto_stats)
+                    avg_latency, avg_cost, total_cost, total_duration, proto_stats, mode, concurrency)
 
     # Save raw results
     raw_path = os.path.join(EVAL_DIR, "eval_results.json")
@@ -181,7 +219,8 @@ def run_evaluation():
 
 
 def generate_report(results, retrieval_acc, avg_keyword, avg_citation,
-                    avg_latency, avg_cost, total_cost, total_duration, proto_stats):
+                    avg_latency, avg_cost, total_cost, total_duration, proto_stats,
+                    mode="live", concurrency=1):
     """Generate markdown evaluation report."""
 
     def status_icon(val, target):
@@ -192,6 +231,7 @@ def generate_report(results, retrieval_acc, avg_keyword, avg_citation,
         f"",
         f"**Generated:** {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}  ",
         f"**Test Cases:** {len(results)}  ",
+        f"**Mode:** {mode} · concurrency {concurrency}  ",
         f"**Total Duration:** {total_duration:.0f}s  ",
         f"**Total Cost:** ${total_cost:.4f}",
         f"",
@@ -257,4 +297,14 @@ def generate_report(results, retrieval_acc, avg_keyword, avg_citation,
 
 
 if __name__ == "__main__":
-    run_evaluation()
+    parser = argparse.ArgumentParser(description='Run the CryptoGuide AI evaluation suite')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Test cases evaluated at once (default: EVAL_CONCURRENCY or 4)')
+    parser.add_argument('--record', metavar='FIXTURE', help='Save every provider response to this fixture file')
+    parser.add_argument('--replay', metavar='FIXTURE', help='Answer from a recorded fixture instead of live providers')
+    parser.add_argument('--replay-latency', action='store_true',
+                        help='When replaying, sleep for each response\'s recorded latency')
+    args = parser.parse_args()
+    if args.record and args.replay:
+        parser.error("--record and --replay are mutually exclusive")
+    run_evaluation(args.concurrency, args.record, args.replay, args.replay_latency)
@@ -0,0 +1,251 @@
+"""
+Record/replay of provider responses for the evaluation suite.
+
+In record mode the pipeline's embeddings client, retriever and LLM are wrapped
+so every response (plus how long it took) is written to a JSON fixture. In
+replay mode the same wrappers answer from that fixture without credentials or
+network access, so the suite re-runs offline and deterministically:
+
+    python evaluation/evaluate.py --record evaluation/fixtures/eval.json
+    python evaluation/evaluate.py --replay evaluation/fixtures/eval.json [--replay-latency]
+"""
+
+import os
+import json
+import time
+import asyncio
+import hashlib
+import threading
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.output_parsers import StrOutputParser
+
+FIXTURE_VERSION = 1
+
+
+class FixtureMissing(KeyError):
+    """Replay needed a provider response the fixture does not contain (re-record it)."""
+
+
+def _digest(value: Any) -> str:
+    return hashlib.sha256(json.dumps(value, sort_keys=True).encode()).hexdigest()[:24]
+
+
+class ProviderFixture:
+    """Recorded provider responses, keyed per provider ("embeddings", "retrieval", "llm")."""
+
+    def __init__(self, path: str, replay: bool = False, simulate_latency: bool = False):
+        self.path = path
+        self.replay = replay
+        self.simulate_latency = simulate_latency
+        self.data: Dict[str, Any] = {"version": FIXTURE_VERSION, "embeddings": {}, "retrieval": {}, "llm": {}}
+        self.lookups = {"embeddings": 0, "retrieval": 0, "llm": 0}
+        self._lock = threading.Lock()
+        if replay:
+            with open(path, "r") as f:
+                self.data = json.load(f)
+            if self.data.get("version") != FIXTURE_VERSION:
+                raise ValueError(f"Unsupported fixture version in {path}: {self.data.get('version')}")
+
+    def record(self, provider: str, key: str, response: Any, latency_s: float):
+        with self._lock:
+            self.data[provider][key] = {"response": response, "latency_s": round(latency_s, 4)}
+
+    def _entry(self, provider: str, key: str) -> Dict[str, Any]:
+        entry = self.data[provider].get(key)
+        if entry is None:
+            raise FixtureMissing(f"No recorded {provider} response for key {key!r} in {self.path}; re-record it")
+        with self._lock:
+            self.lookups[provider] += 1
+        return entry
+
+    def replayed(self, provider: str, key: str) -> Any:
+        entry = self._entry(provider, key)
+        if self.simulate_latency:
+            time.sleep(entry["latency_s"])
+        return entry["response"]
+
+    async def areplayed(self, provider: str, key: str) -> Any:
+        entry = self._entry(provider, key)
+        if self.simulate_latency:
+            await asyncio.sleep(entry["latency_s"])
+        return entry["response"]
+
+    def save(self):
+        self.data["recorded"] = datetime.now().isoformat(timespec="seconds")
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.data, f, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def stats(self) -> Dict[str, int]:
+        return {provider: len(self.data[provider]) for provider in self.lookups}
+
+
+class RecordedEmbeddings:
+    """Query embeddings keyed on the exact text. Wraps `inner` when recording, replays when it is None."""
+
+    def __init__(self, fixture: ProviderFixture, inner=None):
+        self.fixture = fixture
+        self.inner = inner
+
+    def __getattr__(self, name):
+        # cache, model, ... of the wrapped client
+        return getattr(self.inner, name)
+
+    def embed_query(self, text: str) -> List[float]:
+        if self.inner is None:
+            return self.fixture.replayed("embeddings", text)
+        start = time.perf_counter()
+        vector = self.inner.embed_query(text)
+        self.fixture.record("embeddings", text, vector, time.perf_counter() - start)
+        return vector
+
+    async def aembed_query(self, text: str) -> List[float]:
+        if self.inner is None:
+            return await self.fixture.areplayed("embeddings", text)
+        start = time.perf_counter()
+        vector = await self.inner.aembed_query(text)
+        self.fixture.record("embeddings", text, vector, time.perf_counter() - start)
+        return vector
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [await self.aembed_query(text) for text in texts]
+
+
+class RecordedRetriever:
+    """Retriever results keyed on (protocol, k, query vector)."""
+
+    def __init__(self, fixture: ProviderFixture, inner=None):
+        self.fixture = fixture
+        self.inner = inner
+
+    def __getattr__(self, name):
+        # client / index of the wrapped retriever (hybrid mode reads `index`)
+        if self.inner is None:
+            raise AttributeError(name)
+        return getattr(self.inner, name)
+
+    @staticmethod
+    def key(query_vector: List[float], protocol: str, k: int) -> str:
+        return f"{protocol}|{k}|{_digest(query_vector)}"
+
+    def search(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        key = self.key(query_vector, protocol, k)
+        if self.inner is None:
+            return self.fixture.replayed("retrieval", key)
+        start = time.perf_counter()
+        docs = self.inner.search(query_vector, protocol, k)
+        self.fixture.record("retrieval", key, docs, time.perf_counter() - start)
+        return docs
+
+    async def asearch(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        key = self.key(query_vector, protocol, k)
+        if self.inner is None:
+            return await self.fixture.areplayed("retrieval", key)
+        start = time.perf_counter()
+        docs = await self.inner.asearch(query_vector, protocol, k)
+        self.fixture.record("retrieval", key, docs, time.perf_counter() - start)
+        return docs
+
+    # Grouped results are recorded per protocol, under the same keys as search, each with
+    # an equal share of the call's latency (replay sleeps once per protocol)
+    def search_multi(self, query_vector: List[float], protocols: List[str], k: int = 5) -> Dict[str, List[Dict]]:
+        if self.inner is None:
+            return {p: self.fixture.replayed("retrieval", self.key(query_vector, p, k)) for p in dict.fromkeys(protocols)}
+        start = time.perf_counter()
+        grouped = self.inner.search_multi(query_vector, protocols, k)
+        self._record_grouped(query_vector, k, grouped, time.perf_counter() - start)
+        return grouped
+
+    async def asearch_multi(self, query_vector: List[float], protocols: List[str], k: int = 5) -> Dict[str, List[Dict]]:
+        if self.inner is None:
+            return {p: await self.fixture.areplayed("retrieval", self.key(query_vector, p, k))
+                    for p in dict.fromkeys(protocols)}
+        start = time.perf_counter()
+        grouped = await self.inner.asearch_multi(query_vector, protocols, k)
+        self._record_grouped(query_vector, k, grouped, time.perf_counter() - start)
+        return grouped
+
+    def _record_grouped(self, query_vector: List[float], k: int, grouped: Dict[str, List[Dict]], seconds: float):
+        for protocol, docs in grouped.items():
+            self.fixture.record("retrieval", self.key(query_vector, protocol, k), docs, seconds / len(grouped))
+
+
+class RecordedChatModel(BaseChatModel):
+    """Chat completions keyed on the rendered prompt messages.
+
+    The recorded message keeps its usage metadata, so replayed runs report the
+    same token counts (and cost) as the recording.
+    """
+
+    fixture: Any
+    inner: Optional[Any] = None
+
+    @property
+    def _llm_type(self) -> str:
+        return "recorded"
+
+    @staticmethod
+    def key(messages: List[BaseMessage]) -> str:
+        return _digest([[message.type, message.content] for message in messages])
+
+    @staticmethod
+    def _result(response: Dict[str, Any]) -> ChatResult:
+        message = AIMessage(content=response["content"], usage_metadata=response.get("usage_metadata"),
+                            response_metadata=response.get("response_metadata", {}))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _to_fixture(self, messages: List[BaseMessage], message: Any, start: float) -> ChatResult:
+        if not isinstance(message, BaseMessage):
+            message = AIMessage(content=str(message))
+        response = {
+            "content": message.content,
+            "usage_metadata": getattr(message, "usage_metadata", None),
+            "response_metadata": {"model_name": message.response_metadata.get("model_name")
+                                  or message.response_metadata.get("model")},
+        }
+        self.fixture.record("llm", self.key(messages), response, time.perf_counter() - start)
+        return self._result(response)
+
+    @staticmethod
+    def _call_kwargs(stop, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        return {**kwargs, "stop": stop} if stop is not None else kwargs
+
+    # The wrapped model is invoked without callbacks: this model reports the run (and its usage) itself.
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.inner is None:
+            return self._result(self.fixture.replayed("llm", self.key(messages)))
+        start = time.perf_counter()
+        message = self.inner.invoke(messages, config={"callbacks": []}, **self._call_kwargs(stop, kwargs))
+        return self._to_fixture(messages, message, start)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.inner is None:
+            return self._result(await self.fixture.areplayed("llm", self.key(messages)))
+        start = time.perf_counter()
+        message = await self.inner.ainvoke(messages, config={"callbacks": []}, **self._call_kwargs(stop, kwargs))
+        return self._to_fixture(messages, message, start)
+
+
+def record_pipeline(rag, fixture: ProviderFixture):
+    """Wraps a live pipeline's providers so their responses are written to `fixture`."""
+    rag.embeddings = RecordedEmbeddings(fixture, rag.embeddings)
+    rag.retriever = RecordedRetriever(fixture, rag.retriever)
+    rag.llm = RecordedChatModel(fixture=fixture, inner=rag.llm)
+    rag.answer_chain = rag.answer_prompt | rag.llm | StrOutputParser()
+    return rag
+
+
+def replay_pipeline(fixture: ProviderFixture):
+    """A RAGPipeline whose providers all answer from `fixture` (no credentials needed)."""
+    from rag import RAGPipeline
+
+    return RAGPipeline(embeddings=RecordedEmbeddings(fixture), retriever=RecordedRetriever(fixture),
+                       llm=RecordedChatModel(fixture=fixture))
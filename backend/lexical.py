@@ -0,0 +1,157 @@
+import os
+import re
+import json
+import math
+from collections import Counter, defaultdict
+from typing import List, Dict, Any, Optional, Tuple
+
+# Kept short on purpose: protocol vocabulary ("health factor", "close factor")
+# is made of ordinary words, so only true function words are dropped.
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for", "from",
+    "how", "in", "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "what",
+    "when", "which", "who", "why", "with", "work", "works",
+}
+
+
+def tokenize(text: str) -> List[str]:
+    return [t for t in re.findall(r"[a-z0-9]+", text.lower()) if t not in STOPWORDS]
+
+
+def doc_key(doc: Dict) -> Tuple:
+    """Identifies a chunk across backends (Supabase ids are not known at ingest time)."""
+    meta = doc.get("metadata", {})
+    return meta.get("protocol"), meta.get("source"), meta.get("page"), doc.get("content")
+
+
+class BM25Index:
+    """Okapi BM25 inverted index over chunk text, partitioned by protocol.
+
+    Built at ingest time from chunk_text output (or from any rows with
+    content + metadata) and persisted as JSON; postings are rebuilt on load.
+    """
+
+    def __init__(self, records: List[Dict[str, Any]], k1: float = 1.5, b: float = 0.75):
+        self.records = records
+        self.k1 = k1
+        self.b = b
+        self._postings: Dict[str, Dict[str, List[Tuple[int, int]]]] = defaultdict(lambda: defaultdict(list))
+        self._lengths: List[int] = []
+        self._stats: Dict[str, Dict[str, float]] = {}
+
+        doc_counts: Dict[str, int] = Counter()
+        total_lengths: Dict[str, int] = Counter()
+        for i, record in enumerate(records):
+            protocol = record.get("metadata", {}).get("protocol") or ""
+            terms = Counter(tokenize(record.get("content", "")))
+            for term, tf in terms.items():
+                self._postings[protocol][term].append((i, tf))
+            length = sum(terms.values())
+            self._lengths.append(length)
+            doc_counts[protocol] += 1
+            total_lengths[protocol] += length
+        for protocol, n in doc_counts.items():
+            self._stats[protocol] = {"n": n, "avgdl": total_lengths[protocol] / n if n else 0.0}
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def _idf(self, protocol: str, term: str) -> float:
+        n = self._stats[protocol]["n"]
+        df = len(self._postings[protocol].get(term, ()))
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def search(self, query: str, protocol: str, k: int = 5) -> List[Dict]:
+        """Returns the top-k chunks as match_documents-shaped rows with a `bm25` score
+        and `coverage` (fraction of query terms present in the chunk)."""
+        if protocol not in self._stats:
+            return []
+        # The protocol name and version tags ("aave", "v3") carry no signal inside
+        # a single protocol's partition, so they don't count toward coverage.
+        terms = {t for t in tokenize(query) if t != protocol and not re.fullmatch(r"v\d+", t)}
+        if not terms:
+            return []
+
+        avgdl = self._stats[protocol]["avgdl"] or 1.0
+        scores: Dict[int, float] = defaultdict(float)
+        matched: Dict[int, int] = Counter()
+        for term in terms:
+            postings = self._postings[protocol].get(term)
+            if not postings:
+                continue
+            idf = self._idf(protocol, term)
+            for i, tf in postings:
+                norm = self.k1 * (1 - self.b + self.b * self._lengths[i] / avgdl)
+                scores[i] += idf * tf * (self.k1 + 1) / (tf + norm)
+                matched[i] += 1
+
+        top = sorted(scores, key=scores.get, reverse=True)[:k]
+        return [
+            {**self.records[i], "bm25": round(scores[i], 4), "coverage": matched[i] / len(terms)}
+            for i in top
+        ]
+
+    @staticmethod
+    def is_decisive(hits: List[Dict], min_ratio: float = 1.5, min_coverage: float = 1.0) -> bool:
+        """True when the best lexical hit contains every query term and clearly beats the runner-up."""
+        if not hits or hits[0]["coverage"] < min_coverage:
+            return False
+        if len(hits) == 1:
+            return True
+        return hits[0]["bm25"] >= min_ratio * hits[1]["bm25"]
+
+    # --- Building / persistence ---
+
+    @classmethod
+    def from_chunks(cls, chunks: List[Dict]) -> "BM25Index":
+        """Builds an index from ingest_documents.chunk_text output."""
+        return cls([{"content": c["text"], "metadata": c["metadata"]} for c in chunks])
+
+    def merge(self, other: "BM25Index") -> "BM25Index":
+        """Returns a new index with `other`'s rows replacing any rows for the same (protocol, source)."""
+        replaced = {(r["metadata"].get("protocol"), r["metadata"].get("source")) for r in other.records}
+        kept = [r for r in self.records
+                if (r["metadata"].get("protocol"), r["metadata"].get("source")) not in replaced]
+        return BM25Index(kept + other.records, self.k1, self.b)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"k1": self.k1, "b": self.b, "records": self.records}, f)
+
+    @classmethod
+    def load(cls, path: str) -> "BM25Index":
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["records"], data.get("k1", 1.5), data.get("b", 0.75))
+
+
+def reciprocal_rank_fusion(ranked_lists: List[List[Dict]], k: int, rrf_k: int = 60) -> List[Dict]:
+    """Fuses several ranked lists of chunks by reciprocal rank; returns the top k.
+
+    Each returned chunk's `similarity` is its fused score divided by the top
+    one, so every chunk is on the same 0-1 scale whichever list it came from
+    (a vector hit's cosine and a BM25-only hit's rank are not comparable).
+    """
+    scores: Dict[Tuple, float] = defaultdict(float)
+    docs: Dict[Tuple, Dict] = {}
+    for ranked in ranked_lists:
+        for rank, doc in enumerate(ranked):
+            key = doc_key(doc)
+            scores[key] += 1.0 / (rrf_k + rank + 1)
+            docs.setdefault(key, doc)
+    top = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [{**docs[key], "similarity": scores[key] / scores[top[0]]} for key in top]
+
+
+def lexical_index_from_env(fallback_records: Optional[List[Dict]] = None) -> Optional[BM25Index]:
+    """Loads BM25_INDEX_PATH, or builds from `fallback_records` (e.g. the local vector index)."""
+    path = os.environ.get("BM25_INDEX_PATH")
+    if path:
+        index = BM25Index.load(path)
+    elif fallback_records:
+        index = BM25Index(fallback_records)
+    else:
+        return None
+    print(f"Loaded BM25 index: {len(index)} chunks")
+    return index
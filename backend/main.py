@@ -1,14 +1,25 @@
-from fastapi import FastAPI, HTTPException
+import time
+import secrets
+IMPORT_START = time.perf_counter()
+
+from fastapi import FastAPI, HTTPException, Header
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict, Field
 from typing import List, Optional, Dict, Any
 from dotenv import load_dotenv
 import os
+import json
 import uvicorn
 from contextlib import asynccontextmanager
 
 from rag import RAGPipeline
 from compare import ComparisonEngine
+from providers import DeadlineExceeded, request_deadline
+from admission import Overloaded
+from sessions import SessionNotFound
+from shared import prepare_shared_state, coordinated_warm_up
+import metrics
 
 # Load env vars
 load_dotenv()
@@ -16,17 +27,44 @@ load_dotenv()
 # App State
 rag_pipeline = None
 comparison_engine = None
+pipeline_ready = False
+startup = {"import_s": round(time.perf_counter() - IMPORT_START, 3)}
+
+def create_pipeline() -> RAGPipeline:
+    """Builds this worker's pipeline (scripts/benchmark_workers.py swaps in stub providers)."""
+    return RAGPipeline()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global rag_pipeline, comparison_engine
+    global rag_pipeline, comparison_engine, pipeline_ready
     try:
-        rag_pipeline = RAGPipeline()
+        start = time.perf_counter()
+        # Multi-worker mode: caches and the local index live in SHARED_STATE_DIR
+        shared = prepare_shared_state()
+        if shared:
+            startup["shared_state"] = shared
+        rag_pipeline = create_pipeline()
         comparison_engine = ComparisonEngine(rag_pipeline)
-        print("RAG Pipeline + Comparison Engine initialized.")
+        startup["init_s"] = round(time.perf_counter() - start, 3)
+        print(f"RAG Pipeline + Comparison Engine initialized in {startup['init_s']}s.")
+
+        # Optional: open provider connections before reporting ready (scale-to-zero hosts)
+        warmup = os.environ.get("WARMUP", "0").lower() in ("1", "true", "yes")
+        start = time.perf_counter()
+        if shared:
+            # The index is pre-faulted once per server; provider probes run in every worker
+            await coordinated_warm_up(rag_pipeline, warmup)
+        elif warmup:
+            await rag_pipeline.awarm_up()
+        if shared or warmup:
+            startup["warmup_s"] = round(time.perf_counter() - start, 3)
+            print(f"Warm-up finished in {startup['warmup_s']}s: {rag_pipeline.warmup}")
+        pipeline_ready = True
     except Exception as e:
         print(f"Failed to initialize: {e}")
     yield
+    if rag_pipeline:
+        await rag_pipeline.providers.aclose()
 
 app = FastAPI(title="CryptoGuide AI API", lifespan=lifespan)
 
@@ -43,11 +81,32 @@ app.add_middleware(
 class QueryRequest(BaseModel):
     question: str
     protocol: str = "aave"
+    # Conversations: the first question sets start_session and gets metadata.session.id
+    # back; follow-ups send that id (ids the server did not issue get a 404)
+    start_session: bool = False
+    session_id: Optional[str] = None
 
 class CompareRequest(BaseModel):
     question: str
     protocols: List[str] = ["aave", "compound"]
 
+class BatchQueryItem(BaseModel):
+    # Batch items are answered independently; session fields are rejected rather than ignored
+    model_config = ConfigDict(extra="forbid")
+    question: str
+    protocol: str = "aave"
+
+# Requests asking for more than this are rejected (422); anything above
+# BATCH_CONCURRENCY is lowered to it by the pipeline.
+MAX_BATCH_CONCURRENCY = 64
+
+class BatchQueryRequest(BaseModel):
+    queries: List[BatchQueryItem]
+    concurrency: Optional[int] = Field(None, ge=1, le=MAX_BATCH_CONCURRENCY)
+
+class InvalidateRequest(BaseModel):
+    protocol: Optional[str] = None
+
 class Source(BaseModel):
     id: int
     document: Optional[str] = None
@@ -60,16 +119,51 @@ class QueryResponse(BaseModel):
     sources: List[Source]
     metadata: Dict[str, Any] = {}
 
+class BatchQueryResult(BaseModel):
+    answer: Optional[str] = None
+    sources: List[Source] = []
+    metadata: Dict[str, Any] = {}
+    error: Optional[str] = None
+    status: int = 200
+
+class BatchQueryResponse(BaseModel):
+    results: List[BatchQueryResult]
+    metadata: Dict[str, Any] = {}
+
 class CompareResponse(BaseModel):
     answer: str
     protocols: List[str]
     sources: List[Source]
     metadata: Dict[str, Any] = {}
 
+def overloaded_error(e: Overloaded) -> HTTPException:
+    """429/503 with Retry-After for requests the LLM scheduler turned away."""
+    return HTTPException(status_code=e.status_code, detail=str(e), headers={"Retry-After": str(e.retry_after)})
+
+def error_status(e: Exception) -> int:
+    """The status /api/query would answer with for `e`, reported per item in batches."""
+    if isinstance(e, DeadlineExceeded):
+        return 504
+    if isinstance(e, Overloaded):
+        return e.status_code
+    return 500
+
 # --- Endpoints ---
 @app.get("/health")
 async def health_check():
-    return {"status": "ok", "pipeline_ready": rag_pipeline is not None}
+    status = {"status": "ok", "pipeline_ready": pipeline_ready, "startup": startup, "pid": os.getpid()}
+    if rag_pipeline:
+        status["warmup"] = rag_pipeline.warmup
+        status["embedding_cache"] = rag_pipeline.embedding_cache.stats()
+        status["answer_cache"] = rag_pipeline.answer_cache.stats()
+        status["retrieval"] = rag_pipeline.retrieval_summary()
+        status["providers"] = rag_pipeline.providers.stats()
+        status["admission"] = rag_pipeline.scheduler.stats()
+        status["sessions"] = rag_pipeline.sessions.stats()
+        status["coalescing"] = {"query": rag_pipeline.inflight.stats()}
+        if comparison_engine:
+            status["coalescing"]["compare"] = comparison_engine.inflight.stats()
+    return status
 
 @app.post("/api/query", response_model=QueryResponse)
 async def query_protocol(request: QueryRequest):
@@ -77,16 +171,64 @@ async def query_protocol(request: QueryRequest):
         raise HTTPException(status_code=503, detail="RAG Pipeline not initialized")
     
     try:
-        result = rag_pipeline.generate_answer(request.question, request.protocol)
+        with request_deadline(rag_pipeline.providers.request_deadline):
+            if request.session_id:
+                result = await rag_pipeline.asession_answer(request.session_id, request.question, request.protocol)
+            else:
+                result = await rag_pipeline.agenerate_answer(request.question, request.protocol,
+                                                             start_session=request.start_session)
         return QueryResponse(
             answer=result["answer"],
             sources=result["sources"],
-            metadata={"model": "claude-3-haiku-20240307"}
+            metadata={"model": "claude-3-haiku-20240307", **result.get("metadata", {})}
         )
+    except SessionNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except DeadlineExceeded as e:
+        print(f"Query timed out: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except Overloaded as e:
+        print(f"Query shed: {e}")
+        raise overloaded_error(e)
     except Exception as e:
         print(f"Error processing query: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+MAX_BATCH_QUERIES = int(os.environ.get("MAX_BATCH_QUERIES", "500"))
+
+@app.post("/api/query/batch", response_model=BatchQueryResponse)
+async def query_protocol_batch(request: BatchQueryRequest):
+    """Answers many questions in one request; results are in input order, failures are per item."""
+    if not rag_pipeline:
+        raise HTTPException(status_code=503, detail="RAG Pipeline not initialized")
+
+    if len(request.queries) > MAX_BATCH_QUERIES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_QUERIES} queries per batch")
+
+    start = time.perf_counter()
+    results = await rag_pipeline.abatch_generate(
+        [{"question": q.question, "protocol": q.protocol} for q in request.queries],
+        concurrency=request.concurrency
+    )
+    # Every item was shed: answer like /api/query would, so clients back off
+    shed = [r["exception"] for r in results if isinstance(r.get("exception"), Overloaded)]
+    if results and len(shed) == len(results):
+        print(f"Batch shed: {shed[0]}")
+        raise overloaded_error(max(shed, key=lambda e: e.retry_after))
+    return BatchQueryResponse(
+        results=[
+            BatchQueryResult(error=r["error"], status=error_status(r["exception"])) if "error" in r else
+            BatchQueryResult(answer=r["answer"], sources=r["sources"],
+                             metadata={"model": "claude-3-haiku-20240307", **r.get("metadata", {})})
+            for r in results
+        ],
+        metadata={
+            "count": len(results),
+            "errors": sum("error" in r for r in results),
+            "total_time_s": round(time.perf_counter() - start, 3),
+        }
+    )
+
 @app.post("/api/compare", response_model=CompareResponse)
 async def compare_protocols(request: CompareRequest):
     if not comparison_engine:
@@ -96,16 +238,151 @@ async def compare_protocols(request: CompareRequest):
         raise HTTPException(status_code=400, detail="Need at least 2 protocols to compare")
     
     try:
-        result = comparison_engine.compare_protocols(request.question, request.protocols)
+        with request_deadline(rag_pipeline.providers.request_deadline):
+            result = await comparison_engine.acompare_protocols(request.question, request.protocols)
         return CompareResponse(
             answer=result["answer"],
             protocols=result["protocols"],
             sources=result["sources"],
-            metadata={"model": "claude-3-haiku-20240307"}
+            metadata={"model": "claude-3-haiku-20240307", **result.get("metadata", {})}
         )
+    except DeadlineExceeded as e:
+        print(f"Comparison timed out: {e}")
+        raise HTTPException(status_code=504, detail=str(e))
+    except Overloaded as e:
+        print(f"Comparison shed: {e}")
+        raise overloaded_error(e)
     except Exception as e:
         print(f"Error processing comparison: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/metrics", response_class=PlainTextResponse)
+async def prometheus_metrics():
+    """Prometheus scrape endpoint: stage/request latency histograms, token, cache and provider counters."""
+    extra = []
+    if rag_pipeline:
+        caches = {"embedding": rag_pipeline.embedding_cache.stats(), "answer": rag_pipeline.answer_cache.stats()}
+        extra.append(metrics.render_samples(
+            "cryptoguide_cache_lookups_total", "Cache lookups by cache and result", "counter",
+            [({"cache": name, "result": result}, stats[key])
+             for name, stats in caches.items() for result, key in (("hit", "hits"), ("miss", "misses"))]
+        ))
+        extra.append(metrics.render_samples(
+            "cryptoguide_cache_entries", "Entries currently held per cache", "gauge",
+            [({"cache": name}, stats["size"]) for name, stats in caches.items()]
+        ))
+        extra.append(metrics.render_samples(
+            "cryptoguide_answer_cache_saved_seconds_total", "Generation time avoided by answer cache hits", "counter",
+            [({}, caches["answer"]["saved_seconds"])]
+        ))
+        extra.append(metrics.render_samples(
+            "cryptoguide_provider_events_total", "Provider calls, retries, timeouts and deadline misses by stage",
+            "counter",
+            [({"stage": stage, "event": event}, count)
+             for stage, counts in rag_pipeline.providers.stats()["stages"].items()
+             for event, count in counts.items()]
+        ))
+        admission = rag_pipeline.scheduler.stats()
+        extra.append(metrics.render_samples(
+            "cryptoguide_llm_slots_in_use", "LLM generations currently running", "gauge",
+            [({}, admission["in_use"])]
+        ))
+        extra.append(metrics.render_samples(
+            "cryptoguide_llm_queue_depth", "Requests waiting for an LLM slot by priority class", "gauge",
+            [({"priority": name}, depth) for name, depth in admission["queue_depth"].items()]
+        ))
+    return PlainTextResponse(metrics.render(extra), media_type="text/plain; version=0.0.4")
+
+# Admin endpoints need this token in X-Admin-Token; unset, they are disabled
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") or None
+
+def require_admin(token: Optional[str]):
+    if ADMIN_TOKEN is None:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (set ADMIN_TOKEN)")
+    if token is None or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Missing or invalid X-Admin-Token")
+
+@app.post("/api/cache/invalidate")
+async def invalidate_cache(request: InvalidateRequest, x_admin_token: Optional[str] = Header(None)):
+    """Drops cached answers after a re-ingest (all protocols if none is given). Needs ADMIN_TOKEN."""
+    require_admin(x_admin_token)
+    if not rag_pipeline:
+        raise HTTPException(status_code=503, detail="RAG Pipeline not initialized")
+
+    removed = await rag_pipeline.answer_cache.ainvalidate(request.protocol)
+    return {"invalidated": removed, "protocol": request.protocol}
+
+@app.delete("/api/sessions/{session_id}")
+async def end_session(session_id: str):
+    """Forgets a conversation's turns and context (they also expire after SESSION_TTL)."""
+    if not rag_pipeline:
+        raise HTTPException(status_code=503, detail="RAG Pipeline not initialized")
+
+    try:
+        rag_pipeline.sessions.drop(session_id)
+    except SessionNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    return {"ended": True, "session_id": session_id}
+
+# --- Streaming (Server-Sent Events) ---
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_events(events):
+    """Serializes (event, data) pairs as SSE; errors become a final `error` event."""
+    try:
+        with request_deadline(rag_pipeline.providers.request_deadline):
+            async for event, data in events:
+                if event == "done":
+                    data = {**data, "model": "claude-3-haiku-20240307"}
+                yield sse_event(event, data)
+    except DeadlineExceeded as e:
+        print(f"Stream timed out: {e}")
+        yield sse_event("error", {"detail": str(e), "status": 504})
+    except Overloaded as e:
+        print(f"Stream shed: {e}")
+        yield sse_event("error", {"detail": str(e), "status": e.status_code, "retry_after": e.retry_after})
+    except SessionNotFound as e:
+        yield sse_event("error", {"detail": str(e), "status": 404})
+    except Exception as e:
+        print(f"Error while streaming: {e}")
+        yield sse_event("error", {"detail": str(e)})
+
+SSE_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+@app.post("/api/query/stream")
+async def query_protocol_stream(request: QueryRequest):
+    if not rag_pipeline:
+        raise HTTPException(status_code=503, detail="RAG Pipeline not initialized")
+
+    if request.session_id:
+        # Unknown ids are turned away before the stream starts, so clients get a plain 404
+        try:
+            rag_pipeline.sessions.get(request.session_id)
+        except SessionNotFound as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        events = rag_pipeline.astream_session_answer(request.session_id, request.question, request.protocol)
+    else:
+        events = rag_pipeline.astream_answer(request.question, request.protocol, start_session=request.start_session)
+    return StreamingResponse(
+        stream_events(events),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
+@app.post("/api/compare/stream")
+async def compare_protocols_stream(request: CompareRequest):
+    if not comparison_engine:
+        raise HTTPException(status_code=503, detail="Comparison Engine not initialized")
+
+    if len(request.protocols) < 2:
+        raise HTTPException(status_code=400, detail="Need at least 2 protocols to compare")
+
+    return StreamingResponse(
+        stream_events(comparison_engine.astream_comparison(request.question, request.protocols)),
+        media_type="text/event-stream",
+        headers=SSE_HEADERS
+    )
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True)
@@ -0,0 +1,231 @@
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple, Any, Iterator
+
+# Minimal Prometheus instrumentation (text exposition format 0.0.4), so /metrics
+# needs no extra dependency. Metrics are process-wide; each request can also
+# collect its own per-stage breakdown through a RequestTracker (see track()).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _label_key(labels: Dict[str, Any]) -> LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(key: LabelKey, extra: Tuple[Tuple[str, str], ...] = ()) -> str:
+    pairs = key + extra
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != float("inf") else "+Inf"
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values: Dict[LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_format_labels(key)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series: Dict[LabelKey, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            series = self._series.setdefault(key, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series["counts"]):
+                    le = (("le", _format_value(bound)),)
+                    lines.append(f"{self.name}_bucket{_format_labels(key, le)} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} {_format_value(series['sum'])}")
+                lines.append(f"{self.name}_count{_format_labels(key)} {series['count']}")
+        return lines
+
+
+def render_samples(name: str, documentation: str, kind: str, samples: List[Tuple[Dict[str, Any], float]]) -> List[str]:
+    """Renders a metric family from values read at scrape time (e.g. cache stats)."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for labels, value in samples:
+        lines.append(f"{name}{_format_labels(_label_key(labels))} {_format_value(value)}")
+    return lines
+
+
+# --- Process-wide metrics ---
+
+STAGE_SECONDS = Histogram("cryptoguide_stage_duration_seconds",
+                          "Duration of one pipeline stage call (embed, retrieve, lexical, queue, llm)")
+REQUEST_SECONDS = Histogram("cryptoguide_request_duration_seconds", "End-to-end pipeline duration per operation")
+REQUESTS = Counter("cryptoguide_requests_total", "Pipeline operations by outcome")
+LLM_TOKENS = Counter("cryptoguide_llm_tokens_total", "LLM tokens by direction (input/output)")
+PROMPT_CACHE_TOKENS = Counter("cryptoguide_llm_prompt_cache_tokens_total",
+                              "Input tokens read from or written to the provider's prompt cache (read/write)")
+CONTEXT_TOKENS = Counter("cryptoguide_context_tokens_total", "Prompt context tokens after packing")
+CONTEXT_CHUNKS = Counter("cryptoguide_context_chunks_total",
+                         "Retrieved chunks by what packing did with them (kept, merged, dropped)")
+RETRIEVALS = Counter("cryptoguide_retrievals_total",
+                     "Retrieval path taken (vector, hybrid, lexical_only, cache, provided, session)")
+COALESCED = Counter("cryptoguide_coalesced_requests_total",
+                    "Requests answered by an identical request already in flight (see coalesce.py)")
+ADMISSIONS = Counter("cryptoguide_llm_admissions_total",
+                     "LLM scheduler decisions by priority class (queued, admitted, rejected, displaced, timed_out)")
+
+REGISTRY = [STAGE_SECONDS, REQUEST_SECONDS, REQUESTS, LLM_TOKENS, PROMPT_CACHE_TOKENS, CONTEXT_TOKENS,
+            CONTEXT_CHUNKS, RETRIEVALS, COALESCED, ADMISSIONS]
+
+
+def render(extra: Optional[List[List[str]]] = None) -> str:
+    lines: List[str] = []
+    for metric in REGISTRY:
+        lines += metric.render()
+    for family in extra or []:
+        lines += family
+    return "\n".join(lines) + "\n"
+
+
+# --- Per-request breakdown ---
+
+class RequestTracker:
+    """Collects one request's stage timings and token counts for its response metadata.
+
+    A stage's time is wall clock from its first start to its last end, so
+    concurrent calls (e.g. per-protocol retrievals in a comparison) are not
+    double counted.
+    """
+
+    def __init__(self, operation: str):
+        self.operation = operation
+        self.start = time.perf_counter()
+        self.spans: Dict[str, List[float]] = {}
+        self.tokens = {"input": 0, "output": 0}
+        self.context: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def add_span(self, stage: str, start: float, end: float):
+        with self._lock:
+            span = self.spans.setdefault(stage, [start, end])
+            span[0] = min(span[0], start)
+            span[1] = max(span[1], end)
+
+    def add_tokens(self, input_tokens: int, output_tokens: int):
+        with self._lock:
+            self.tokens["input"] += input_tokens
+            self.tokens["output"] += output_tokens
+
+    def add_context(self, stats: Dict[str, int]):
+        with self._lock:
+            for key, value in stats.items():
+                self.context[key] = self.context.get(key, 0) + value
+
+    def summary(self) -> Dict[str, Any]:
+        timings = {f"{stage}_s": round(end - start, 4) for stage, (start, end) in self.spans.items()}
+        timings["total_s"] = round(time.perf_counter() - self.start, 4)
+        summary = {"timings": timings, "tokens": dict(self.tokens)}
+        if self.context:
+            summary["context"] = dict(self.context)
+        return summary
+
+
+_tracker: ContextVar[Optional[RequestTracker]] = ContextVar("request_tracker", default=None)
+
+
+def current_tracker() -> Optional[RequestTracker]:
+    return _tracker.get()
+
+
+@contextmanager
+def track(operation: str) -> Iterator[RequestTracker]:
+    """Tracks one pipeline operation: per-stage spans, tokens, and the request duration/outcome metrics."""
+    tracker = RequestTracker(operation)
+    token = _tracker.set(tracker)
+    outcome = "ok"
+    try:
+        yield tracker
+    except TimeoutError:
+        outcome = "timeout"
+        raise
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _tracker.reset(token)
+        REQUEST_SECONDS.observe(time.perf_counter() - tracker.start, operation=operation)
+        REQUESTS.inc(operation=operation, outcome=outcome)
+
+
+@contextmanager
+def stage(name: str):
+    """Times a block as pipeline stage `name` (process histogram + current request's breakdown)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        end = time.perf_counter()
+        STAGE_SECONDS.observe(end - start, stage=name)
+        tracker = _tracker.get()
+        if tracker is not None:
+            tracker.add_span(name, start, end)
+
+
+def record_tokens(input_tokens: int, output_tokens: int):
+    LLM_TOKENS.inc(input_tokens, direction="input")
+    LLM_TOKENS.inc(output_tokens, direction="output")
+    tracker = _tracker.get()
+    if tracker is not None:
+        tracker.add_tokens(input_tokens, output_tokens)
+
+
+def record_prompt_cache(read_tokens: int, write_tokens: int):
+    PROMPT_CACHE_TOKENS.inc(read_tokens, kind="read")
+    PROMPT_CACHE_TOKENS.inc(write_tokens, kind="write")
+
+
+def record_context(stats: Dict[str, int]):
+    """Counts one packed context (see context.ContextPacker.pack) into the metrics and the request."""
+    CONTEXT_TOKENS.inc(stats["tokens"])
+    kept = stats["candidates"] - stats["merged_chunks"]
+    CONTEXT_CHUNKS.inc(stats["blocks"], outcome="kept")
+    CONTEXT_CHUNKS.inc(stats["merged_chunks"], outcome="merged")
+    CONTEXT_CHUNKS.inc(kept - stats["blocks"], outcome="dropped")
+    tracker = _tracker.get()
+    if tracker is not None:
+        tracker.add_context(stats)
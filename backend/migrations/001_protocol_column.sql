@@ -0,0 +1,134 @@
+-- Moves an existing documents table (created by the original supabase_schema.sql,
+-- protocol only in metadata, one global ivfflat index) to the protocol column and
+-- per-protocol vector indexes, keeping every row and its embedding.
+--
+-- Run it once in the Supabase SQL editor (or psql). Safe to re-run; re-running
+-- also applies later changes to the functions it defines.
+-- The backfill rewrites each row once; on large tables run it off-peak.
+
+BEGIN;
+
+ALTER TABLE documents ADD COLUMN IF NOT EXISTS protocol TEXT;
+
+UPDATE documents
+SET protocol = COALESCE(metadata->>'protocol', '')
+WHERE protocol IS NULL;
+
+ALTER TABLE documents ALTER COLUMN protocol SET NOT NULL;
+
+CREATE OR REPLACE FUNCTION documents_set_protocol()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF NEW.protocol IS NULL THEN
+    NEW.protocol := COALESCE(NEW.metadata->>'protocol', '');
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS documents_set_protocol ON documents;
+CREATE TRIGGER documents_set_protocol
+BEFORE INSERT OR UPDATE ON documents
+FOR EACH ROW EXECUTE FUNCTION documents_set_protocol();
+
+-- Old indexes (default names from the original schema): the global ivfflat
+-- index and the metadata expression index used by incremental ingestion
+DROP INDEX IF EXISTS documents_embedding_idx;
+DROP INDEX IF EXISTS documents_expr_expr1_idx;
+CREATE INDEX IF NOT EXISTS documents_protocol_source_idx ON documents (protocol, (metadata->>'source'));
+
+CREATE OR REPLACE FUNCTION ensure_protocol_index(p TEXT)
+RETURNS TEXT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  method TEXT := CASE WHEN EXISTS (SELECT 1 FROM pg_am WHERE amname = 'hnsw') THEN 'hnsw' ELSE 'ivfflat' END;
+  index_name TEXT := format('documents_%s_%s_%s',
+                            left(regexp_replace(lower(p), '[^a-z0-9]+', '_', 'g'), 32), left(md5(p), 8), method);
+  n_rows BIGINT;
+BEGIN
+  -- Only protocols that have rows, under a plain name: callers cannot build
+  -- indexes for arbitrary values
+  IF p IS NULL OR p !~ '^[a-z0-9][a-z0-9_.-]{0,63}$' THEN
+    RAISE EXCEPTION 'invalid protocol name: %', p;
+  END IF;
+  IF NOT EXISTS (SELECT 1 FROM documents WHERE protocol = p) THEN
+    RAISE EXCEPTION 'no documents for protocol %', p;
+  END IF;
+  IF method = 'hnsw' THEN
+    EXECUTE format(
+      'CREATE INDEX IF NOT EXISTS %I ON documents USING hnsw (embedding vector_cosine_ops) WHERE protocol = %L',
+      index_name, p);
+  ELSE
+    SELECT count(*) INTO n_rows FROM documents WHERE protocol = p;
+    EXECUTE format(
+      'CREATE INDEX IF NOT EXISTS %I ON documents USING ivfflat (embedding vector_cosine_ops) '
+      'WITH (lists = %s) WHERE protocol = %L',
+      index_name, GREATEST(1, n_rows / 1000), p);
+  END IF;
+  RETURN index_name;
+END;
+$$;
+
+-- It runs DDL as its owner, so only the service role may call it (Supabase
+-- otherwise exposes every public function to anon and authenticated over /rpc)
+REVOKE EXECUTE ON FUNCTION ensure_protocol_index(TEXT) FROM PUBLIC;
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'service_role') THEN
+    REVOKE EXECUTE ON FUNCTION ensure_protocol_index(TEXT) FROM anon, authenticated;
+    GRANT EXECUTE ON FUNCTION ensure_protocol_index(TEXT) TO service_role;
+  END IF;
+END
+$$;
+
+CREATE OR REPLACE FUNCTION match_documents(
+  query_embedding VECTOR(1536),
+  match_count INT DEFAULT 3,
+  filter JSONB DEFAULT '{}'
+)
+RETURNS TABLE (
+  id UUID,
+  content TEXT,
+  metadata JSONB,
+  similarity FLOAT
+)
+LANGUAGE plpgsql
+STABLE
+AS $$
+BEGIN
+  IF filter ? 'protocol' THEN
+    RETURN QUERY EXECUTE format(
+      'SELECT d.id, d.content, d.metadata, 1 - (d.embedding <=> $1) AS similarity
+       FROM documents d
+       WHERE d.protocol = %L
+       ORDER BY d.embedding <=> $1
+       LIMIT $2',
+      filter->>'protocol')
+    USING query_embedding, match_count;
+  ELSE
+    RETURN QUERY
+    SELECT
+      d.id,
+      d.content,
+      d.metadata,
+      1 - (d.embedding <=> query_embedding) AS similarity
+    FROM documents d
+    ORDER BY d.embedding <=> query_embedding
+    LIMIT match_count;
+  END IF;
+END;
+$$;
+
+COMMIT;
+
+-- One vector index per protocol already in the table (each build is its own statement)
+SELECT protocol, ensure_protocol_index(protocol)
+FROM (SELECT DISTINCT protocol FROM documents) AS protocols
+WHERE protocol ~ '^[a-z0-9][a-z0-9_.-]{0,63}$';
+
+ANALYZE documents;
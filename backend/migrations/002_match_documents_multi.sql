@@ -0,0 +1,34 @@
+-- Adds match_documents_multi (one RPC for a comparison's retrievals) to a
+-- database already on the protocol column (supabase_schema.sql or
+-- migrations/001_protocol_column.sql). Safe to re-run.
+
+CREATE OR REPLACE FUNCTION match_documents_multi(
+  query_embedding VECTOR(1536),
+  protocols TEXT[],
+  match_count INT DEFAULT 3
+)
+RETURNS TABLE (
+  protocol TEXT,
+  id UUID,
+  content TEXT,
+  metadata JSONB,
+  similarity FLOAT
+)
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+  p TEXT;
+BEGIN
+  FOREACH p IN ARRAY protocols LOOP
+    RETURN QUERY EXECUTE format(
+      'SELECT d.protocol, d.id, d.content, d.metadata, 1 - (d.embedding <=> $1) AS similarity
+       FROM documents d
+       WHERE d.protocol = %L
+       ORDER BY d.embedding <=> $1
+       LIMIT $2',
+      p)
+    USING query_embedding, match_count;
+  END LOOP;
+END;
+$$;
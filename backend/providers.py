@@ -0,0 +1,246 @@
+import os
+import time
+import random
+import asyncio
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Optional
+
+import httpx
+
+import metrics
+
+# Provider layer shared by RAGPipeline and ComparisonEngine.
+#
+# - One pooled httpx client (sync + async) with keep-alive is shared by the
+#   OpenAI embeddings client and Supabase, so TLS handshakes happen once per
+#   connection rather than once per request. ChatAnthropic keeps its own pooled
+#   client; it gets the same timeout and retry settings.
+# - SDK-level retries are turned off. Every async provider call goes through
+#   Providers.call, which applies a per-stage timeout, retries transient
+#   failures with jittered backoff, and never waits past the request deadline
+#   (REQUEST_DEADLINE applies to calls made outside a request too). A
+#   generation that ran out LLM_TIMEOUT is slow rather than flaky, so only
+#   the embed and retrieve stages retry timeouts.
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+_deadline: ContextVar[Optional[float]] = ContextVar("request_deadline", default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """A provider stage timed out, or the request deadline ran out (mapped to HTTP 504)."""
+
+    def __init__(self, stage: str, reason: str):
+        self.stage = stage
+        super().__init__(f"{reason} during '{stage}'")
+
+
+@contextmanager
+def request_deadline(seconds: Optional[float]):
+    """Bounds every Providers.call made inside the block to `seconds` in total."""
+    token = _deadline.set(time.monotonic() + seconds if seconds else None)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining_time() -> Optional[float]:
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def is_retryable(error: Exception) -> bool:
+    if isinstance(error, (httpx.TransportError, asyncio.TimeoutError)):
+        return True
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS:
+        return True
+    # openai / anthropic wrap transport failures in APIConnectionError (and APITimeoutError)
+    return any(cls.__name__ == "APIConnectionError" for cls in type(error).__mro__)
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+class Providers:
+    """Configured provider clients plus deadline-aware call wrappers."""
+
+    def __init__(self):
+        self.stage_timeouts = {
+            "embed": _env_float("EMBED_TIMEOUT", 10),
+            "retrieve": _env_float("RETRIEVAL_TIMEOUT", 10),
+            "llm": _env_float("LLM_TIMEOUT", 60),
+        }
+        self.request_deadline = _env_float("REQUEST_DEADLINE", 90)
+        self.max_retries = int(os.environ.get("PROVIDER_MAX_RETRIES", "2"))
+        self.retry_timeout_stages = {"embed", "retrieve"}
+        self.retry_base_delay = _env_float("RETRY_BASE_DELAY", 0.25)
+        self.retry_max_delay = _env_float("RETRY_MAX_DELAY", 2.0)
+        self.limits = httpx.Limits(
+            max_connections=int(os.environ.get("HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.environ.get("HTTP_MAX_KEEPALIVE", "20")),
+            keepalive_expiry=_env_float("HTTP_KEEPALIVE_EXPIRY", 30),
+        )
+        self.connect_timeout = _env_float("HTTP_CONNECT_TIMEOUT", 5)
+        self._http_client: Optional[httpx.Client] = None
+        self._async_http_client: Optional[httpx.AsyncClient] = None
+        self._lock = threading.Lock()
+        self.counters: Dict[str, Dict[str, int]] = {
+            stage: {"calls": 0, "retries": 0, "timeouts": 0, "deadline_exceeded": 0}
+            for stage in self.stage_timeouts
+        }
+
+    # --- Pooled transports ---
+
+    def _timeout(self, stage: str) -> httpx.Timeout:
+        return httpx.Timeout(self.stage_timeouts[stage], connect=self.connect_timeout)
+
+    @property
+    def http_client(self) -> httpx.Client:
+        with self._lock:
+            if self._http_client is None:
+                self._http_client = httpx.Client(limits=self.limits, timeout=self._timeout("retrieve"))
+            return self._http_client
+
+    @property
+    def async_http_client(self) -> httpx.AsyncClient:
+        with self._lock:
+            if self._async_http_client is None:
+                self._async_http_client = httpx.AsyncClient(limits=self.limits, timeout=self._timeout("retrieve"))
+            return self._async_http_client
+
+    async def aclose(self):
+        if self._async_http_client is not None:
+            await self._async_http_client.aclose()
+        if self._http_client is not None:
+            self._http_client.close()
+
+    # --- Provider clients ---
+
+    def supabase_options(self, asynchronous: bool = False):
+        from supabase.lib.client_options import SyncClientOptions, AsyncClientOptions
+
+        if asynchronous:
+            return AsyncClientOptions(httpx_client=self.async_http_client,
+                                      postgrest_client_timeout=self._timeout("retrieve"))
+        return SyncClientOptions(httpx_client=self.http_client, postgrest_client_timeout=self._timeout("retrieve"))
+
+    def openai_embeddings(self, model: str = "text-embedding-ada-002"):
+        from langchain_openai import OpenAIEmbeddings
+
+        return OpenAIEmbeddings(
+            model=model,
+            http_client=self.http_client,
+            http_async_client=self.async_http_client,
+            request_timeout=self._timeout("embed"),
+            max_retries=0,
+        )
+
+    def anthropic_llm(self, model: str = "claude-3-haiku-20240307", **kwargs):
+        from langchain_anthropic import ChatAnthropic
+
+        return ChatAnthropic(
+            model=model,
+            default_request_timeout=self.stage_timeouts["llm"],
+            max_retries=0,
+            **kwargs
+        )
+
+    # --- Deadline-aware calls ---
+
+    def _count(self, stage: str, counter: str):
+        with self._lock:
+            self.counters.setdefault(stage, {"calls": 0, "retries": 0, "timeouts": 0, "deadline_exceeded": 0})
+            self.counters[stage][counter] += 1
+
+    def _budget(self, stage: str, stage_start: Optional[float] = None) -> tuple:
+        """Returns (seconds allowed, whether the request deadline is the binding limit)."""
+        budget = self.stage_timeouts.get(stage, self.request_deadline)
+        if stage_start is not None:
+            budget -= time.monotonic() - stage_start
+        left = remaining_time()
+        if left is not None and left <= budget:
+            return left, True
+        return budget, False
+
+    def _retry_delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.retry_max_delay, self.retry_base_delay * 2 ** attempt))
+
+    async def call(self, stage: str, make_call: Callable[[], Awaitable[Any]]) -> Any:
+        """Runs `make_call()` with the stage timeout, bounded jittered retries and the request deadline.
+        The whole call, retries included, is timed as one `stage` in metrics."""
+        self._count(stage, "calls")
+        with metrics.stage(stage):
+            if remaining_time() is None:
+                with request_deadline(self.request_deadline):
+                    return await self._call_with_retries(stage, make_call)
+            return await self._call_with_retries(stage, make_call)
+
+    async def _call_with_retries(self, stage: str, make_call: Callable[[], Awaitable[Any]]) -> Any:
+        for attempt in range(self.max_retries + 1):
+            budget, deadline_bound = self._budget(stage)
+            if budget <= 0:
+                self._count(stage, "deadline_exceeded")
+                raise DeadlineExceeded(stage, "Request deadline exceeded")
+            try:
+                return await asyncio.wait_for(make_call(), budget)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                if isinstance(e, asyncio.TimeoutError):
+                    if deadline_bound:
+                        self._count(stage, "deadline_exceeded")
+                        raise DeadlineExceeded(stage, "Request deadline exceeded") from e
+                    self._count(stage, "timeouts")
+                    if attempt == self.max_retries or stage not in self.retry_timeout_stages:
+                        raise DeadlineExceeded(stage, f"Provider timed out after {budget:.1f}s") from e
+                elif attempt == self.max_retries or not is_retryable(e):
+                    raise
+
+            delay = self._retry_delay(attempt)
+            left = remaining_time()
+            if left is not None and delay >= left:
+                self._count(stage, "deadline_exceeded")
+                raise DeadlineExceeded(stage, "Request deadline exceeded")
+            self._count(stage, "retries")
+            await asyncio.sleep(delay)
+
+    async def stream(self, stage: str, iterator: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        """Yields from `iterator`, failing once the stage timeout or request deadline is used up.
+        Streams are not retried: tokens may already have been sent to the client."""
+        self._count(stage, "calls")
+        with metrics.stage(stage):
+            async for item in self._stream_with_deadline(stage, iterator):
+                yield item
+
+    async def _stream_with_deadline(self, stage: str, iterator: AsyncIterator[Any]) -> AsyncIterator[Any]:
+        start = time.monotonic()
+        iterator = iterator.__aiter__()
+        while True:
+            budget, deadline_bound = self._budget(stage, start)
+            try:
+                if budget <= 0:
+                    raise asyncio.TimeoutError()
+                item = await asyncio.wait_for(iterator.__anext__(), budget)
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError as e:
+                if hasattr(iterator, "aclose"):
+                    await iterator.aclose()
+                self._count(stage, "deadline_exceeded" if deadline_bound else "timeouts")
+                reason = "Request deadline exceeded" if deadline_bound else \
+                    f"Provider timed out after {self.stage_timeouts[stage]:.1f}s"
+                raise DeadlineExceeded(stage, reason) from e
+            yield item
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stage_timeouts_s": self.stage_timeouts,
+            "request_deadline_s": self.request_deadline,
+            "max_retries": self.max_retries,
+            "retry_timeout_stages": sorted(self.retry_timeout_stages),
+            "stages": {stage: dict(counts) for stage, counts in self.counters.items()},
+        }
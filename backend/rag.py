@@ -1,101 +1,713 @@
 import os
-from typing import List, Dict, Any
-from supabase.client import create_client, Client
-from langchain_openai import OpenAIEmbeddings
-from langchain_anthropic import ChatAnthropic
+import time
+import asyncio
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple, TYPE_CHECKING
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.callbacks import UsageMetadataCallbackHandler
+import metrics
+from tokens import count_tokens
+from cache import CachedEmbeddings, embedding_cache_from_env, answer_cache_from_env, normalize_text
+from retrievers import SupabaseRetriever, local_retriever_from_env
+from lexical import BM25Index, lexical_index_from_env, reciprocal_rank_fusion
+from providers import Providers, request_deadline
+from context import context_packer_from_env
+from coalesce import SingleFlight, caller_result
+from admission import llm_scheduler_from_env
+from sessions import Session, session_store_from_env
+
+# Provider SDKs (supabase, langchain_openai, langchain_anthropic) take seconds to
+# import, so they are only imported when the pipeline has to build that client itself.
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+    from supabase.client import Client
+
+NO_CONTEXT_ANSWER = "I couldn't find any specific information about that in the protocol documentation."
+
+SYSTEM_PROMPT = """You are CryptoGuide AI, an expert DeFi research assistant.
+        Answer the user's question based ONLY on the provided context.
+
+        Rules:
+        - Cite your sources using square brackets like [1], [2].
+        - If the answer is not in the context, say you don't know.
+        - Be concise, professional, and precise.
+        - Use markdown for formatting.
+
+        Context:
+        {context}
+        """
+
+WARMUP_QUERY = "ping"
+
+def record_llm_usage(usage: UsageMetadataCallbackHandler, prompt: str, answer: str) -> Dict[str, int]:
+    """Counts LLM tokens from the provider's usage metadata; estimated with the
+    tokenizer when the model reports none (e.g. stub models). Returns the input
+    tokens read from and written to the provider's prompt cache."""
+    reported = list(usage.usage_metadata.values())
+    if not reported:
+        metrics.record_tokens(count_tokens(prompt), count_tokens(answer))
+        return {"cache_read": 0, "cache_write": 0}
+    metrics.record_tokens(sum(u.get("input_tokens", 0) for u in reported),
+                          sum(u.get("output_tokens", 0) for u in reported))
+    details = [u.get("input_token_details") or {} for u in reported]
+    cache = {"cache_read": sum(d.get("cache_read", 0) for d in details),
+             "cache_write": sum(d.get("cache_creation", 0) for d in details)}
+    metrics.record_prompt_cache(cache["cache_read"], cache["cache_write"])
+    return cache
 
 class RAGPipeline:
-    def __init__(self):
+    def __init__(self, supabase: Optional["Client"] = None, embeddings=None, llm=None,
+                 async_supabase: Optional["AsyncClient"] = None, retriever=None,
+                 providers: Optional[Providers] = None):
         self.supabase_url = os.environ.get("SUPABASE_URL")
         self.supabase_key = os.environ.get("SUPABASE_KEY")
         self.openai_key = os.environ.get("OPENAI_API_KEY")
         self.anthropic_key = os.environ.get("ANTHROPIC_API_KEY")
-        
-        if not all([self.supabase_url, self.supabase_key, self.openai_key, self.anthropic_key]):
+        # "supabase" (match_documents RPC) or "local" (in-process VectorIndex)
+        self.retriever_backend = os.environ.get("RETRIEVER_BACKEND", "supabase").lower()
+
+        # Providers can be injected (e.g. stubs in scripts/test_concurrency.py);
+        # credentials are only required for the ones we have to build ourselves.
+        needs_supabase = retriever is None and supabase is None and self.retriever_backend == "supabase"
+        required = []
+        if needs_supabase:
+            required += [self.supabase_url, self.supabase_key]
+        if embeddings is None:
+            required.append(self.openai_key)
+        if llm is None:
+            required.append(self.anthropic_key)
+        if not all(required):
             raise ValueError("Missing environment variables for RAG pipeline")
-            
-        self.supabase: Client = create_client(self.supabase_url, self.supabase_key)
-        self.embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
-        self.llm = ChatAnthropic(
-            model="claude-3-haiku-20240307",
-            temperature=0,
-            max_tokens=1000
+
+        # Pooled HTTP clients, per-stage timeouts, retries and the request deadline
+        self.providers = providers or Providers()
+
+        if retriever is None:
+            if supabase is not None or self.retriever_backend == "supabase":
+                if supabase is None:
+                    from supabase.client import create_client
+                    supabase = create_client(self.supabase_url, self.supabase_key,
+                                             options=self.providers.supabase_options())
+                retriever = SupabaseRetriever(supabase, self.supabase_url, self.supabase_key, async_supabase,
+                                              async_options=self.providers.supabase_options(asynchronous=True))
+            elif self.retriever_backend == "local":
+                retriever = local_retriever_from_env()
+            else:
+                raise ValueError(f"Unknown RETRIEVER_BACKEND '{self.retriever_backend}'")
+        self.retriever = retriever
+        self.supabase: Optional["Client"] = getattr(retriever, "client", None)
+
+        # Query embeddings are cached (LRU + TTL, optionally persisted to disk)
+        self.embedding_cache = embedding_cache_from_env()
+        if embeddings is None:
+            embeddings = self.providers.openai_embeddings("text-embedding-ada-002")
+        self.embeddings = CachedEmbeddings(embeddings, self.embedding_cache)
+        # Answers are reused across paraphrased questions (see cache.SemanticAnswerCache)
+        self.answer_cache = answer_cache_from_env()
+        # Optional BM25 index: RETRIEVAL_MODE=hybrid fuses lexical and vector ranks and
+        # skips the embedding call when the lexical match is decisive.
+        self.retrieval_mode = os.environ.get("RETRIEVAL_MODE", "vector").lower()
+        self.lexical_index: Optional[BM25Index] = None
+        if self.retrieval_mode == "hybrid":
+            local_index = getattr(self.retriever, "index", None)
+            self.lexical_index = lexical_index_from_env(getattr(local_index, "records", None))
+            if self.lexical_index is None:
+                raise ValueError("RETRIEVAL_MODE=hybrid requires BM25_INDEX_PATH or a local vector index")
+        self.lexical_decisive_ratio = float(os.environ.get("LEXICAL_DECISIVE_RATIO", "1.5"))
+        # Merges overlapping same-page chunks, applies MMR and fits CONTEXT_TOKEN_BUDGET
+        self.context_packer = context_packer_from_env()
+        self.retrieval_stats = {"vector": 0, "hybrid": 0, "lexical_only": 0}
+        # Generations in flight per abatch_generate call
+        self.batch_concurrency = int(os.environ.get("BATCH_CONCURRENCY", "8"))
+        # Bounds concurrent generations; queries queue ahead of comparisons and batch items
+        self.scheduler = llm_scheduler_from_env()
+        # Identical (normalized question, protocol) requests in flight share one computation
+        self.inflight = SingleFlight("query")
+        # Conversations: recent turns and their context blocks, reused by follow-ups
+        self.sessions = session_store_from_env()
+
+        if llm is None:
+            llm = self.providers.anthropic_llm(
+                "claude-3-haiku-20240307",
+                temperature=0,
+                max_tokens=1000
+            )
+        self.llm = llm
+
+        # Built once and shared by every request
+        self.answer_prompt = ChatPromptTemplate.from_messages([
+            ("system", SYSTEM_PROMPT),
+            ("user", "{question}")
+        ])
+        self.answer_chain = self.answer_prompt | self.llm | StrOutputParser()
+        # Session turns pass their own message list (sessions.Session.messages)
+        self.session_chain = self.llm | StrOutputParser()
+        self.warmup: Dict[str, Any] = {}
+
+    def retrieve_by_vector(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        """Searches the configured retriever backend with an already-embedded query."""
+        with metrics.stage("retrieve"):
+            return self.retriever.search(query_vector, protocol, k)
+
+    async def aretrieve_by_vector(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        """Async version of retrieve_by_vector."""
+        return await self.providers.call("retrieve", lambda: self.retriever.asearch(query_vector, protocol, k))
+
+    def retrieve_multi_by_vector(self, query_vector: List[float], protocols: List[str],
+                                 k: int = 5) -> Dict[str, List[Dict]]:
+        """Top-k for every protocol with one already-embedded query, in a single backend call."""
+        with metrics.stage("retrieve"):
+            return self.retriever.search_multi(query_vector, protocols, k)
+
+    async def aretrieve_multi_by_vector(self, query_vector: List[float], protocols: List[str],
+                                        k: int = 5) -> Dict[str, List[Dict]]:
+        """Async version of retrieve_multi_by_vector."""
+        return await self.providers.call("retrieve", lambda: self.retriever.asearch_multi(query_vector, protocols, k))
+
+    def _lexical(self, query: str, protocol: str, k: int) -> Tuple[Optional[List[Dict]], bool]:
+        """BM25 candidates for hybrid mode, and whether they are decisive enough to skip embedding."""
+        if self.lexical_index is None:
+            return None, False
+        with metrics.stage("lexical"):
+            hits = self.lexical_index.search(query, protocol, self.context_packer.fetch_k(k) * 2)
+        decisive = BM25Index.is_decisive(hits, min_ratio=self.lexical_decisive_ratio)
+        if decisive:
+            self.retrieval_stats["lexical_only"] += 1
+        return hits, decisive
+
+    def _fuse(self, vector_docs: List[Dict], lexical: Optional[List[Dict]], k: int) -> List[Dict]:
+        if lexical is None:
+            self.retrieval_stats["vector"] += 1
+            return vector_docs[:k]
+        self.retrieval_stats["hybrid"] += 1
+        return reciprocal_rank_fusion([vector_docs, lexical], k)
+
+    def _candidate_k(self, k: int) -> int:
+        # Packing picks k blocks from fetch_k candidates; fusion needs a deeper vector list still
+        fetch_k = self.context_packer.fetch_k(k)
+        return fetch_k * 2 if self.lexical_index is not None else fetch_k
+
+    def pack_context(self, docs: List[Dict], k: int, token_budget: Optional[int] = None) -> List[Dict]:
+        """Packs retrieved candidates into at most k prompt blocks (see context.ContextPacker)."""
+        packed, stats = self.context_packer.pack(docs, k, token_budget)
+        metrics.record_context(stats)
+        return packed
+
+    def _select(self, vector_docs: List[Dict], lexical: Optional[List[Dict]], k: int) -> List[Dict]:
+        return self.pack_context(self._fuse(vector_docs, lexical, self.context_packer.fetch_k(k)), k)
+
+    def _lexical_only(self, lexical: List[Dict], k: int) -> List[Dict]:
+        return self.pack_context(lexical[:self.context_packer.fetch_k(k)], k)
+
+    def retrieval_summary(self) -> Dict[str, Any]:
+        total = sum(self.retrieval_stats.values())
+        return {
+            "mode": self.retrieval_mode,
+            **self.retrieval_stats,
+            "embedding_skipped_rate": round(self.retrieval_stats["lexical_only"] / total, 4) if total else 0.0,
+        }
+
+    async def awarm_up(self) -> Dict[str, Any]:
+        """Opens provider connections ahead of the first request (main.py runs this when WARMUP=1).
+
+        Embeds a short probe (bypassing the cache so the HTTP connection is really
+        opened), runs one k=1 retrieval with it, and asks the LLM for a single
+        token. Failures are logged rather than raised: a cold provider only costs
+        latency on the first real request.
+        """
+        async def step(name: str, call):
+            start = time.perf_counter()
+            try:
+                result = await call()
+                self.warmup[name] = round(time.perf_counter() - start, 3)
+                return result
+            except Exception as e:
+                print(f"Warm-up step '{name}' failed: {e}")
+                self.warmup[name] = f"failed: {e}"
+
+        async def embed_then_retrieve():
+            vector = await step("embeddings", lambda: self.embeddings.embeddings.aembed_query(WARMUP_QUERY))
+            if vector is not None:
+                await step("retriever", lambda: self.aretrieve_by_vector(vector, "warmup", 1))
+
+        # Keep the probe generation to one token where the model supports it (ChatAnthropic does)
+        llm = self.llm.bind(max_tokens=1) if hasattr(self.llm, "max_tokens") else self.llm
+        await asyncio.gather(
+            embed_then_retrieve(),
+            step("llm", lambda: llm.ainvoke(WARMUP_QUERY)),
         )
+        return self.warmup
 
     def retrieve_context(self, query: str, protocol: str, k: int = 5) -> List[Dict]:
-        """Retrieves relevant documents from Supabase."""
+        """Retrieves relevant documents for a query from the configured backend."""
+        lexical, decisive = self._lexical(query, protocol, k)
+        if decisive:
+            return self._lexical_only(lexical, k)
         query_vector = self.embeddings.embed_query(query)
-        
-        response = self.supabase.rpc(
-            'match_documents',
-            {
-                'query_embedding': query_vector,
-                'match_count': k,
-                'filter': {'protocol': protocol}
-            }
-        ).execute()
-        
-        return response.data
+        return self._select(self.retrieve_by_vector(query_vector, protocol, self._candidate_k(k)), lexical, k)
+
+    async def aretrieve_context(self, query: str, protocol: str, k: int = 5) -> List[Dict]:
+        """Async version of retrieve_context; does not block the event loop."""
+        lexical, decisive = self._lexical(query, protocol, k)
+        if decisive:
+            return self._lexical_only(lexical, k)
+        query_vector = await self.providers.call("embed", lambda: self.embeddings.aembed_query(query))
+        docs = await self.aretrieve_by_vector(query_vector, protocol, self._candidate_k(k))
+        return self._select(docs, lexical, k)
+
+    def _prepare(self, query: str, protocol: str, k: int = 5) -> Dict[str, Any]:
+        """Lexical shortcut -> embed -> semantic answer cache -> retrieval.
+
+        When the lexical match is decisive no query vector exists, so the answer
+        cache is neither consulted nor filled for that question.
+        """
+        lexical, decisive = self._lexical(query, protocol, k)
+        if decisive:
+            return {"docs": self._lexical_only(lexical, k), "query_vector": None, "cached": None,
+                    "retrieval": "lexical_only"}
+
+        with metrics.stage("embed"):
+            query_vector = self.embeddings.embed_query(query)
+        cached = self.answer_cache.lookup(protocol, query_vector)
+        if cached is not None:
+            return {"docs": None, "query_vector": query_vector, "cached": cached, "retrieval": "cache"}
+
+        docs = self._select(self.retrieve_by_vector(query_vector, protocol, self._candidate_k(k)), lexical, k)
+        return {"docs": docs, "query_vector": query_vector, "cached": None,
+                "retrieval": "vector" if lexical is None else "hybrid"}
+
+    async def _aprepare(self, query: str, protocol: str, k: int = 5,
+                        query_vector: Optional[List[float]] = None) -> Dict[str, Any]:
+        """Async version of _prepare. `query_vector` may be passed in when it was embedded as part of a batch.
+
+        As there, a decisive lexical match skips the answer cache in both directions.
+        """
+        lexical, decisive = self._lexical(query, protocol, k)
+        if decisive:
+            return {"docs": self._lexical_only(lexical, k), "query_vector": None, "cached": None,
+                    "retrieval": "lexical_only"}
+
+        if query_vector is None:
+            query_vector = await self.providers.call("embed", lambda: self.embeddings.aembed_query(query))
+        cached = await self.answer_cache.alookup(protocol, query_vector)
+        if cached is not None:
+            return {"docs": None, "query_vector": query_vector, "cached": cached, "retrieval": "cache"}
+
+        docs = await self.aretrieve_by_vector(query_vector, protocol, self._candidate_k(k))
+        return {"docs": self._select(docs, lexical, k), "query_vector": query_vector, "cached": None,
+                "retrieval": "vector" if lexical is None else "hybrid"}
+
+    def _store_answer(self, protocol: str, prepared: Dict[str, Any], answer: str, sources: List[Dict],
+                      generation_time: float):
+        if prepared["query_vector"] is not None:
+            self.answer_cache.store(protocol, prepared["query_vector"], answer, sources, generation_time)
+
+    async def _astore_answer(self, protocol: str, prepared: Dict[str, Any], answer: str, sources: List[Dict],
+                             generation_time: float):
+        if prepared["query_vector"] is not None:
+            await self.answer_cache.astore(protocol, prepared["query_vector"], answer, sources, generation_time)
+
+    @staticmethod
+    def format_block(doc: Dict, number: int) -> str:
+        """Formats one retrieved document for the prompt, cited as [number]."""
+        meta = doc.get('metadata', {})
+        source = f"{meta.get('source', 'Unknown')} (Page {meta.get('page', '?')})"
+        content = doc.get('content', '').replace('\n', ' ')
+        return f"[{number}] SOURCE: {source}\nCONTENT: {content}"
+
+    @staticmethod
+    def format_source(doc: Dict, number: int) -> Dict:
+        """Formats one retrieved document as a citation card for the API response."""
+        return {
+            "id": number,
+            "document": doc.get('metadata', {}).get('source'),
+            "page": doc.get('metadata', {}).get('page'),
+            "text": doc.get('content')[:200] + "..."
+        }
 
     def format_docs(self, docs: List[Dict]) -> str:
         """Formats retrieved documents for the prompt."""
-        formatted = []
-        for i, doc in enumerate(docs):
-            meta = doc.get('metadata', {})
-            source = f"{meta.get('source', 'Unknown')} (Page {meta.get('page', '?')})"
-            content = doc.get('content', '').replace('\n', ' ')
-            formatted.append(f"[{i+1}] SOURCE: {source}\nCONTENT: {content}")
-        return "\n\n".join(formatted)
+        return "\n\n".join(self.format_block(doc, i + 1) for i, doc in enumerate(docs))
+
+    def format_sources(self, docs: List[Dict]) -> List[Dict]:
+        """Formats retrieved documents as citation cards for the API response."""
+        return [self.format_source(doc, i + 1) for i, doc in enumerate(docs)]
+
+    def _answer_cache_metadata(self, cached: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+        stats = self.answer_cache.stats()
+        meta = {"hit": cached is not None, "hit_rate": stats["hit_rate"]}
+        if cached is not None:
+            meta["similarity"] = round(cached["similarity"], 4)
+            meta["saved_s"] = round(cached["generation_time_s"], 3)
+        return {"answer_cache": meta}
+
+    def _cached_result(self, prepared: Dict[str, Any]) -> Dict[str, Any]:
+        cached = prepared["cached"]
+        return {"answer": cached["answer"], "sources": cached["sources"],
+                "metadata": {"retrieval": "cache", **self._answer_cache_metadata(cached)}}
+
+    @staticmethod
+    def coalesce_key(query: str, protocol: str) -> Tuple[str, str]:
+        return normalize_text(query), protocol
 
     def generate_answer(self, query: str, protocol: str) -> Dict[str, Any]:
-        """Full RAG flow: Retrieve -> Generate -> Cite."""
-        
-        # 1. Retrieve
-        docs = self.retrieve_context(query, protocol)
+        """Full RAG flow: Retrieve -> Generate -> Cite.
+
+        Synchronous, for scripts and notebooks only. It takes no LLM scheduler
+        slot and is not bounded by Providers.call (no retries or request
+        deadline, just the clients' HTTP timeouts). The API serves every request
+        through agenerate_answer.
+        """
+        with metrics.track("query") as tracker:
+            result, coalesced = self.inflight.do(self.coalesce_key(query, protocol),
+                                                 lambda: self._generate_answer(query, protocol))
+        return caller_result(result, tracker, coalesced)
+
+    def _generate_answer(self, query: str, protocol: str) -> Dict[str, Any]:
+        # 1. Retrieve (or reuse a cached answer for a paraphrased question)
+        prepared = self._prepare(query, protocol)
+        metrics.RETRIEVALS.inc(path=prepared["retrieval"])
+        if prepared["cached"] is not None:
+            return self._cached_result(prepared)
+        docs = prepared["docs"]
         if not docs:
-            return {
-                "answer": "I couldn't find any specific information about that in the protocol documentation.",
-                "sources": []
-            }
-            
+            return {"answer": NO_CONTEXT_ANSWER, "sources": []}
+
         context_str = self.format_docs(docs)
-        
-        # 2. Prompt
-        system_prompt = """You are CryptoGuide AI, an expert DeFi research assistant. 
-        Answer the user's question based ONLY on the provided context. 
-        
-        Rules:
-        - Cite your sources using square brackets like [1], [2].
-        - If the answer is not in the context, say you don't know.
-        - Be concise, professional, and precise.
-        - Use markdown for formatting.
-        
-        Context:
-        {context}
+
+        # 2. Generate
+        start = time.perf_counter()
+        usage = UsageMetadataCallbackHandler()
+        with metrics.stage("llm"):
+            answer = self.answer_chain.invoke({"context": context_str, "question": query},
+                                              config={"callbacks": [usage]})
+        record_llm_usage(usage, SYSTEM_PROMPT.format(context=context_str) + query, answer)
+        sources = self.format_sources(docs)
+        self._store_answer(protocol, prepared, answer, sources, time.perf_counter() - start)
+
+        # 3. Format Output
+        return {"answer": answer, "sources": sources,
+                "metadata": {"retrieval": prepared["retrieval"], **self._answer_cache_metadata(None)}}
+
+    async def agenerate_answer(self, query: str, protocol: str, start_session: bool = False) -> Dict[str, Any]:
+        """Async version of generate_answer (async embed, async RPC, ainvoke).
+        With `start_session`, the answer also opens a conversation (metadata.session)."""
+        with metrics.track("query") as tracker:
+            result, coalesced = await self.inflight.ado(self.coalesce_key(query, protocol),
+                                                        lambda: self._agenerate_answer(query, protocol))
+        result = caller_result(result, tracker, coalesced)
+        context = result.pop("context", None)
+        if start_session:
+            result["metadata"]["session"] = self.start_session(query, protocol, result["answer"], result["sources"],
+                                                               result["metadata"].get("retrieval"), context)
+        return result
+
+    async def _agenerate_answer(self, query: str, protocol: str) -> Dict[str, Any]:
+        # 1. Retrieve (or reuse a cached answer for a paraphrased question)
+        prepared = await self._aprepare(query, protocol)
+        return await self._agenerate_prepared(query, protocol, prepared)
+
+    async def agenerate_from_docs(self, query: str, protocol: str, docs: List[Dict]) -> Dict[str, Any]:
+        """Generates from documents the caller already retrieved (e.g. with aretrieve_context).
+        Bypasses the semantic answer cache, so every call really generates."""
+        prepared = {"docs": docs, "query_vector": None, "cached": None, "retrieval": "provided"}
+        result = await self._agenerate_prepared(query, protocol, prepared)
+        result.pop("context", None)
+        return result
+
+    async def _agenerate_prepared(self, query: str, protocol: str, prepared: Dict[str, Any],
+                                  priority_class: str = "query") -> Dict[str, Any]:
+        metrics.RETRIEVALS.inc(path=prepared["retrieval"])
+        if prepared["cached"] is not None:
+            return self._cached_result(prepared)
+        docs = prepared["docs"]
+        if not docs:
+            return {"answer": NO_CONTEXT_ANSWER, "sources": []}
+
+        context_str = self.format_docs(docs)
+
+        # 2. Generate
+        start = time.perf_counter()
+        usage = UsageMetadataCallbackHandler()
+        async with self.scheduler.slot(priority_class):
+            answer = await self.providers.call(
+                "llm", lambda: self.answer_chain.ainvoke({"context": context_str, "question": query},
+                                                         config={"callbacks": [usage]})
+            )
+        record_llm_usage(usage, SYSTEM_PROMPT.format(context=context_str) + query, answer)
+        sources = self.format_sources(docs)
+        await self._astore_answer(protocol, prepared, answer, sources, time.perf_counter() - start)
+
+        # 3. Format Output (`context` seeds a conversation; callers drop it from the response)
+        return {"answer": answer, "sources": sources,
+                "metadata": {"retrieval": prepared["retrieval"], **self._answer_cache_metadata(None)},
+                "context": {"docs": docs, "query_vector": prepared["query_vector"]}}
+
+    async def abatch_generate(self, items: List[Dict[str, str]], concurrency: Optional[int] = None,
+                              k: int = 5) -> List[Dict[str, Any]]:
+        """Answers many {"question", "protocol"} items; results come back in input order.
+
+        Repeated questions (same normalized text and protocol) are answered once.
+        Every question that needs a vector is embedded in a single
+        embed_documents call, then retrieval and generation run per item with at
+        most `concurrency` generations in flight (clamped to 1..BATCH_CONCURRENCY,
+        which is also the default). Each item (and the shared
+        embedding call) gets the single-query request deadline from when it
+        starts. A failing item gets an {"error": ..., "exception": ...} result
+        instead of failing the batch.
         """
-        
-        prompt = ChatPromptTemplate.from_messages([
-            ("system", system_prompt),
-            ("user", "{question}")
-        ])
-        
-        # 3. Generate
-        chain = prompt | self.llm | StrOutputParser()
-        answer = chain.invoke({"context": context_str, "question": query})
-        
-        # 4. Format Output
-        return {
-            "answer": answer,
-            "sources": [
-                {
-                    "id": i+1,
-                    "document": doc.get('metadata', {}).get('source'),
-                    "page": doc.get('metadata', {}).get('page'),
-                    "text": doc.get('content')[:200] + "..."
-                }
-                for i, doc in enumerate(docs)
-            ]
+        with metrics.track("batch"):
+            concurrency = max(1, min(concurrency or self.batch_concurrency, self.batch_concurrency))
+            return await self._abatch_generate(items, concurrency, k)
+
+    async def _abatch_generate(self, items: List[Dict[str, str]], concurrency: int, k: int) -> List[Dict[str, Any]]:
+        keys = [(normalize_text(item["question"]), item["protocol"]) for item in items]
+        unique: Dict[Tuple[str, str], Dict[str, str]] = {}
+        for key, item in zip(keys, items):
+            unique.setdefault(key, item)
+
+        # One embedding request for every distinct question text the lexical path can't answer
+        # (the embedding cache still short-circuits questions seen before).
+        prepared: Dict[Tuple[str, str], Any] = {}
+        to_embed: Dict[str, str] = {}
+        for key, item in unique.items():
+            lexical, decisive = self._lexical(item["question"], item["protocol"], k)
+            if decisive:
+                prepared[key] = {"docs": self._lexical_only(lexical, k), "query_vector": None, "cached": None,
+                                 "retrieval": "lexical_only"}
+            else:
+                to_embed.setdefault(key[0], item["question"])
+        vectors, embed_error = {}, None
+        if to_embed:
+            try:
+                texts = list(to_embed.values())
+                with request_deadline(self.providers.request_deadline):
+                    embedded = await self.providers.call("embed", lambda: self.embeddings.aembed_queries(texts))
+                vectors = dict(zip(to_embed, embedded))
+            except Exception as e:
+                embed_error = e
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def answer(key: Tuple[str, str], item: Dict[str, str]) -> Dict[str, Any]:
+            try:
+                if key not in prepared and key[0] not in vectors:
+                    raise embed_error
+                async with semaphore:
+                    with request_deadline(self.providers.request_deadline):
+                        if key not in prepared:
+                            prepared[key] = await self._aprepare(item["question"], item["protocol"], k,
+                                                                 query_vector=vectors[key[0]])
+                        result = await self._agenerate_prepared(item["question"], item["protocol"],
+                                                                prepared[key], priority_class="batch")
+                result.pop("context", None)
+                return result
+            except Exception as e:
+                print(f"Error answering batch item {item['question'][:50]!r}: {e}")
+                return {"error": str(e), "exception": e}
+
+        answers = dict(zip(unique, await asyncio.gather(*(answer(key, item) for key, item in unique.items()))))
+        return [dict(answers[key]) for key in keys]
+
+    async def astream_answer(self, query: str, protocol: str,
+                             start_session: bool = False) -> AsyncIterator[Tuple[str, Any]]:
+        """Streaming RAG flow. Yields (event, data) pairs: sources first, then answer tokens, then done.
+        With `start_session`, the answer also opens a conversation (done's `session`)."""
+        with metrics.track("query_stream") as tracker:
+            async for event, data in self._astream_answer(query, protocol, start_session):
+                if event == "done":
+                    data = {**data, **tracker.summary()}
+                yield event, data
+
+    async def _astream_answer(self, query: str, protocol: str,
+                              start_session: bool = False) -> AsyncIterator[Tuple[str, Any]]:
+        start = time.perf_counter()
+
+        # 1. Retrieve (or reuse a cached answer) -- sources go out before generation starts
+        prepared = await self._aprepare(query, protocol)
+        metrics.RETRIEVALS.inc(path=prepared["retrieval"])
+        if prepared["cached"] is not None:
+            result = self._cached_result(prepared)
+            yield "sources", result["sources"]
+            yield "token", result["answer"]
+            done = {"total_time_s": round(time.perf_counter() - start, 3), **result["metadata"]}
+            if start_session:
+                done["session"] = self.start_session(query, protocol, result["answer"], result["sources"], "cache")
+            yield "done", done
+            return
+
+        docs = prepared["docs"]
+        retrieval_time = time.perf_counter() - start
+        sources = self.format_sources(docs)
+        yield "sources", sources
+
+        if not docs:
+            yield "token", NO_CONTEXT_ANSWER
+            done = {"retrieval_time_s": round(retrieval_time, 3),
+                    "total_time_s": round(time.perf_counter() - start, 3)}
+            if start_session:
+                done["session"] = self.start_session(query, protocol, NO_CONTEXT_ANSWER, [], prepared["retrieval"])
+            yield "done", done
+            return
+
+        # 2. Generate token by token
+        first_token_time = None
+        tokens = []
+        chain = self.answer_chain
+        context_str = self.format_docs(docs)
+        usage = UsageMetadataCallbackHandler()
+        async with self.scheduler.slot("query"):
+            stream = chain.astream({"context": context_str, "question": query}, config={"callbacks": [usage]})
+            async for token in self.providers.stream("llm", stream):
+                if not token:
+                    continue
+                if first_token_time is None:
+                    first_token_time = time.perf_counter() - start
+                tokens.append(token)
+                yield "token", token
+
+        generation_time = time.perf_counter() - start - retrieval_time
+        answer = "".join(tokens)
+        record_llm_usage(usage, SYSTEM_PROMPT.format(context=context_str) + query, answer)
+        await self._astore_answer(protocol, prepared, answer, sources, generation_time)
+
+        done = {
+            "retrieval": prepared["retrieval"],
+            "retrieval_time_s": round(retrieval_time, 3),
+            "time_to_first_token_s": round(first_token_time, 3) if first_token_time is not None else None,
+            "total_time_s": round(time.perf_counter() - start, 3),
+            **self._answer_cache_metadata(None),
         }
+        if start_session:
+            done["session"] = self.start_session(query, protocol, answer, sources, prepared["retrieval"],
+                                                 {"docs": docs, "query_vector": prepared["query_vector"]})
+        yield "done", done
+
+    # --- Conversation sessions (see sessions.py) ---
+
+    def start_session(self, query: str, protocol: str, answer: str, sources: List[Dict],
+                      retrieval: Optional[str], context: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+        """Opens a conversation with a turn answered by the normal path. Its context blocks
+        keep their numbers, so the answer's citations stay valid in follow-ups; an answer
+        from the cache comes without them, and the next turn retrieves."""
+        session = self.sessions.start(protocol)
+        added = 0
+        if context is not None:
+            _, added = session.add_blocks(context["docs"], context["query_vector"], self.format_block,
+                                          self.context_packer.block_tokens, self.sessions.context_budget)
+        else:
+            session.next_source_id = len(sources) + 1
+        turn = {"retrieval": retrieval, "reused_chunks": 0, "new_chunks": added}
+        return self._finish_turn(session, query, answer, turn, {"cache_read": 0, "cache_write": 0})
+
+    async def _aprepare_turn(self, session: Session, query: str, protocol: str, k: int = 5) -> Dict[str, Any]:
+        """Embeds the question together with the previous one, then reuses the session's
+        context blocks when they were retrieved for a close enough query, or retrieves."""
+        if session.protocol != protocol:
+            session.reset_context(protocol)
+        text = f"{session.turns[-1]['question']}\n{query}" if session.turns else query
+        query_vector = await self.providers.call("embed", lambda: self.embeddings.aembed_query(text))
+        if session.can_reuse(query_vector, self.sessions.reuse_similarity):
+            metrics.RETRIEVALS.inc(path="session")
+            return {"retrieval": "reused", "reused_chunks": len(session.blocks), "new_chunks": 0}
+
+        metrics.RETRIEVALS.inc(path="vector")
+        docs = self.pack_context(await self.aretrieve_by_vector(query_vector, protocol, self._candidate_k(k)), k)
+        reused, added = session.add_blocks(docs, query_vector, self.format_block, self.context_packer.block_tokens,
+                                           self.sessions.context_budget)
+        return {"retrieval": "retrieved", "reused_chunks": reused, "new_chunks": added}
+
+    def _session_messages(self, session: Session, query: str):
+        return session.messages(SYSTEM_PROMPT.format(context=""), query, self.sessions.max_turns,
+                                self.sessions.prompt_cache)
+
+    @staticmethod
+    def _messages_text(messages) -> str:
+        return "\n".join(m.content if isinstance(m.content, str) else "".join(b["text"] for b in m.content)
+                         for m in messages)
+
+    def _finish_turn(self, session: Session, query: str, answer: str, turn: Dict[str, Any],
+                     cache: Dict[str, int]) -> Dict[str, Any]:
+        session.record_turn(query, answer, self.sessions.max_turns)
+        self.sessions.touch(session)
+        turn.update({
+            "id": session.id,
+            "turn": session.turn_count,
+            "context_blocks": len(session.blocks),
+            "history_turns": len(session.turns) - 1,
+            "cached_tokens": cache["cache_read"],
+            "cache_write_tokens": cache["cache_write"],
+        })
+        self.sessions.count_turn(turn)
+        return turn
+
+    def session_sources(self, session: Session) -> List[Dict]:
+        """Citation cards for every block in the session's prompt, under their stable numbers."""
+        return [self.format_source(block["doc"], block["source_id"]) for block in session.blocks]
+
+    async def asession_answer(self, session_id: str, query: str, protocol: str) -> Dict[str, Any]:
+        """Answers a follow-up in a conversation opened with start_session. Earlier turns
+        go into the prompt, and context blocks are reused across turns; the answer
+        cache and request coalescing are skipped, since the answer depends on the
+        conversation. Raises SessionNotFound for ids this server did not issue."""
+        with metrics.track("session") as tracker:
+            session = self.sessions.get(session_id)
+            async with session.lock:
+                turn = await self._aprepare_turn(session, query, protocol)
+                cache = {"cache_read": 0, "cache_write": 0}
+                if not session.blocks:
+                    answer = NO_CONTEXT_ANSWER
+                else:
+                    messages = self._session_messages(session, query)
+                    usage = UsageMetadataCallbackHandler()
+                    async with self.scheduler.slot("query"):
+                        answer = await self.providers.call(
+                            "llm", lambda: self.session_chain.ainvoke(messages, config={"callbacks": [usage]})
+                        )
+                    cache = record_llm_usage(usage, self._messages_text(messages), answer)
+                sources = self.session_sources(session)
+                self._finish_turn(session, query, answer, turn, cache)
+        return {"answer": answer, "sources": sources,
+                "metadata": {"retrieval": turn["retrieval"], "session": turn, **tracker.summary()}}
+
+    async def astream_session_answer(self, session_id: str, query: str,
+                                     protocol: str) -> AsyncIterator[Tuple[str, Any]]:
+        """Streaming version of asession_answer: sources, answer tokens, then done."""
+        with metrics.track("session_stream") as tracker:
+            start = time.perf_counter()
+            session = self.sessions.get(session_id)
+            async with session.lock:
+                turn = await self._aprepare_turn(session, query, protocol)
+                retrieval_time = time.perf_counter() - start
+                yield "sources", self.session_sources(session)
+
+                cache = {"cache_read": 0, "cache_write": 0}
+                first_token_time = None
+                if not session.blocks:
+                    answer = NO_CONTEXT_ANSWER
+                    yield "token", answer
+                else:
+                    messages = self._session_messages(session, query)
+                    usage = UsageMetadataCallbackHandler()
+                    tokens = []
+                    async with self.scheduler.slot("query"):
+                        stream = self.session_chain.astream(messages, config={"callbacks": [usage]})
+                        async for token in self.providers.stream("llm", stream):
+                            if not token:
+                                continue
+                            if first_token_time is None:
+                                first_token_time = time.perf_counter() - start
+                            tokens.append(token)
+                            yield "token", token
+                    answer = "".join(tokens)
+                    cache = record_llm_usage(usage, self._messages_text(messages), answer)
+                self._finish_turn(session, query, answer, turn, cache)
+
+            yield "done", {
+                "retrieval": turn["retrieval"],
+                "retrieval_time_s": round(retrieval_time, 3),
+                "time_to_first_token_s": round(first_token_time, 3) if first_token_time is not None else None,
+                "total_time_s": round(time.perf_counter() - start, 3),
+                "session": turn,
+                **tracker.summary(),
+            }
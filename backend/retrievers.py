@@ -0,0 +1,141 @@
+import os
+import asyncio
+from typing import List, Dict, Any, Optional, TYPE_CHECKING
+
+from vector_index import load_index
+
+if TYPE_CHECKING:
+    from supabase import AsyncClient
+    from supabase.client import Client
+
+# Retriever backends for RAGPipeline. Each one takes an already-embedded query and
+# returns rows shaped like the `match_documents` RPC output:
+#   {"id", "content", "metadata": {"source", "page", "protocol"}, "similarity"}
+# search_multi returns them grouped by protocol, {protocol: rows}, for comparisons.
+
+
+class SupabaseRetriever:
+    """Vector search through the Supabase `match_documents` RPC."""
+
+    name = "supabase"
+
+    def __init__(self, client: "Client", url: Optional[str] = None, key: Optional[str] = None,
+                 async_client: Optional["AsyncClient"] = None, async_options=None):
+        self.client = client
+        self.url = url
+        self.key = key
+        self.async_options = async_options
+        # The async Supabase client has to be created inside a running event loop,
+        # so it is opened lazily on the first async search.
+        self._async_client: Optional["AsyncClient"] = async_client
+
+    async def get_async_client(self) -> "AsyncClient":
+        """Returns the async Supabase client, creating it on first use."""
+        if self._async_client is None:
+            from supabase import acreate_client
+            self._async_client = await acreate_client(self.url, self.key, options=self.async_options)
+        return self._async_client
+
+    def _match_params(self, query_vector: List[float], protocol: str, k: int) -> Dict[str, Any]:
+        return {
+            'query_embedding': query_vector,
+            'match_count': k,
+            'filter': {'protocol': protocol}
+        }
+
+    def search(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        response = self.client.rpc(
+            'match_documents',
+            self._match_params(query_vector, protocol, k)
+        ).execute()
+        return response.data
+
+    async def asearch(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        client = await self.get_async_client()
+        response = await client.rpc(
+            'match_documents',
+            self._match_params(query_vector, protocol, k)
+        ).execute()
+        return response.data
+
+    @staticmethod
+    def _multi_params(query_vector: List[float], protocols: List[str], k: int) -> Dict[str, Any]:
+        return {
+            'query_embedding': query_vector,
+            'protocols': list(dict.fromkeys(protocols)),
+            'match_count': k
+        }
+
+    @staticmethod
+    def _group(protocols: List[str], rows: List[Dict]) -> Dict[str, List[Dict]]:
+        grouped: Dict[str, List[Dict]] = {protocol: [] for protocol in protocols}
+        for row in rows:
+            row = dict(row)
+            grouped.setdefault(row.pop('protocol'), []).append(row)
+        for docs in grouped.values():
+            docs.sort(key=lambda d: d.get('similarity', 0.0), reverse=True)
+        return grouped
+
+    def search_multi(self, query_vector: List[float], protocols: List[str], k: int = 5) -> Dict[str, List[Dict]]:
+        """Top-k rows for each protocol in one `match_documents_multi` RPC."""
+        response = self.client.rpc(
+            'match_documents_multi',
+            self._multi_params(query_vector, protocols, k)
+        ).execute()
+        return self._group(protocols, response.data)
+
+    async def asearch_multi(self, query_vector: List[float], protocols: List[str], k: int = 5) -> Dict[str, List[Dict]]:
+        client = await self.get_async_client()
+        response = await client.rpc(
+            'match_documents_multi',
+            self._multi_params(query_vector, protocols, k)
+        ).execute()
+        return self._group(protocols, response.data)
+
+
+class LocalRetriever:
+    """Vector search against an in-process VectorIndex or QuantizedIndex (no network hop)."""
+
+    name = "local"
+
+    def __init__(self, index, thread_rows: int = 10000):
+        self.index = index
+        self.thread_rows = thread_rows
+
+    def _rows(self, protocols: List[Optional[str]]) -> int:
+        """Rows a search over `protocols` scans (None = the whole index)."""
+        rows = 0
+        for protocol in protocols:
+            start, end = (0, len(self.index)) if protocol is None else self.index.partitions.get(protocol, (0, 0))
+            rows += end - start
+        return rows
+
+    async def _run(self, protocols: List[Optional[str]], search, *args):
+        # Scanning a few thousand rows takes well under a millisecond, less than a
+        # thread hop, so it runs inline. Larger scans would block every other
+        # request on the event loop; NumPy releases the GIL, so they go to a thread.
+        if self._rows(protocols) > self.thread_rows:
+            return await asyncio.to_thread(search, *args)
+        return search(*args)
+
+    def search(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        return self.index.search(query_vector, protocol, k)
+
+    async def asearch(self, query_vector: List[float], protocol: str, k: int = 5) -> List[Dict]:
+        return await self._run([protocol], self.search, query_vector, protocol, k)
+
+    def search_multi(self, query_vector: List[float], protocols: List[str], k: int = 5) -> Dict[str, List[Dict]]:
+        return {protocol: self.index.search(query_vector, protocol, k) for protocol in dict.fromkeys(protocols)}
+
+    async def asearch_multi(self, query_vector: List[float], protocols: List[str], k: int = 5) -> Dict[str, List[Dict]]:
+        return await self._run(list(dict.fromkeys(protocols)), self.search_multi, query_vector, protocols, k)
+
+
+def local_retriever_from_env() -> LocalRetriever:
+    """Loads the index at VECTOR_INDEX_PATH (see vector_index.load_index for accepted formats)."""
+    path = os.environ.get("VECTOR_INDEX_PATH")
+    if not path:
+        raise ValueError("RETRIEVER_BACKEND=local requires VECTOR_INDEX_PATH")
+    index = load_index(path)
+    print(f"Loaded local vector index: {len(index)} chunks, protocols={index.protocols()}")
+    return LocalRetriever(index, thread_rows=int(os.environ.get("LOCAL_SEARCH_THREAD_ROWS", "10000")))
@@ -0,0 +1,142 @@
+"""
+Offline comparison of raw top-k context against ContextPacker output.
+
+Retrieves candidates for the ground_truth.json questions with the BM25 index
+built from data/ (no API keys needed), then compares, per question, the
+top-k chunks as format_docs used to send them with the packed blocks:
+prompt tokens, duplicate text removed, and how many expected keywords the
+context still contains.
+
+Comparisons are measured too: each question is compared against one and two
+other protocols, and each protocol's context is packed the way
+ComparisonEngine does it (DOCS_PER_PROTOCOL blocks within
+ContextPacker.protocol_budget). It is reported next to the raw
+DOCS_PER_PROTOCOL chunks and next to an equal split of the single-query budget.
+
+    python scripts/benchmark_context.py [--k 5] [--budget 1500] [--compare-budget 4500] [--mmr-lambda 0.7]
+                                        [--fetch-factor 1]
+"""
+
+import os
+import sys
+import json
+import argparse
+from datetime import datetime
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from context import ContextPacker
+from compare import DOCS_PER_PROTOCOL
+from tokens import tokenizer_name
+from benchmark_lexical import build_index, GROUND_TRUTH_PATH, BACKEND_DIR
+
+RESULTS_PATH = os.path.join(BACKEND_DIR, "evaluation", "context_packing_results.json")
+
+
+def keyword_coverage(docs, keywords) -> float:
+    text = " ".join(d.get("content", "") for d in docs).lower()
+    return sum(1 for kw in keywords if kw.lower() in text) / len(keywords) if keywords else 0.0
+
+
+def compare_packing(index, packer: ContextPacker, cases) -> dict:
+    """Per-protocol context of 2- and 3-protocol comparisons: raw chunks, an equal split
+    of the single-query budget, and the comparison budget ComparisonEngine uses."""
+    all_protocols = sorted({tc["protocol"] for tc in cases})
+    strategies = {"raw": None, "equal_split": lambda n: packer.token_budget // n,
+                  "compare_budget": packer.protocol_budget}
+    results = {}
+    print(f"\n--- Comparison context ({DOCS_PER_PROTOCOL} blocks per protocol, "
+          f"compare budget {packer.compare_token_budget}) ---")
+    print(f"{'protocols':<11}{'strategy':<16}{'blocks/protocol':>16}{'tokens':>8}{'keyword coverage':>18}")
+    for n in range(2, len(all_protocols) + 1):
+        totals = {name: {"blocks": 0, "tokens": 0, "coverage": 0.0} for name in strategies}
+        for tc in cases:
+            protocols = [tc["protocol"]] + [p for p in all_protocols if p != tc["protocol"]][:n - 1]
+            candidates = [index.search(tc["question"], p, packer.fetch_k(DOCS_PER_PROTOCOL)) for p in protocols]
+            for name, budget in strategies.items():
+                if budget is None:
+                    packed = [docs[:DOCS_PER_PROTOCOL] for docs in candidates]
+                else:
+                    packed = [packer.pack(docs, DOCS_PER_PROTOCOL, budget(n))[0] for docs in candidates]
+                totals[name]["blocks"] += sum(len(docs) for docs in packed) / n
+                totals[name]["tokens"] += sum(packer.block_tokens(d) for docs in packed for d in docs)
+                # Coverage of the question's own protocol, whose keywords the ground truth lists
+                totals[name]["coverage"] += keyword_coverage(packed[0], tc["expected_keywords"])
+        results[f"{n}_protocols"] = {}
+        for name, total in totals.items():
+            row = {key: round(value / len(cases), 3) for key, value in total.items()}
+            results[f"{n}_protocols"][name] = {"blocks_per_protocol": row["blocks"], "tokens": row["tokens"],
+                                               "keyword_coverage": row["coverage"]}
+            print(f"{n:<11}{name:<16}{row['blocks']:>16.2f}{row['tokens']:>8.0f}{row['coverage']:>18.0%}")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare raw top-k context with packed context')
+    parser.add_argument('--k', type=int, default=5, help='Chunks (raw) / blocks (packed) in the prompt')
+    parser.add_argument('--budget', type=int, default=int(os.environ.get("CONTEXT_TOKEN_BUDGET", "1500")),
+                        help='Context token budget')
+    parser.add_argument('--compare-budget', type=int,
+                        default=int(os.environ.get("COMPARE_TOKEN_BUDGET", "4500")),
+                        help='Context token budget of a whole comparison')
+    parser.add_argument('--mmr-lambda', type=float, default=float(os.environ.get("CONTEXT_MMR_LAMBDA", "0.7")),
+                        help='Relevance vs diversity trade-off')
+    parser.add_argument('--fetch-factor', type=int, default=int(os.environ.get("CONTEXT_FETCH_FACTOR", "1")),
+                        help='Candidates retrieved per kept block')
+    parser.add_argument('--out', default=RESULTS_PATH, help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    index = build_index()
+    packer = ContextPacker(token_budget=args.budget, mmr_lambda=args.mmr_lambda, fetch_factor=args.fetch_factor,
+                           compare_token_budget=args.compare_budget)
+    with open(GROUND_TRUTH_PATH) as f:
+        cases = json.load(f)["test_cases"]
+
+    print(f"\n--- Context packing on {len(cases)} questions (k={args.k}, budget={args.budget}, "
+          f"tokens: {tokenizer_name()}) ---")
+    rows = []
+    for tc in cases:
+        candidates = index.search(tc["question"], tc["protocol"], packer.fetch_k(args.k))
+        raw = candidates[:args.k]
+        packed, stats = packer.pack(candidates, args.k)
+        rows.append({
+            "id": tc["id"],
+            "raw_tokens": sum(packer.block_tokens(d) for d in raw),
+            "packed_tokens": stats["tokens"],
+            "merged_chunks": stats["merged_chunks"],
+            "duplicate_chars_removed": stats["duplicate_chars_removed"],
+            "raw_keyword_coverage": round(keyword_coverage(raw, tc["expected_keywords"]), 3),
+            "packed_keyword_coverage": round(keyword_coverage(packed, tc["expected_keywords"]), 3),
+            "raw_sources": len({(d["metadata"]["source"], d["metadata"]["page"]) for d in raw}),
+            "packed_sources": len(packed),
+        })
+
+    n = len(rows)
+    summary = {key: round(sum(r[key] for r in rows) / n, 3) for key in rows[0] if key != "id"}
+    print(f"{'':<26}{'raw top-k':>12}{'packed':>12}")
+    print(f"{'avg context tokens':<26}{summary['raw_tokens']:>12.0f}{summary['packed_tokens']:>12.0f}")
+    print(f"{'avg distinct pages':<26}{summary['raw_sources']:>12.2f}{summary['packed_sources']:>12.2f}")
+    print(f"{'avg keyword coverage':<26}{summary['raw_keyword_coverage']:>12.0%}"
+          f"{summary['packed_keyword_coverage']:>12.0%}")
+    print(f"Chunks merged per question: {summary['merged_chunks']:.2f}, "
+          f"duplicate characters removed: {summary['duplicate_chars_removed']:.0f}")
+
+    comparisons = compare_packing(index, packer, cases)
+
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "generated": datetime.now().isoformat(timespec="seconds"),
+            "tokenizer": tokenizer_name(),
+            "config": {"k": args.k, "budget": args.budget, "compare_budget": args.compare_budget,
+                       "docs_per_protocol": DOCS_PER_PROTOCOL, "mmr_lambda": args.mmr_lambda,
+                       "fetch_factor": args.fetch_factor},
+            "summary": summary,
+            "comparisons": comparisons,
+            "questions": rows,
+        }, f, indent=2)
+    print(f"\n📄 Results saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,229 @@
+"""
+Ingestion embedding/insert throughput against a local stub embedding server.
+
+Starts an OpenAI-compatible /v1/embeddings server on localhost that sleeps in
+proportion to the tokens it receives and answers 429 + Retry-After once a
+tokens-per-minute budget is spent, then pushes the same synthetic corpus through:
+
+    baseline  fixed 100-item batches, one embedding request at a time, one insert per batch
+    writer    EmbeddingWriter: token-budgeted batches, several in flight, bulk inserts
+
+Inserts go to a sink that sleeps --insert-latency per call to model a database round trip.
+
+    python scripts/benchmark_embedding.py [--chunks 3000] [--tpm 2000000]
+"""
+
+import os
+import sys
+import json
+import time
+import base64
+import struct
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tokens import count_tokens, tokenizer_name
+from embedding_writer import EmbeddingClient, EmbeddingWriter
+from ingest_documents import extract_text_from_pdf, extract_text_from_markdown, chunk_text, chunk_row_id
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(BACKEND_DIR, "..", "data")
+RESULTS_PATH = os.path.join(BACKEND_DIR, "evaluation", "embedding_throughput_results.json")
+DIM = 1536
+
+
+class StubEmbeddingServer:
+    """OpenAI-compatible embeddings endpoint with a latency model and a token rate limit."""
+
+    def __init__(self, base_latency: float, per_token_latency: float, tokens_per_minute: int):
+        self.base_latency = base_latency
+        self.per_token_latency = per_token_latency
+        self.tokens_per_minute = tokens_per_minute
+        self.lock = threading.Lock()
+        self.window_start = time.monotonic()
+        self.window_tokens = 0
+        self.requests = 0
+        self.rejected = 0
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.httpd.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/v1"
+
+    def _admit(self, tokens: int) -> float:
+        """Returns 0 if the request fits this minute's budget, else seconds until it resets."""
+        with self.lock:
+            self.requests += 1
+            now = time.monotonic()
+            if now - self.window_start >= 60:
+                self.window_start, self.window_tokens = now, 0
+            if self.window_tokens + tokens > self.tokens_per_minute:
+                self.rejected += 1
+                return 60 - (now - self.window_start)
+            self.window_tokens += tokens
+            return 0.0
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status: int, body: dict, headers: dict = None):
+                payload = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                inputs = request["input"] if isinstance(request["input"], list) else [request["input"]]
+                tokens = sum(count_tokens(text) for text in inputs)
+                wait = server._admit(tokens)
+                if wait:
+                    self._reply(429, {"error": {"message": "Rate limit reached", "type": "requests"}},
+                                {"Retry-After": f"{wait:.2f}"})
+                    return
+                time.sleep(server.base_latency + server.per_token_latency * tokens)
+                data = []
+                for i, text in enumerate(inputs):
+                    seed = hashlib.sha256(text.encode()).digest()
+                    vector = [b / 255.0 for b in (seed * (DIM // len(seed) + 1))[:DIM]]
+                    if request.get("encoding_format") == "base64":
+                        embedding = base64.b64encode(struct.pack(f"{DIM}f", *vector)).decode()
+                    else:
+                        embedding = vector
+                    data.append({"object": "embedding", "index": i, "embedding": embedding})
+                self._reply(200, {"object": "list", "data": data, "model": request["model"],
+                                  "usage": {"prompt_tokens": tokens, "total_tokens": tokens}})
+
+        return Handler
+
+    def __enter__(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+
+
+class InsertSink:
+    """Stands in for the `documents` table: one sleep per insert call."""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = 0
+        self.rows = 0
+
+    def __call__(self, rows):
+        time.sleep(self.latency)
+        self.calls += 1
+        self.rows += len(rows)
+
+
+def corpus(n: int):
+    """n distinct (row_id, chunk) pairs built by cycling the real chunks in data/."""
+    base = []
+    for protocol, filename in [("aave", "Aave_V3_Technical_Paper.pdf"), ("compound", "Compound_V3_Documentation.md"),
+                               ("uniswap", "Uniswap_V3_Whitepaper.pdf")]:
+        path = os.path.join(DATA_DIR, filename)
+        pages = extract_text_from_pdf(path) if filename.endswith(".pdf") else extract_text_from_markdown(path)
+        base += chunk_text(pages, protocol)
+    items = []
+    for i in range(n):
+        chunk = base[i % len(base)]
+        chunk = {"text": f"{chunk['text']} [{i}]", "metadata": {**chunk["metadata"], "copy": i}}
+        items.append((chunk_row_id(chunk), chunk))
+    return items
+
+
+def run_baseline(items, client: EmbeddingClient, sink: InsertSink, batch_size: int = 100):
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i+batch_size]
+        vectors = client.embed([chunk["text"] for _, chunk in batch])
+        sink([{"id": row_id, "content": chunk["text"], "metadata": chunk["metadata"],
+               "protocol": chunk["metadata"]["protocol"], "embedding": vector}
+              for (row_id, chunk), vector in zip(batch, vectors)])
+
+
+def run_writer(items, client: EmbeddingClient, sink: InsertSink, max_tokens: int, max_in_flight: int,
+               insert_batch_size: int):
+    EmbeddingWriter(client.embed, sink, max_tokens=max_tokens, max_in_flight=max_in_flight,
+                    insert_batch_size=insert_batch_size).write(items)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark ingestion embedding throughput against a stub server')
+    parser.add_argument('--chunks', type=int, default=3000, help='Number of chunks to embed')
+    parser.add_argument('--base-latency', type=float, default=0.15, help='Stub server seconds per request')
+    parser.add_argument('--token-latency', type=float, default=2e-5, help='Stub server seconds per token')
+    parser.add_argument('--tpm', type=int, default=2_000_000, help='Stub server tokens-per-minute limit')
+    parser.add_argument('--insert-latency', type=float, default=0.05, help='Seconds per insert call')
+    parser.add_argument('--batch-tokens', type=int, default=50_000, help='Writer token budget per request')
+    parser.add_argument('--in-flight', type=int, default=4, help='Writer concurrent embedding requests')
+    parser.add_argument('--insert-batch', type=int, default=200, help='Writer rows per bulk insert')
+    parser.add_argument('--out', default=RESULTS_PATH, help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    items = corpus(args.chunks)
+    tokens = sum(count_tokens(chunk["text"]) for _, chunk in items)
+    print(f"\n--- Embedding throughput: {len(items)} chunks, {tokens:,} tokens ({tokenizer_name()}) ---")
+
+    results = {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "chunks": len(items),
+        "tokens": tokens,
+        "stub": {"base_latency_s": args.base_latency, "token_latency_s": args.token_latency,
+                 "tokens_per_minute": args.tpm, "insert_latency_s": args.insert_latency},
+        "runs": {},
+    }
+    runs = {
+        "baseline": lambda client, sink: run_baseline(items, client, sink),
+        "writer": lambda client, sink: run_writer(items, client, sink, args.batch_tokens, args.in_flight,
+                                                  args.insert_batch),
+    }
+    for name, run in runs.items():
+        # A fresh server per run so each starts with an empty rate-limit window
+        with StubEmbeddingServer(args.base_latency, args.token_latency, args.tpm) as server:
+            from openai import OpenAI
+            client = EmbeddingClient(client=OpenAI(api_key="stub", base_url=server.base_url, max_retries=0),
+                                     base_delay=0.2)
+            sink = InsertSink(args.insert_latency)
+            start = time.perf_counter()
+            run(client, sink)
+            elapsed = time.perf_counter() - start
+        assert sink.rows == len(items)
+        results["runs"][name] = {
+            "seconds": round(elapsed, 3),
+            "chunks_per_sec": round(len(items) / elapsed, 1),
+            "embed_requests": client.stats["requests"],
+            "rate_limited": client.stats["rate_limited"],
+            "insert_calls": sink.calls,
+        }
+
+    print(f"{'run':<10}{'seconds':>10}{'chunks/s':>10}{'requests':>10}{'429s':>7}{'inserts':>9}")
+    for name, run in results["runs"].items():
+        print(f"{name:<10}{run['seconds']:>10.2f}{run['chunks_per_sec']:>10.1f}{run['embed_requests']:>10}"
+              f"{run['rate_limited']:>7}{run['insert_calls']:>9}")
+    speedup = results["runs"]["baseline"]["seconds"] / results["runs"]["writer"]["seconds"]
+    results["speedup"] = round(speedup, 2)
+    print(f"\nSpeedup: {speedup:.1f}x")
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n📄 Results saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
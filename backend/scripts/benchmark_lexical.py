@@ -0,0 +1,79 @@
+"""
+Offline check of the BM25 fast path on the ground_truth.json questions.
+
+Builds a BM25 index straight from the documents in data/ (no API keys needed) and
+reports, per question, whether the lexical match is decisive enough to skip the
+embedding call and whether its top chunk comes from the expected source.
+
+    python scripts/benchmark_lexical.py [--ratio 1.5]
+"""
+
+import os
+import sys
+import json
+import argparse
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lexical import BM25Index
+from ingest_documents import extract_text_from_pdf, extract_text_from_markdown, chunk_text
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = os.path.join(BACKEND_DIR, "..", "data")
+GROUND_TRUTH_PATH = os.path.join(BACKEND_DIR, "evaluation", "ground_truth.json")
+
+CORPUS = {
+    "aave": "Aave_V3_Technical_Paper.pdf",
+    "compound": "Compound_V3_Documentation.md",
+    "uniswap": "Uniswap_V3_Whitepaper.pdf",
+}
+
+
+def load_chunks():
+    """Chunks the documents in data/ the way ingest_documents.py does."""
+    chunks = []
+    for protocol, filename in CORPUS.items():
+        path = os.path.join(DATA_DIR, filename)
+        pages = extract_text_from_pdf(path) if filename.endswith(".pdf") else extract_text_from_markdown(path)
+        chunks += chunk_text(pages, protocol)
+    return chunks
+
+
+def build_index() -> BM25Index:
+    return BM25Index.from_chunks(load_chunks())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how often the BM25 fast path skips embedding')
+    parser.add_argument('--ratio', type=float, default=float(os.environ.get("LEXICAL_DECISIVE_RATIO", "1.5")),
+                        help='Top-1 / top-2 BM25 score ratio required to call a match decisive')
+    args = parser.parse_args()
+
+    index = build_index()
+    with open(GROUND_TRUTH_PATH) as f:
+        cases = json.load(f)["test_cases"]
+
+    print(f"\n--- BM25 fast path on {len(cases)} ground-truth questions (ratio ≥ {args.ratio}) ---")
+    decisive_count = 0
+    decisive_correct = 0
+    top5_correct = 0
+    for tc in cases:
+        hits = index.search(tc["question"], tc["protocol"], k=10)
+        decisive = BM25Index.is_decisive(hits, min_ratio=args.ratio)
+        correct = bool(hits) and tc["expected_source"].lower() in hits[0]["metadata"]["source"].lower()
+        in_top5 = any(tc["expected_source"].lower() in h["metadata"]["source"].lower() for h in hits[:5])
+        decisive_count += decisive
+        decisive_correct += decisive and correct
+        top5_correct += in_top5
+        marker = "⚡" if decisive else "  "
+        print(f"  {marker} [{tc['id']:>2}] {tc['category']:<18} {tc['question'][:55]:<55} "
+              f"{'✅' if correct else '❌'}")
+
+    print(f"\nEmbedding skipped:     {decisive_count}/{len(cases)} ({decisive_count / len(cases):.0%})")
+    if decisive_count:
+        print(f"Skipped and correct:   {decisive_correct}/{decisive_count}")
+    print(f"Expected source @5:    {top5_correct}/{len(cases)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+Recall@k, latency and size of the quantized on-disk index formats against
+exact float32 search, on the ground_truth.json questions. Sizes are the
+vector files on disk per chunk, re-scoring rows included for "+rescore".
+
+Against a real (ada-002) index:
+    python scripts/benchmark_quantization.py --index index/documents.npz
+
+Without API keys, `--offline` embeds the chunks of data/ and the questions with
+LSA (TF-IDF + SVD, lifted to 1536 dimensions) and grows the corpus to `--scale`
+chunks with noisy copies of the real ones, so the questions have close
+distractors:
+    python scripts/benchmark_quantization.py --offline [--scale 20000]
+
+or a fully synthetic corpus with questions drawn near existing chunks:
+    python scripts/benchmark_quantization.py --synthetic 20000
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+from datetime import datetime
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vector_index import VectorIndex, QuantizedIndex
+from lexical import tokenize
+from benchmark_lexical import load_chunks
+
+# Load environment variables
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUND_TRUTH_PATH = os.path.join(BACKEND_DIR, "evaluation", "ground_truth.json")
+RESULTS_PATH = os.path.join(BACKEND_DIR, "evaluation", "quantization_results.json")
+K_VALUES = [1, 3, 5, 10]
+
+
+def ground_truth_queries(index: VectorIndex):
+    """Embeds the ground_truth.json questions; returns [(protocol, vector)]."""
+    from langchain_openai import OpenAIEmbeddings
+
+    with open(GROUND_TRUTH_PATH) as f:
+        cases = json.load(f)["test_cases"]
+    vectors = OpenAIEmbeddings(model="text-embedding-ada-002").embed_documents([c["question"] for c in cases])
+    return [(c["protocol"], v) for c, v in zip(cases, vectors) if c["protocol"] in index.partitions]
+
+
+def offline_ground_truth(dim: int = 1536, components: int = 100, seed: int = 0):
+    """The data/ chunks and ground_truth.json questions as LSA vectors; returns (index, [(protocol, vector)]).
+
+    LSA only stands in for ada-002 where no API key is available: its vectors
+    are dense like ada-002's, but their similarities are not ada-002's.
+    """
+    chunks = load_chunks()
+    with open(GROUND_TRUTH_PATH) as f:
+        cases = json.load(f)["test_cases"]
+    terms = sorted({t for c in chunks for t in tokenize(c["text"])})
+    column = {t: i for i, t in enumerate(terms)}
+
+    def tf(texts):
+        counts = np.zeros((len(texts), len(terms)), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for term in tokenize(text):
+                if term in column:
+                    counts[row, column[term]] += 1
+        return np.log1p(counts)
+
+    docs = tf([c["text"] for c in chunks])
+    idf = np.log((1 + len(chunks)) / (1 + (docs > 0).sum(axis=0))) + 1
+    _, _, vt = np.linalg.svd(docs * idf, full_matrices=False)
+    rng = np.random.default_rng(seed)
+    basis = vt[:components].T @ np.linalg.qr(rng.normal(size=(dim, components)))[0].T
+
+    def embed(texts):
+        return (tf(texts) * idf) @ basis
+
+    index = VectorIndex.from_chunks(chunks, embed([c["text"] for c in chunks]))
+    vectors = embed([c["question"] for c in cases])
+    return index, [(c["protocol"], v) for c, v in zip(cases, vectors) if c["protocol"] in index.partitions]
+
+
+def scale_corpus(index: VectorIndex, n: int, noise: float = 0.6, seed: int = 0) -> VectorIndex:
+    """Grows `index` to n chunks with noisy copies of its own chunks, each in its source's protocol."""
+    if n <= len(index):
+        return index
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(index), n - len(index))
+    copies = index.matrix[rows] + rng.normal(scale=noise / np.sqrt(index.dim),
+                                             size=(len(rows), index.dim)).astype(np.float32)
+    records = index.records + [{"id": f"copy-{i}", "content": "", "metadata": index.records[row]["metadata"]}
+                               for i, row in enumerate(rows)]
+    return VectorIndex(np.vstack([index.matrix, copies]), records)
+
+
+def synthetic_corpus(n: int, dim: int = 1536, n_queries: int = 50, seed: int = 0):
+    """Clustered random corpus over three protocols, with queries perturbed from random chunks."""
+    rng = np.random.default_rng(seed)
+    protocols = ["aave", "compound", "uniswap"]
+    centers = rng.normal(size=(64, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, 64, n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+    records = [{"id": i, "content": "", "metadata": {"protocol": protocols[i % 3], "source": "synthetic", "page": i}}
+               for i in range(n)]
+    index = VectorIndex(vectors, records)
+
+    queries = []
+    for row in rng.integers(0, n, n_queries):
+        protocol = index.records[row]["metadata"]["protocol"]
+        queries.append((protocol, index.matrix[row] + 0.3 * rng.normal(size=dim).astype(np.float32) / np.sqrt(dim)))
+    return index, queries
+
+
+def recall_at_k(index, queries, exact, k: int, **search_kwargs) -> float:
+    hits = 0
+    for (protocol, vector), truth in zip(queries, exact):
+        found = {r["id"] for r in index.search(vector, protocol, k, **search_kwargs)}
+        hits += len(found & set(truth[:k]))
+    return hits / (k * len(queries))
+
+
+def mean_latency_ms(index, queries, k: int, repeat: int = 5, **search_kwargs) -> float:
+    for protocol, vector in queries[:3]:
+        index.search(vector, protocol, k, **search_kwargs)  # page in the mapped files
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for protocol, vector in queries:
+            index.search(vector, protocol, k, **search_kwargs)
+    return (time.perf_counter() - start) / (repeat * len(queries)) * 1000
+
+
+def file_bytes(directory: str, *names) -> int:
+    """Size of the .npy files, header included, that exist in `directory`."""
+    return sum(os.path.getsize(os.path.join(directory, n)) for n in names
+               if os.path.exists(os.path.join(directory, n)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure recall@k of quantized indexes vs float32')
+    parser.add_argument('--index', default=os.environ.get("VECTOR_INDEX_PATH"),
+                        help='float32 index (.npz or .json/.jsonl export) built from the real corpus')
+    parser.add_argument('--offline', action='store_true',
+                        help='Use the data/ chunks and ground-truth questions embedded with LSA (no API keys)')
+    parser.add_argument('--scale', type=int, default=20000, help='Corpus size for --offline')
+    parser.add_argument('--synthetic', type=int, help='Use a synthetic corpus of this many chunks instead')
+    parser.add_argument('--out', default=RESULTS_PATH, help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    if args.offline:
+        base, queries = offline_ground_truth()
+        index = scale_corpus(base, args.scale)
+        source = f"data/ chunks ({len(base)}) scaled to {len(index)} + ground_truth.json, LSA embeddings"
+    elif args.synthetic:
+        index, queries = synthetic_corpus(args.synthetic)
+        source = f"synthetic ({args.synthetic} chunks)"
+    elif args.index:
+        index = VectorIndex.load(args.index) if args.index.endswith(".npz") else VectorIndex.from_export(args.index)
+        queries = ground_truth_queries(index)
+        source = f"{args.index} + ground_truth.json"
+    else:
+        print("Error: pass --index (or set VECTOR_INDEX_PATH), --offline or --synthetic N")
+        sys.exit(1)
+
+    print(f"\n--- Quantization benchmark: {source}, {len(queries)} queries ---")
+    max_k = max(K_VALUES)
+    exact = [[r["id"] for r in index.search(v, p, max_k)] for p, v in queries]
+
+    float32_bytes = index.dim * 4
+    results = {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "source": source,
+        "chunks": len(index),
+        "dim": index.dim,
+        "queries": len(queries),
+        "formats": {
+            "float32": {
+                "bytes_per_vector": float32_bytes,
+                "size_vs_float32": 1.0,
+                "latency_ms": round(mean_latency_ms(index, queries, 5), 3),
+            }
+        },
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for dtype in QuantizedIndex.DTYPES:
+            directory = os.path.join(tmp, dtype)
+            quantized = QuantizedIndex.build(index, directory, dtype=dtype)
+            vector_bytes = file_bytes(directory, "vectors.npy", "scales.npy")
+            rescore_bytes = file_bytes(directory, "rescore.npy")
+            # float16 directories have no re-scoring rows: they would re-score to the same values
+            for rescore in ((False, True) if rescore_bytes else (False,)):
+                name = f"{dtype}{'+rescore' if rescore else ''}"
+                bytes_per_vector = round((vector_bytes + (rescore_bytes if rescore else 0)) / len(index))
+                results["formats"][name] = {
+                    "bytes_per_vector": bytes_per_vector,
+                    "size_vs_float32": round(bytes_per_vector / float32_bytes, 3),
+                    "latency_ms": round(mean_latency_ms(quantized, queries, 5, rescore=rescore), 3),
+                    "recall": {f"@{k}": round(recall_at_k(quantized, queries, exact, k, rescore=rescore), 4)
+                               for k in K_VALUES},
+                }
+
+    print(f"{'format':<18}{'bytes/vec':>10}{'vs f32':>8}{'ms/query':>10}  " + "  ".join(f"R@{k:<4}" for k in K_VALUES))
+    for name, entry in results["formats"].items():
+        recall = entry.get("recall", {f"@{k}": 1.0 for k in K_VALUES})
+        print(f"{name:<18}{entry['bytes_per_vector']:>10}{entry['size_vs_float32']:>8.2f}{entry['latency_ms']:>10.3f}  "
+              + "  ".join(f"{recall[f'@{k}']:.3f} " for k in K_VALUES))
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n📄 Results saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,404 @@
+"""
+Retrieval latency, throughput, memory and recall@k as the corpus grows.
+
+Each scale is built around a base corpus: every base chunk is kept, and the rest
+are synthetic chunks, each a noisy copy of a random base chunk. Part of them stay
+in the base chunk's protocol (close distractors for the real questions) and the
+rest go to new synthetic protocols (more protocols on the same deployment).
+Corpora are written to disk block by block in the QuantizedIndex layout, so
+million-chunk scales never have to fit in RAM.
+
+Backends per scale:
+    float32            in-RAM VectorIndex (skipped above --max-ram-gb)
+    float16, int8      memory-mapped QuantizedIndex, int8 with and without float16 re-scoring
+    supabase           match_documents RPC on the live table (base scale only, --supabase)
+
+Recall@k is measured against brute-force float32 search over the same corpus.
+
+The queries are always the ground_truth.json questions. With --index they are
+embedded with ada-002 (or read from an evaluation fixture). Without it, the
+base corpus is the chunks of data/, and chunks and questions are embedded
+offline with LSA (benchmark_quantization.offline_ground_truth). LSA vectors
+are dense like ada-002's, but their recall figures are not ada-002's.
+
+    python scripts/benchmark_retrieval.py --index index/documents.npz [--fixture evaluation/fixtures/eval.json]
+    python scripts/benchmark_retrieval.py --scales 10000,100000,1000000      # offline, LSA-embedded data/
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, List
+
+import numpy as np
+from dotenv import load_dotenv
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vector_index import VectorIndex, QuantizedIndex
+from benchmark_quantization import offline_ground_truth
+
+# Load environment variables
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GROUND_TRUTH_PATH = os.path.join(BACKEND_DIR, "evaluation", "ground_truth.json")
+RESULTS_PATH = os.path.join(BACKEND_DIR, "evaluation", "retrieval_benchmark_results.json")
+HISTORY_PATH = os.path.join(BACKEND_DIR, "evaluation", "retrieval_benchmark_history.jsonl")
+K_VALUES = [1, 5, 10]
+LATENCY_K = 5
+BLOCK_ROWS = 50_000
+
+
+def ground_truth_queries(index: VectorIndex, fixture_path: str = None):
+    """Embeds the ground_truth.json questions (from a recorded evaluation fixture if given)."""
+    with open(GROUND_TRUTH_PATH) as f:
+        cases = [c for c in json.load(f)["test_cases"] if c["protocol"] in index.partitions]
+    if fixture_path:
+        from evaluation.fixtures import ProviderFixture, RecordedEmbeddings
+        embeddings = RecordedEmbeddings(ProviderFixture(fixture_path, replay=True))
+        vectors = [embeddings.embed_query(c["question"]) for c in cases]
+    else:
+        from langchain_openai import OpenAIEmbeddings
+        vectors = OpenAIEmbeddings(model="text-embedding-ada-002").embed_documents([c["question"] for c in cases])
+    return [(c["protocol"], np.asarray(v, dtype=np.float32)) for c, v in zip(cases, vectors)]
+
+
+def rss_mb() -> float:
+    """Current resident set size (peak RSS where /proc is unavailable)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def partition_counts(base: VectorIndex, n: int, real_share: float, new_protocols: int):
+    """Rows per protocol at scale n: base rows + their share of the synthetic rows."""
+    extra = max(n - len(base), 0)
+    to_real = int(extra * real_share) if new_protocols else extra
+    counts = {}
+    for protocol, (start, end) in base.partitions.items():
+        counts[protocol] = {"base": (start, end), "synthetic": to_real * (end - start) // len(base)}
+    to_new = extra - sum(c["synthetic"] for c in counts.values())
+    for i in range(new_protocols):
+        counts[f"synthetic-{i:02d}"] = {"base": (0, 0), "synthetic": to_new // new_protocols
+                                        + (1 if i < to_new % new_protocols else 0)}
+    return {p: counts[p] for p in sorted(counts)}
+
+
+def build_scaled_corpus(base: VectorIndex, n: int, path: str, real_share: float, new_protocols: int,
+                        noise: float, seed: int = 0):
+    """Writes an n-chunk corpus as QuantizedIndex directories `path`/float16 and `path`/int8.
+
+    The float32 `full.npy` (brute-force ground truth) stays in `path`. Both
+    directories share one records.jsonl, and the float16 vectors double as the
+    int8 directory's re-scoring rows; shared files are hard-linked.
+    """
+    rng = np.random.default_rng(seed)
+    counts = partition_counts(base, n, real_share, new_protocols)
+    total = sum(c["base"][1] - c["base"][0] + c["synthetic"] for c in counts.values())
+    dim = base.dim
+    os.makedirs(path, exist_ok=True)
+    full = np.lib.format.open_memmap(os.path.join(path, "full.npy"), mode="w+", dtype=np.float32,
+                                     shape=(total, dim))
+    half = np.lib.format.open_memmap(os.path.join(path, "float16.npy"), mode="w+", dtype=np.float16,
+                                     shape=(total, dim))
+    int8 = np.lib.format.open_memmap(os.path.join(path, "int8.npy"), mode="w+", dtype=np.int8, shape=(total, dim))
+    scales = np.empty(total, dtype=np.float32)
+
+    def write(row: int, block: np.ndarray):
+        end = row + len(block)
+        full[row:end] = block
+        half[row:end] = block.astype(np.float16)
+        block_scales = np.abs(block).max(axis=1) / 127.0
+        block_scales[block_scales == 0] = 1.0
+        int8[row:end] = np.clip(np.rint(block / block_scales[:, None]), -127, 127).astype(np.int8)
+        scales[row:end] = block_scales
+
+    partitions, row = {}, 0
+    with open(os.path.join(path, "records.jsonl"), "w") as records:
+        for protocol, count in counts.items():
+            start = row
+            base_start, base_end = count["base"]
+            if base_end > base_start:
+                write(row, base.matrix[base_start:base_end])
+                for record in base.records[base_start:base_end]:
+                    records.write(json.dumps(record) + "\n")
+                row += base_end - base_start
+            # Same-protocol copies for real protocols, copies of any chunk for new ones
+            pool = (base_start, base_end) if base_end > base_start else (0, len(base))
+            for block_start in range(0, count["synthetic"], BLOCK_ROWS):
+                size = min(BLOCK_ROWS, count["synthetic"] - block_start)
+                block = base.matrix[rng.integers(pool[0], pool[1], size)]
+                block = block + rng.normal(scale=noise / np.sqrt(dim), size=(size, dim)).astype(np.float32)
+                block /= np.linalg.norm(block, axis=1, keepdims=True)
+                write(row, block)
+                for i in range(size):
+                    records.write(json.dumps({"id": f"syn-{row + i}", "content": "", "metadata": {
+                        "protocol": protocol, "source": "synthetic", "page": row + i}}) + "\n")
+                row += size
+            partitions[protocol] = (start, row)
+    for matrix in (full, half, int8):
+        matrix.flush()
+    del full, half, int8
+
+    for dtype in QuantizedIndex.DTYPES:
+        directory = os.path.join(path, dtype)
+        os.makedirs(directory, exist_ok=True)
+        os.link(os.path.join(path, f"{dtype}.npy"), os.path.join(directory, "vectors.npy"))
+        os.link(os.path.join(path, "records.jsonl"), os.path.join(directory, "records.jsonl"))
+        if dtype == "int8":
+            np.save(os.path.join(directory, "scales.npy"), scales)
+            os.link(os.path.join(path, "float16.npy"), os.path.join(directory, "rescore.npy"))
+        with open(os.path.join(directory, "meta.json"), "w") as f:
+            json.dump({"format_version": 1, "dtype": dtype, "dim": dim, "count": total, "partitions": partitions,
+                       "rescore_dtype": "float16" if dtype == "int8" else None}, f, indent=2)
+    return total, partitions
+
+
+def brute_force(full: np.ndarray, partitions, queries, k: int):
+    """Exact float32 top-k row numbers per query, scanning the memory-mapped matrix in blocks."""
+    truth = []
+    for protocol, vector in queries:
+        start, end = partitions[protocol]
+        query = vector / (np.linalg.norm(vector) or 1.0)
+        scores = np.empty(end - start, dtype=np.float32)
+        for block in range(start, end, BLOCK_ROWS):
+            stop = min(block + BLOCK_ROWS, end)
+            scores[block - start:stop - start] = full[block:stop] @ query
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        truth.append(start + top[np.argsort(-scores[top], kind="stable")])
+    return truth
+
+
+def latency_summary(samples, partitions) -> Dict[str, Any]:
+    """Every latency figure and QPS from one list of timed (protocol, seconds) samples.
+
+    The questions hit protocols of different sizes, so the samples are a mix of
+    fast and slow scans and the mean can fall on either side of p50; the p50 of
+    each question protocol is reported next to its row count to show the mix.
+    """
+    ms = np.asarray([seconds for _, seconds in samples]) * 1000
+    p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+    by_protocol = {}
+    for protocol in sorted({p for p, _ in samples}):
+        protocol_ms = np.asarray([seconds for p, seconds in samples if p == protocol]) * 1000
+        start, end = partitions[protocol]
+        by_protocol[protocol] = {"rows": end - start, "p50_ms": round(float(np.median(protocol_ms)), 3)}
+    return {
+        "latency_ms": {"p50": round(float(p50), 3), "p95": round(float(p95), 3), "p99": round(float(p99), 3),
+                       "mean": round(float(ms.mean()), 3), "min": round(float(ms.min()), 3),
+                       "max": round(float(ms.max()), 3), "samples": len(ms)},
+        "by_protocol": by_protocol,
+        "qps": round(1000 / float(ms.mean()), 1),
+    }
+
+
+def check_latency(result: Dict[str, Any], samples: int) -> List[str]:
+    """Consistency problems in a latency_summary result (empty if none)."""
+    latency = result["latency_ms"]
+    problems = []
+    if latency["samples"] != samples:
+        problems.append(f"{latency['samples']} latency samples, expected {samples}")
+    if not latency["min"] <= latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"]:
+        problems.append(f"percentiles out of order: {latency}")
+    if not latency["min"] <= latency["mean"] <= latency["max"]:
+        problems.append(f"mean outside the sample range: {latency}")
+    # QPS is rounded to 0.1 and the mean to 0.001 ms
+    if abs(result["qps"] - 1000 / latency["mean"]) > 0.05 + 1000 / latency["mean"] * 0.001:
+        problems.append(f"QPS {result['qps']} does not match the mean latency {latency['mean']} ms")
+    return problems
+
+
+def measure(search, queries, truth_ids, repeat: int, partitions):
+    """Latency and QPS at k=LATENCY_K from repeat * len(queries) timed searches, and recall@k for
+    every K_VALUES entry. The warm-up and recall searches are not timed."""
+    for protocol, vector in queries[:3]:
+        search(vector, protocol, LATENCY_K)  # warm caches / page in the mapped files
+    samples = []
+    for _ in range(repeat):
+        for protocol, vector in queries:
+            start = time.perf_counter()
+            search(vector, protocol, LATENCY_K)
+            samples.append((protocol, time.perf_counter() - start))
+    recall = {}
+    for k in K_VALUES:
+        hits = sum(len({r["id"] for r in search(vector, protocol, k)} & set(truth[:k]))
+                   for (protocol, vector), truth in zip(queries, truth_ids))
+        recall[f"@{k}"] = round(hits / (k * len(queries)), 4)
+    result = latency_summary(samples, partitions)
+    result["recall"] = recall
+    problems = check_latency(result, repeat * len(queries))
+    if problems:
+        raise RuntimeError("inconsistent latency statistics: " + "; ".join(problems))
+    return result
+
+
+def file_bytes(*paths) -> int:
+    return sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+
+
+def run_scale(base: VectorIndex, queries, n: int, args, work_dir: str):
+    path = os.path.join(work_dir, f"scale-{n}")
+    start = time.perf_counter()
+    total, partitions = build_scaled_corpus(base, n, path, args.real_share, args.new_protocols, args.noise)
+    build_s = time.perf_counter() - start
+    full = np.load(os.path.join(path, "full.npy"), mmap_mode="r")
+    with open(os.path.join(path, "records.jsonl")) as f:
+        ids = [json.loads(line)["id"] for line in f]
+    # Backends return records in file order, so truth row numbers map straight to ids
+    truth_ids = [[ids[row] for row in rows] for rows in brute_force(full, partitions, queries, max(K_VALUES))]
+    largest = max(end - start for start, end in partitions.values())
+    print(f"\n[{total:,} chunks, {len(partitions)} protocols, largest partition {largest:,}] "
+          f"built in {build_s:.1f}s")
+
+    entry = {"chunks": total, "protocols": len(partitions), "largest_partition": largest,
+             "build_s": round(build_s, 2), "backends": {}}
+    backends = {}
+
+    if "float32" in args.backends:
+        if total * base.dim * 4 / 1e9 <= args.max_ram_gb:
+            def load_float32():
+                with open(os.path.join(path, "records.jsonl")) as f:
+                    rows = [json.loads(line) for line in f]
+                return VectorIndex(np.asarray(full), rows), {"vector_bytes": total * base.dim * 4}
+            backends["float32"] = (load_float32, lambda index: index.search)
+        else:
+            entry["backends"]["float32"] = {"skipped": f"needs more than --max-ram-gb {args.max_ram_gb}"}
+
+    for dtype in QuantizedIndex.DTYPES:
+        directory = os.path.join(path, dtype)
+        def load_quantized(directory=directory):
+            index = QuantizedIndex(directory)
+            return index, {"vector_bytes": file_bytes(os.path.join(directory, "vectors.npy"),
+                                                      os.path.join(directory, "scales.npy")),
+                           "rescore_bytes": file_bytes(os.path.join(directory, "rescore.npy"))}
+        for rescore in ((False, True) if dtype == "int8" else (False,)):
+            name = f"{dtype}{'+rescore' if rescore else ''}"
+            if name in args.backends:
+                backends[name] = (load_quantized, lambda index, rescore=rescore:
+                                  lambda vector, protocol, k: index.search(vector, protocol, k, rescore=rescore))
+
+    for name, (load, make_search) in backends.items():
+        rss_before = rss_mb()
+        index, memory = load()
+        result = measure(make_search(index), queries, truth_ids, args.repeat, partitions)
+        memory["rss_delta_mb"] = round(rss_mb() - rss_before, 1)
+        result["memory"] = memory
+        entry["backends"][name] = result
+        del index
+
+    if not args.keep:
+        shutil.rmtree(path)
+    return entry
+
+
+def run_supabase(base: VectorIndex, queries, repeat: int):
+    """match_documents on the live table; recall is against brute force over the --index export."""
+    from supabase.client import create_client
+    from retrievers import SupabaseRetriever
+
+    retriever = SupabaseRetriever(create_client(os.environ["SUPABASE_URL"], os.environ["SUPABASE_KEY"]))
+    truth_ids = [[r["id"] for r in base.search(vector, protocol, max(K_VALUES))] for protocol, vector in queries]
+    return measure(lambda vector, protocol, k: retriever.search(vector.tolist(), protocol, k),
+                   queries, truth_ids, repeat, base.partitions)
+
+
+def print_table(results):
+    print(f"\n{'chunks':>10} {'backend':<16}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'QPS':>9}{'RSS MB':>9}  "
+          + "  ".join(f"R@{k:<4}" for k in K_VALUES))
+    for scale in results["scales"].values():
+        for name, run in scale["backends"].items():
+            if "skipped" in run:
+                print(f"{scale['chunks']:>10,} {name:<16}skipped ({run['skipped']})")
+                continue
+            latency = run["latency_ms"]
+            print(f"{scale['chunks']:>10,} {name:<16}{latency['p50']:>9.2f}{latency['p95']:>9.2f}"
+                  f"{latency['p99']:>9.2f}{run['qps']:>9.1f}{run['memory'].get('rss_delta_mb', 0):>9.1f}  "
+                  + "  ".join(f"{run['recall'][f'@{k}']:.3f} " for k in K_VALUES))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark retrieval backends on synthetically scaled corpora')
+    parser.add_argument('--index', default=os.environ.get("VECTOR_INDEX_PATH"),
+                        help='Base corpus: .npz index or .json/.jsonl export of the documents table')
+    parser.add_argument('--fixture', help='Evaluation fixture (evaluate.py --record) holding the question '
+                                          'embeddings, so real questions need no API call')
+    parser.add_argument('--scales', default="10000,100000,1000000", help='Comma-separated corpus sizes')
+    parser.add_argument('--backends', default="float32,float16,int8,int8+rescore",
+                        help='Comma-separated local backends to run')
+    parser.add_argument('--supabase', action='store_true',
+                        help='Also time match_documents on the live table (base corpus scale)')
+    parser.add_argument('--real-share', type=float, default=0.5,
+                        help='Fraction of synthetic chunks added to the existing protocols')
+    parser.add_argument('--new-protocols', type=int, default=20, help='Synthetic protocols for the other chunks')
+    parser.add_argument('--noise', type=float, default=0.6, help='Norm of the noise added to copied chunks')
+    parser.add_argument('--repeat', type=int, default=5, help='Passes over the queries for latency samples')
+    parser.add_argument('--max-ram-gb', type=float, default=2.0, help='Largest float32 matrix to load into RAM')
+    parser.add_argument('--work-dir', help='Where scaled corpora are written (default: a temporary directory)')
+    parser.add_argument('--keep', action='store_true', help='Keep the scaled corpora on disk')
+    parser.add_argument('--out', default=RESULTS_PATH, help='Where to write the JSON results')
+    parser.add_argument('--history', default=HISTORY_PATH, help='JSON-lines file every run is appended to')
+    args = parser.parse_args()
+    args.backends = [b.strip() for b in args.backends.split(",") if b.strip()]
+
+    if args.index:
+        base = VectorIndex.load(args.index) if args.index.endswith(".npz") else VectorIndex.from_export(args.index)
+        queries = ground_truth_queries(base, args.fixture)
+        source = f"{args.index} + ground_truth.json"
+    else:
+        base, queries = offline_ground_truth()
+        queries = [(p, np.asarray(v, dtype=np.float32)) for p, v in queries]
+        source = f"data/ chunks ({len(base)}) + ground_truth.json, LSA embeddings"
+
+    print(f"\n--- Retrieval benchmark: {source}, {len(queries)} queries ---")
+    results = {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "source": source,
+        "base_chunks": len(base),
+        "dim": base.dim,
+        "queries": len(queries),
+        "latency_k": LATENCY_K,
+        "config": {"real_share": args.real_share, "new_protocols": args.new_protocols, "noise": args.noise,
+                   "repeat": args.repeat},
+        "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                        "machine": platform.machine(), "cpus": os.cpu_count()},
+        "scales": {},
+    }
+
+    if args.supabase:
+        results["supabase"] = run_supabase(base, queries, args.repeat)
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="retrieval-benchmark-")
+    try:
+        for n in sorted(int(s) for s in args.scales.split(",")):
+            results["scales"][str(n)] = run_scale(base, queries, n, args, work_dir)
+            print_table({"scales": {str(n): results["scales"][str(n)]}})
+    finally:
+        if not args.work_dir and not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print_table(results)
+    if "supabase" in results:
+        run = results["supabase"]
+        print(f"\nSupabase match_documents ({len(base):,} chunks): p50 {run['latency_ms']['p50']:.1f}ms, "
+              f"p95 {run['latency_ms']['p95']:.1f}ms, R@5 {run['recall']['@5']:.3f}")
+
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    with open(args.history, "a") as f:
+        f.write(json.dumps(results) + "\n")
+    print(f"\n📄 Results saved to: {args.out} (appended to {args.history})")
+
+
+if __name__ == "__main__":
+    main()
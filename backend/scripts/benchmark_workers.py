@@ -0,0 +1,316 @@
+"""
+Throughput and memory of the API as the number of uvicorn workers grows.
+
+Serves main.app with `uvicorn --workers N`. Embeddings and the LLM are stubs
+with a fixed delay, so no API keys are needed and the measured cost is this
+process's own work: retrieval over a local index, packing and serialization.
+Each worker count runs twice:
+
+    isolated   every worker loads the .npz index into its own memory and keeps private caches
+    shared     SHARED_STATE_DIR: one memory-mapped index, SQLite-backed shared caches, one warm-up
+
+A load generator then sends /api/query requests drawn from a skewed set of
+questions, so caches matter. It reports QPS, latency percentiles, the share
+of requests answered from the answer cache, and memory summed over the server
+processes: RSS (shared pages counted once per process) and PSS (shared pages
+split between them, i.e. the real footprint).
+
+QPS only says something about scaling when the host has at least as many
+CPUs as workers. Rows with more workers than CPUs are marked
+`"qps_comparable": false`, and their throughput should not be compared.
+
+    python scripts/benchmark_workers.py [--workers 1,2,4] [--chunks 50000] [--requests 600] [--concurrency 32]
+
+Worker processes import this module (benchmark_workers:app) to get the stubbed app.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import asyncio
+import hashlib
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+import numpy as np
+
+# Add backend directory to path
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BACKEND_DIR)
+
+RESULTS_PATH = os.path.join(BACKEND_DIR, "evaluation", "worker_benchmark_results.json")
+PROTOCOLS = ["aave", "compound", "uniswap"]
+DIM = 1536
+
+
+# --- Worker side: main.app with stub providers ---
+
+class HashEmbeddings:
+    """Deterministic pseudo-embedding per question text, after a fixed network delay."""
+
+    def __init__(self, delay: float):
+        self.delay = delay
+
+    def _vector(self, text: str):
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        return np.random.default_rng(seed).normal(size=DIM).astype(np.float32).tolist()
+
+    def embed_query(self, text):
+        time.sleep(self.delay)
+        return self._vector(text)
+
+    async def aembed_query(self, text):
+        await asyncio.sleep(self.delay)
+        return self._vector(text)
+
+    async def aembed_documents(self, texts):
+        await asyncio.sleep(self.delay)
+        return [self._vector(t) for t in texts]
+
+
+def stub_pipeline():
+    from langchain_core.messages import AIMessage
+    from langchain_core.runnables import RunnableLambda
+    from rag import RAGPipeline
+
+    llm_delay = float(os.environ.get("BENCH_LLM_DELAY", "0.2"))
+
+    async def fake_llm(prompt_value):
+        await asyncio.sleep(llm_delay)
+        return AIMessage(content="Stub answer [1].")
+
+    return RAGPipeline(
+        embeddings=HashEmbeddings(float(os.environ.get("BENCH_EMBED_DELAY", "0.03"))),
+        llm=RunnableLambda(lambda _: AIMessage(content="Stub answer [1]."), afunc=fake_llm),
+    )
+
+
+if os.environ.get("BENCH_WORKER"):
+    import main
+    main.create_pipeline = stub_pipeline
+    app = main.app
+
+
+# --- Driver side ---
+
+def build_corpus(n: int, path: str):
+    """Clustered random vectors over three protocols, each chunk with ~800 characters of text."""
+    from vector_index import VectorIndex
+
+    rng = np.random.default_rng(0)
+    centers = rng.normal(size=(64, DIM)).astype(np.float32)
+    vectors = centers[rng.integers(0, 64, n)]
+    vectors += 0.6 * rng.normal(size=(n, DIM)).astype(np.float32)
+    filler = "Collateral, liquidation thresholds and interest rate curves are described in this section. " * 9
+    records = [{"id": i, "content": f"Chunk {i}. {filler}",
+                "metadata": {"protocol": PROTOCOLS[i % 3], "source": f"synthetic_{i // 40}.pdf", "page": i % 40}}
+               for i in range(n)]
+    VectorIndex(vectors, records).save(path)
+
+
+def workload(n_requests: int, n_questions: int, seed: int = 0):
+    """Questions drawn with a Zipf-like skew: a few popular ones, a long tail."""
+    rng = np.random.default_rng(seed)
+    weights = 1.0 / np.arange(1, n_questions + 1)
+    picks = rng.choice(n_questions, size=n_requests, p=weights / weights.sum())
+    return [{"question": f"How does feature {q} work?", "protocol": PROTOCOLS[q % 3]} for q in picks]
+
+
+def process_tree(root: int):
+    """`root` and all its descendants (uvicorn supervisor + workers)."""
+    children = {}
+    for entry in os.listdir("/proc"):
+        if entry.isdigit():
+            try:
+                with open(f"/proc/{entry}/stat") as f:
+                    ppid = int(f.read().rsplit(")", 1)[1].split()[1])
+                children.setdefault(ppid, []).append(int(entry))
+            except (OSError, ValueError, IndexError):
+                continue
+    pids, stack = [], [root]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack += children.get(pid, [])
+    return pids
+
+
+def memory_mb(pids):
+    """Summed RSS and PSS (from /proc/<pid>/smaps_rollup) in MB."""
+    total = {"rss_mb": 0.0, "pss_mb": 0.0}
+    for pid in pids:
+        try:
+            with open(f"/proc/{pid}/smaps_rollup") as f:
+                for line in f:
+                    field, value = line.split(":", 1)
+                    if field in ("Rss", "Pss"):
+                        total[f"{field.lower()}_mb"] += int(value.split()[0]) / 1024
+        except OSError:
+            continue
+    return {key: round(value, 1) for key, value in total.items()}
+
+
+def start_server(workers: int, port: int, env):
+    return subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "benchmark_workers:app", "--app-dir", os.path.dirname(__file__),
+         "--port", str(port), "--workers", str(workers), "--log-level", "warning"],
+        env=env, cwd=BACKEND_DIR, start_new_session=True,
+    )
+
+
+async def wait_ready(url: str, workers: int, timeout: float):
+    """Polls /health on fresh connections until `workers` distinct worker pids report ready."""
+    import httpx
+
+    ready, start = set(), time.perf_counter()
+    while len(ready) < workers:
+        if time.perf_counter() - start > timeout:
+            raise TimeoutError(f"only {len(ready)}/{workers} workers ready after {timeout:.0f}s")
+        try:
+            async with httpx.AsyncClient() as client:
+                health = (await client.get(f"{url}/health", timeout=2)).json()
+            if health.get("pipeline_ready"):
+                ready.add(health["pid"])
+        except Exception:
+            await asyncio.sleep(0.2)
+    return time.perf_counter() - start
+
+
+async def run_load(url: str, items, concurrency: int):
+    import httpx
+
+    latencies, outcomes = [], {"ok": 0, "error": 0, "cache": 0, "coalesced": 0}
+    semaphore = asyncio.Semaphore(concurrency)
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as client:
+        async def one(item):
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    response = await client.post(f"{url}/api/query", json=item)
+                    response.raise_for_status()
+                    meta = response.json()["metadata"]
+                    outcomes["ok"] += 1
+                    outcomes["cache"] += meta.get("retrieval") == "cache"
+                    outcomes["coalesced"] += bool(meta.get("coalesced"))
+                except Exception:
+                    outcomes["error"] += 1
+                latencies.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(one(item) for item in items))
+        elapsed = time.perf_counter() - start
+
+    ms = np.array(latencies) * 1000
+    return {
+        "qps": round(len(items) / elapsed, 1),
+        "p50_ms": round(float(np.percentile(ms, 50)), 1),
+        "p95_ms": round(float(np.percentile(ms, 95)), 1),
+        "p99_ms": round(float(np.percentile(ms, 99)), 1),
+        "errors": outcomes["error"],
+        "answer_cache_share": round(outcomes["cache"] / max(outcomes["ok"], 1), 3),
+        "coalesced_share": round(outcomes["coalesced"] / max(outcomes["ok"], 1), 3),
+    }
+
+
+def run_one(mode: str, workers: int, args, index_path: str, shared_dir: str, items, port: int):
+    env = {**os.environ, "BENCH_WORKER": "1", "RETRIEVER_BACKEND": "local", "VECTOR_INDEX_PATH": index_path,
+           "RETRIEVAL_MODE": "vector", "BENCH_LLM_DELAY": str(args.llm_delay),
+           "BENCH_EMBED_DELAY": str(args.embed_delay), "WARMUP": "0",
+           # Admission control is not what is measured here
+           "LLM_CONCURRENCY": "1024", "LLM_QUEUE_SIZE": "4096"}
+    for key in ("SHARED_STATE_DIR", "EMBEDDING_CACHE_PATH", "ANSWER_CACHE_PATH"):
+        env.pop(key, None)
+    if mode == "shared":
+        # Cold caches per run; the converted index is kept, as on a restart
+        for name in os.listdir(shared_dir):
+            if name.startswith(("embeddings.sqlite", "answers.sqlite", "warmup.json")):
+                os.remove(os.path.join(shared_dir, name))
+        env["SHARED_STATE_DIR"] = shared_dir
+
+    url = f"http://127.0.0.1:{port}"
+    server = start_server(workers, port, env)
+    try:
+        startup_s = asyncio.run(wait_ready(url, workers, args.startup_timeout))
+        idle = memory_mb(process_tree(server.pid))
+        load = asyncio.run(run_load(url, items, args.concurrency))
+        loaded = memory_mb(process_tree(server.pid))
+    finally:
+        os.killpg(server.pid, signal.SIGTERM)
+        server.wait(timeout=30)
+
+    row = {"mode": mode, "workers": workers, "startup_s": round(startup_s, 2), **load,
+           "idle_rss_mb": idle["rss_mb"], "idle_pss_mb": idle["pss_mb"],
+           "rss_mb": loaded["rss_mb"], "pss_mb": loaded["pss_mb"]}
+    print(f"{mode:<10}{workers:>8}{row['qps']:>8.1f}{row['p50_ms']:>9.0f}{row['p95_ms']:>9.0f}"
+          f"{row['answer_cache_share']:>8.0%}{row['rss_mb']:>10.0f}{row['pss_mb']:>10.0f}{row['startup_s']:>9.1f}")
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark throughput and memory across uvicorn worker counts')
+    parser.add_argument('--workers', default="1,2,4", help='Comma-separated worker counts')
+    parser.add_argument('--modes', default="isolated,shared", help='isolated and/or shared')
+    parser.add_argument('--chunks', type=int, default=50000, help='Synthetic corpus size (1536-dim float32)')
+    parser.add_argument('--requests', type=int, default=600, help='Requests per run')
+    parser.add_argument('--questions', type=int, default=150, help='Distinct questions in the workload')
+    parser.add_argument('--concurrency', type=int, default=32, help='Requests in flight from the load generator')
+    parser.add_argument('--llm-delay', type=float, default=0.2, help='Stub LLM latency (s)')
+    parser.add_argument('--embed-delay', type=float, default=0.03, help='Stub embedding latency (s)')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--startup-timeout', type=float, default=300)
+    parser.add_argument('--work-dir', help='Where the corpus and shared state go (default: a temporary directory)')
+    parser.add_argument('--out', default=RESULTS_PATH, help='Where to write the JSON results')
+    args = parser.parse_args()
+    worker_counts = [int(w) for w in args.workers.split(",")]
+    modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix="bench_workers_")
+    os.makedirs(work_dir, exist_ok=True)
+    index_path = os.path.join(work_dir, "documents.npz")
+    shared_dir = os.path.join(work_dir, "shared")
+    os.makedirs(shared_dir, exist_ok=True)
+    try:
+        if not os.path.exists(index_path):
+            start = time.perf_counter()
+            build_corpus(args.chunks, index_path)
+            print(f"Built {args.chunks}-chunk corpus in {time.perf_counter() - start:.1f}s "
+                  f"({os.path.getsize(index_path) / 2 ** 20:.0f} MB)")
+        items = workload(args.requests, args.questions)
+
+        print(f"\n--- Worker scaling: {args.chunks} chunks, {args.requests} requests, concurrency "
+              f"{args.concurrency}, {os.cpu_count()} CPU(s) ---")
+        print(f"{'mode':<10}{'workers':>8}{'QPS':>8}{'p50 ms':>9}{'p95 ms':>9}{'cached':>8}"
+              f"{'RSS MB':>10}{'PSS MB':>10}{'start s':>9}")
+        rows = [run_one(mode, workers, args, index_path, shared_dir, items, args.port)
+                for workers in worker_counts for mode in modes]
+        for row in rows:
+            row["qps_comparable"] = row["workers"] <= (os.cpu_count() or 1)
+        if not all(row["qps_comparable"] for row in rows):
+            print(f"⚠️ More workers than CPUs ({os.cpu_count()}): QPS does not show scaling, "
+                  f"memory figures still hold.")
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    with open(args.out, "w") as f:
+        json.dump({
+            "generated": datetime.now().isoformat(timespec="seconds"),
+            "config": {"chunks": args.chunks, "dim": DIM, "requests": args.requests, "questions": args.questions,
+                       "concurrency": args.concurrency, "llm_delay_s": args.llm_delay,
+                       "embed_delay_s": args.embed_delay},
+            "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                            "machine": platform.machine(), "cpus": os.cpu_count()},
+            "results": rows,
+        }, f, indent=2)
+    print(f"\n📄 Results saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Calibrates ANSWER_CACHE_THRESHOLD on the ground_truth.json questions.
+
+Each ground-truth question is paired with a paraphrase that should be served
+its cached answer, and with questions about a different parameter or
+mechanism of the same protocol that must not be (evaluation/
+answer_cache_pairs.json, plus every pair of distinct ground-truth questions
+for one protocol). The script reports the paraphrase hit rate and false hits
+per threshold, and recommends the lowest threshold that stays `--margin`
+above every negative pair.
+
+With OPENAI_API_KEY set it embeds with text-embedding-ada-002, the model the
+cache runs with. `--offline` uses hashed term vectors instead; they exercise
+the script without credentials but do not calibrate ada-002, whose
+similarities are compressed into roughly 0.7-1.0. Runs are stored per
+embedding model in evaluation/answer_cache_calibration.json.
+
+    python scripts/calibrate_answer_cache.py [--offline] [--margin 0.01]
+"""
+
+import os
+import sys
+import json
+import math
+import hashlib
+import argparse
+import itertools
+from datetime import datetime
+from typing import List
+
+import numpy as np
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from lexical import tokenize
+from cache import SemanticAnswerCache
+from benchmark_lexical import GROUND_TRUTH_PATH, BACKEND_DIR
+
+PAIRS_PATH = os.path.join(BACKEND_DIR, "evaluation", "answer_cache_pairs.json")
+RESULTS_PATH = os.path.join(BACKEND_DIR, "evaluation", "answer_cache_calibration.json")
+OFFLINE_MODEL = "offline-hashed-terms"
+OFFLINE_DIM = 1024
+
+
+class OfflineEmbeddings:
+    """Hashed unigram + bigram counts: a credential-free stand-in, not a model of ada-002."""
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = []
+        for text in texts:
+            terms = tokenize(text)
+            vector = np.zeros(OFFLINE_DIM, dtype=np.float32)
+            for term in terms + [" ".join(p) for p in zip(terms, terms[1:])]:
+                vector[int.from_bytes(hashlib.sha256(term.encode()).digest()[:4], "little") % OFFLINE_DIM] += 1
+            vectors.append(vector.tolist())
+        return vectors
+
+
+def load_pairs():
+    with open(GROUND_TRUTH_PATH) as f:
+        cases = {tc["id"]: tc for tc in json.load(f)["test_cases"]}
+    with open(PAIRS_PATH) as f:
+        pairs = json.load(f)
+    positives = [{"protocol": cases[p["id"]]["protocol"], "a": cases[p["id"]]["question"], "b": p["paraphrase"]}
+                 for p in pairs["paraphrases"]]
+    hard = [dict(p, hard=True) for p in pairs["negatives"]]
+    ground_truth = [{"protocol": a["protocol"], "a": a["question"], "b": b["question"], "hard": False}
+                    for a, b in itertools.combinations(cases.values(), 2) if a["protocol"] == b["protocol"]]
+    return positives, hard + ground_truth
+
+
+def similarities(embeddings, pairs) -> List[float]:
+    texts = sorted({p[side] for p in pairs for side in ("a", "b")})
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    unit = dict(zip(texts, vectors))
+    return [float(unit[p["a"]] @ unit[p["b"]]) for p in pairs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Calibrate the semantic answer cache threshold')
+    parser.add_argument('--offline', action='store_true', help='Use hashed term vectors instead of ada-002')
+    parser.add_argument('--margin', type=float, default=0.01,
+                        help='Similarity kept between the closest negative pair and the threshold')
+    parser.add_argument('--out', default=RESULTS_PATH, help='Where to write the JSON results')
+    args = parser.parse_args()
+
+    if args.offline:
+        embeddings, model = OfflineEmbeddings(), OFFLINE_MODEL
+    else:
+        from providers import Providers
+        embeddings = Providers().openai_embeddings()
+        model = embeddings.model
+
+    positives, negatives = load_pairs()
+    pos = np.array(similarities(embeddings, positives))
+    neg = np.array(similarities(embeddings, negatives))
+    hard = np.array([p["hard"] for p in negatives])
+    default = SemanticAnswerCache().threshold
+    recommended = min(1.0, math.ceil((neg.max() + args.margin) / 0.005) * 0.005)
+
+    print(f"\n--- Answer cache threshold on {len(positives)} paraphrase and {len(negatives)} negative pairs "
+          f"({model}) ---")
+    print(f"paraphrases: min {pos.min():.3f}  mean {pos.mean():.3f}")
+    print(f"negatives:   max {neg.max():.3f}  mean {neg.mean():.3f}  (hard negatives: max {neg[hard].max():.3f})")
+    print(f"{'threshold':<11}{'paraphrase hits':>17}{'false hits':>12}")
+    thresholds = sorted({round(t, 3) for t in np.arange(0.80, 1.0, 0.01)} | {default, recommended})
+    table = []
+    for t in thresholds:
+        row = {"threshold": t, "paraphrase_hit_rate": round(float((pos >= t).mean()), 3),
+               "false_hits": int((neg >= t).sum())}
+        table.append(row)
+        print(f"{t:<11.3f}{row['paraphrase_hit_rate']:>17.0%}{row['false_hits']:>12}")
+
+    closest = sorted(zip(neg, negatives), key=lambda x: -x[0])[:5]
+    print("closest negatives:")
+    for score, p in closest:
+        print(f"  {score:.3f}  {p['a']!r} / {p['b']!r}")
+    print(f"Recommended threshold: {recommended:.3f} (default {default})")
+
+    results = {}
+    if os.path.exists(args.out):
+        with open(args.out) as f:
+            results = json.load(f)
+    results.setdefault("runs", {})[model] = {
+        "generated": datetime.now().isoformat(timespec="seconds"),
+        "calibrates_default": not args.offline,
+        "pairs": {"paraphrase": len(positives), "negative": len(negatives), "hard_negative": int(hard.sum())},
+        "paraphrase_similarity": {"min": round(float(pos.min()), 4), "mean": round(float(pos.mean()), 4)},
+        "negative_similarity": {"max": round(float(neg.max()), 4), "mean": round(float(neg.mean()), 4),
+                                "hard_max": round(float(neg[hard].max()), 4)},
+        "closest_negatives": [{"similarity": round(float(s), 4), "a": p["a"], "b": p["b"]} for s, p in closest],
+        "margin": args.margin,
+        "default_threshold": default,
+        "recommended_threshold": recommended,
+        "thresholds": table,
+    }
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\n📄 Results saved to: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
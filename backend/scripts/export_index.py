@@ -0,0 +1,61 @@
+import os
+import sys
+import json
+import argparse
+from dotenv import load_dotenv
+from supabase.client import create_client, Client
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vector_index import VectorIndex, parse_embedding
+
+# Load environment variables
+load_dotenv(os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env'))
+
+
+def fetch_documents(supabase: Client, page_size: int = 500):
+    """Pages through the `documents` table, yielding rows with parsed embeddings."""
+    offset = 0
+    while True:
+        response = supabase.table("documents") \
+            .select("id, content, metadata, embedding") \
+            .order("id") \
+            .range(offset, offset + page_size - 1) \
+            .execute()
+        if not response.data:
+            return
+        for row in response.data:
+            row["embedding"] = parse_embedding(row["embedding"])
+            yield row
+        print(f"  Fetched {offset + len(response.data)} rows...")
+        offset += page_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the Supabase documents table to a local vector index')
+    parser.add_argument('--out', required=True, help='Output path (.npz index, or .jsonl raw export)')
+    args = parser.parse_args()
+
+    supabase_url = os.environ.get("SUPABASE_URL")
+    supabase_key = os.environ.get("SUPABASE_KEY")
+    if not supabase_url or not supabase_key:
+        print("Error: Missing Supabase credentials in .env file")
+        sys.exit(1)
+
+    supabase: Client = create_client(supabase_url, supabase_key)
+    rows = list(fetch_documents(supabase))
+
+    if args.out.endswith(".jsonl"):
+        with open(args.out, "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+    else:
+        index = VectorIndex.from_rows(rows)
+        index.save(args.out)
+        print(f"Protocols: {', '.join(f'{p} ({e - s})' for p, (s, e) in index.partitions.items())}")
+
+    print(f"\n✅ Exported {len(rows)} chunks to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,144 +1,602 @@
 import os
 import sys
+import json
+import time
+import uuid
+import hashlib
 import argparse
+import queue
+import resource
+import threading
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor
 import fitz  # PyMuPDF
 from dotenv import load_dotenv
-from typing import List, Dict
+from typing import List, Dict, Tuple, Iterator, Iterable
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import SupabaseVectorStore
 from supabase.client import create_client, Client
 
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from vector_index import VectorIndex
+from lexical import BM25Index
+from embedding_writer import embedding_writer_from_env
+
 # Load environment variables
 load_dotenv()
 
+def iter_pdf_pages(pdf_path: str, start_page: int = 1) -> Iterator[Dict]:
+    """Yields non-empty PDF pages one at a time, starting at `start_page` (1-based)."""
+    doc = fitz.open(pdf_path)
+    try:
+        for page_num in range(start_page - 1, doc.page_count):
+            text = doc[page_num].get_text()
+            text = " ".join(text.split())
+            # Remove null bytes that cause Postgres errors
+            text = text.replace('\x00', '')
+            if text.strip():
+                yield {
+                    "text": text,
+                    "page": page_num + 1,
+                    "source": os.path.basename(pdf_path)
+                }
+    finally:
+        doc.close()
+
+def iter_markdown_pages(md_path: str, start_page: int = 1) -> Iterator[Dict]:
+    """Yields Markdown sections (split on ## headings) one at a time without reading the whole file."""
+    def section(lines, index):
+        text = "".join(lines).strip()
+        if text and index >= start_page:
+            return {"text": text, "page": index, "source": os.path.basename(md_path)}
+
+    index, lines = 1, []
+    with open(md_path, 'r') as f:
+        for line_num, line in enumerate(f):
+            if line.startswith('## ') and line_num > 0:
+                page = section(lines, index)
+                if page:
+                    yield page
+                index, lines = index + 1, []
+            if index >= start_page:
+                lines.append(line)
+    page = section(lines, index)
+    if page:
+        yield page
+
 def extract_text_from_pdf(pdf_path: str) -> List[Dict]:
     """Extracts text from PDF page by page."""
-    doc = fitz.open(pdf_path)
-    pages = []
-    for page_num, page in enumerate(doc):
-        text = page.get_text()
-        text = " ".join(text.split())
-        # Remove null bytes that cause Postgres errors
-        text = text.replace('\x00', '')
-        if text.strip():
-            pages.append({
-                "text": text,
-                "page": page_num + 1,
-                "source": os.path.basename(pdf_path)
-            })
+    pages = list(iter_pdf_pages(pdf_path))
     print(f"  Extracted {len(pages)} pages from {pdf_path}")
     return pages
 
 def extract_text_from_markdown(md_path: str) -> List[Dict]:
     """Extracts text from a Markdown file, splitting by headings."""
-    with open(md_path, 'r') as f:
-        content = f.read()
-    
-    # Split by ## headings to create logical sections
-    sections = content.split('\n## ')
-    pages = []
-    for i, section in enumerate(sections):
-        text = section.strip()
-        if text:
-            # Re-add the ## prefix for non-first sections
-            if i > 0:
-                text = '## ' + text
-            pages.append({
-                "text": text,
-                "page": i + 1,
-                "source": os.path.basename(md_path)
-            })
+    pages = list(iter_markdown_pages(md_path))
     print(f"  Extracted {len(pages)} sections from {md_path}")
     return pages
 
-def chunk_text(pages: List[Dict], protocol: str) -> List[Dict]:
-    """Chunks text while preserving metadata."""
-    text_splitter = RecursiveCharacterTextSplitter(
+def iter_pages(file_path: str, start_page: int = 1) -> Iterator[Dict]:
+    if os.path.splitext(file_path)[1].lower() == '.pdf':
+        return iter_pdf_pages(file_path, start_page)
+    return iter_markdown_pages(file_path, start_page)
+
+def content_hash(source: str, page: int, text: str) -> str:
+    """Stable hash of a chunk's identity: source document, page and text."""
+    return hashlib.sha256(f"{source}\x1f{page}\x1f{text}".encode()).hexdigest()
+
+def chunk_row_id(chunk: Dict) -> str:
+    """Deterministic documents.id (UUID) derived from the chunk's content hash."""
+    return str(uuid.UUID(bytes=bytes.fromhex(chunk["metadata"]["content_hash"])[:16]))
+
+def make_text_splitter() -> RecursiveCharacterTextSplitter:
+    return RecursiveCharacterTextSplitter(
         chunk_size=1000,
         chunk_overlap=100,
         separators=["\n\n", "\n", " ", ""]
     )
-    
-    chunks = []
+
+def iter_chunks(pages: Iterable[Dict], protocol: str) -> Iterator[Dict]:
+    """Lazily chunks pages while preserving metadata."""
+    text_splitter = make_text_splitter()
     for page in pages:
-        page_chunks = text_splitter.split_text(page["text"])
-        for chunk in page_chunks:
-            chunks.append({
+        for chunk in text_splitter.split_text(page["text"]):
+            yield {
                 "text": chunk,
                 "metadata": {
                     "source": page["source"],
                     "page": page["page"],
-                    "protocol": protocol
+                    "protocol": protocol,
+                    "content_hash": content_hash(page["source"], page["page"], chunk)
                 }
-            })
+            }
+
+def chunk_text(pages: List[Dict], protocol: str) -> List[Dict]:
+    """Chunks text while preserving metadata."""
+    chunks = list(iter_chunks(pages, protocol))
     print(f"  Created {len(chunks)} chunks for '{protocol}'")
     return chunks
 
-def ingest_to_supabase(chunks: List[Dict]):
-    """Embeds and upserts chunks to Supabase."""
+def fetch_existing_pages(supabase: Client, protocol: str, source: str, page_size: int = 1000) -> Dict[int, set]:
+    """Returns the ids of rows already stored for one protocol's source document, grouped by page."""
+    pages: Dict[int, set] = {}
+    offset = 0
+    while True:
+        response = supabase.table("documents") \
+            .select("id, page:metadata->page") \
+            .eq("protocol", protocol) \
+            .eq("metadata->>source", source) \
+            .range(offset, offset + page_size - 1) \
+            .execute()
+        for row in response.data:
+            pages.setdefault(int(row.get("page") or 0), set()).add(row["id"])
+        if len(response.data) < page_size:
+            return pages
+        offset += page_size
+
+def fetch_existing_ids(supabase: Client, protocol: str, source: str, page_size: int = 1000) -> set:
+    """Returns the ids of rows already stored for one protocol's source document."""
+    return set().union(*fetch_existing_pages(supabase, protocol, source, page_size).values())
+
+def supabase_client() -> Client:
     supabase_url = os.environ.get("SUPABASE_URL")
     supabase_key = os.environ.get("SUPABASE_KEY")
     
     if not supabase_url or not supabase_key:
         raise ValueError("Supabase credentials missing. Check .env file.")
         
-    supabase: Client = create_client(supabase_url, supabase_key)
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
-    
-    texts = [chunk["text"] for chunk in chunks]
-    metadatas = [chunk["metadata"] for chunk in chunks]
-    
+    return create_client(supabase_url, supabase_key)
+
+def ingest_to_supabase(chunks: List[Dict]) -> Dict[str, int]:
+    """Incrementally syncs chunks to Supabase.
+
+    Rows are keyed on a hash of (source, page, text): unchanged chunks are skipped
+    without an embedding call, new ones are embedded and upserted, and rows for the
+    same protocol + source that no longer appear in the document are deleted.
+    New chunks from all documents go through one EmbeddingWriter run, so
+    token-budgeted embedding batches stay full and several are in flight at once.
+    """
+    supabase = supabase_client()
+    writer = embedding_writer_from_env(lambda rows: supabase.table("documents").upsert(rows).execute())
+
+    # Identical chunks (same source, page and text) collapse to one row
+    unique = {chunk_row_id(chunk): chunk for chunk in chunks}
+
+    documents: Dict[tuple, Dict[str, Dict]] = {}
+    for row_id, chunk in unique.items():
+        meta = chunk["metadata"]
+        documents.setdefault((meta["protocol"], meta["source"]), {})[row_id] = chunk
+
+    summary = {"added": 0, "unchanged": 0, "removed": 0, "embedded": 0, "changed_protocols": set()}
+    plans = []
+    for (protocol, source), doc_chunks in documents.items():
+        existing = fetch_existing_ids(supabase, protocol, source)
+        to_add = [(row_id, chunk) for row_id, chunk in doc_chunks.items() if row_id not in existing]
+        plans.append((protocol, source, doc_chunks, to_add, sorted(existing - doc_chunks.keys())))
+
+    stats = writer.write(item for *_, to_add, _ in plans for item in to_add)
+    summary["embedded"] = stats["rows"]
+    print(f"  Embedded {stats['rows']} chunks ({stats['tokens']:,} tokens) in {stats['embed_batches']} requests, "
+          f"inserted in {stats['insert_batches']} bulk writes")
+
     batch_size = 100
-    for i in range(0, len(texts), batch_size):
-        batch_texts = texts[i:i+batch_size]
-        batch_metadatas = metadatas[i:i+batch_size]
-        
-        SupabaseVectorStore.from_texts(
-            texts=batch_texts,
-            embedding=embeddings,
-            metadatas=batch_metadatas,
-            client=supabase,
-            table_name="documents",
-            query_name="match_documents"
-        )
-        print(f"  Uploaded batch {i//batch_size + 1}")
+    for protocol, source, doc_chunks, to_add, stale in plans:
+        for i in range(0, len(stale), batch_size):
+            supabase.table("documents").delete().in_("id", stale[i:i+batch_size]).execute()
+
+        unchanged = len(doc_chunks) - len(to_add)
+        summary["added"] += len(to_add)
+        summary["unchanged"] += unchanged
+        summary["removed"] += len(stale)
+        if to_add or stale:
+            summary["changed_protocols"].add(protocol)
+        print(f"  {source}: +{len(to_add)} added, ={unchanged} unchanged, -{len(stale)} removed")
+
+    return summary
+
+def ensure_protocol_indexes(protocols: Iterable[str]):
+    """Creates the per-protocol vector index (ensure_protocol_index in supabase_schema.sql)
+    for each protocol; protocols that already have one are left alone."""
+    supabase = supabase_client()
+    for protocol in sorted(set(protocols)):
+        try:
+            index_name = supabase.rpc("ensure_protocol_index", {"p": protocol}).execute().data
+            print(f"  Vector index for '{protocol}': {index_name}")
+        except Exception as e:
+            # Search still works without it (exact scan of the protocol's rows)
+            print(f"  ⚠️ Could not create the vector index for '{protocol}': {e}")
+            print(f"     It needs the service_role key; or run in the SQL editor: "
+                  f"SELECT ensure_protocol_index('{protocol}');")
+
+CHECKPOINT_DIR = ".ingest_checkpoints"
+_DONE = object()  # end-of-stream marker passed between pipeline stages
+
+def checkpoint_path_for(file_path: str, protocol: str, directory: str = CHECKPOINT_DIR) -> str:
+    return os.path.join(directory, f"{protocol}__{os.path.basename(file_path)}.json")
+
+def read_checkpoint(path: str, file_path: str, protocol: str) -> int:
+    """Returns the last fully uploaded page, or 0 if there is no checkpoint for this exact file."""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    stat = os.stat(file_path)
+    if (checkpoint.get("protocol"), checkpoint.get("size"), checkpoint.get("mtime")) != (protocol, stat.st_size, stat.st_mtime):
+        print(f"  Ignoring stale checkpoint {path} (file changed since it was written)")
+        return 0
+    return checkpoint["completed_page"]
+
+def write_checkpoint(path: str, file_path: str, protocol: str, page: int):
+    stat = os.stat(file_path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"file": os.path.abspath(file_path), "protocol": protocol, "size": stat.st_size,
+                   "mtime": stat.st_mtime, "completed_page": page}, f)
+    os.replace(tmp_path, path)
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> bool:
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            return q.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    return _DONE
+
+def stream_ingest_to_supabase(file_path: str, protocol: str, checkpoint_path: str, queue_size: int = 4) -> Dict:
+    """Syncs one document to Supabase through a page -> chunk -> embed -> upload pipeline.
+
+    Pages are read and chunked lazily by a producer thread and handed over through
+    a bounded queue of at most `queue_size` pages, so extraction overlaps the
+    rest. New chunks go through the same EmbeddingWriter as the normal path
+    (token-budgeted batches, several in flight, shared 429 cool-down). Once every
+    new chunk of a page and of the pages before it is stored, that page's stale
+    rows are deleted and the page is recorded in `checkpoint_path`; a rerun on the
+    same file resumes after the last completed page.
+    """
+    supabase = supabase_client()
+    source = os.path.basename(file_path)
+
+    existing = fetch_existing_pages(supabase, protocol, source)
+    resume_after = read_checkpoint(checkpoint_path, file_path, protocol)
+    if resume_after:
+        print(f"  Resuming {source} after page {resume_after}")
+        existing = {page: ids for page, ids in existing.items() if page > resume_after}
+
+    summary = {"pages": 0, "added": 0, "unchanged": 0, "removed": 0, "embedded": 0,
+               "resumed_from": resume_after, "changed_protocols": set()}
+    pages: queue.Queue = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+
+    def produce():
+        # Only this thread reads the document; everything it finds, counts included,
+        # goes through the queue as ("page", number, new (row_id, chunk) pairs,
+        # unchanged count, stale row ids), or ("error", exception).
+        try:
+            for page in iter_pages(file_path, resume_after + 1):
+                stored = existing.get(page["page"], set())
+                ids, new = set(), []
+                for chunk in iter_chunks([page], protocol):
+                    row_id = chunk_row_id(chunk)
+                    if row_id not in ids:
+                        ids.add(row_id)
+                        if row_id not in stored:
+                            new.append((row_id, chunk))
+                if not _put(pages, ("page", page["page"], new, len(ids) - len(new), stored - ids), stop):
+                    return
+        except BaseException as e:
+            _put(pages, ("error", e), stop)
+        finally:
+            _put(pages, _DONE, stop)
+
+    def delete_rows(ids):
+        ids = sorted(ids)
+        for i in range(0, len(ids), 100):
+            supabase.table("documents").delete().in_("id", ids[i:i+100]).execute()
+        summary["removed"] += len(ids)
+
+    # Pages whose chunks have all been handed to the writer, in page order, with
+    # their stale row ids; unstored counts each page's rows not yet upserted.
+    open_pages: List[Tuple[int, set]] = []
+    unstored: Dict[int, int] = {}
+
+    def finish_pages():
+        while open_pages and unstored[open_pages[0][0]] == 0:
+            page, stale = open_pages.pop(0)
+            delete_rows(stale)
+            write_checkpoint(checkpoint_path, file_path, protocol, page)
+            summary["pages"] += 1
+
+    def upload(rows):
+        supabase.table("documents").upsert(rows).execute()
+        summary["added"] += len(rows)
+        for row in rows:
+            unstored[row["metadata"]["page"]] -= 1
+        finish_pages()
+
+    seen = set()
+
+    def new_chunks():
+        # The writer pulls from this generator on the calling thread, so the
+        # summary and page bookkeeping are only touched here and in upload().
+        while True:
+            item = _get(pages, stop)
+            if item is _DONE:
+                return
+            if item[0] == "error":
+                raise item[1]
+            _, page, new, unchanged, stale = item
+            seen.add(page)
+            summary["unchanged"] += unchanged
+            unstored[page] = len(new)
+            yield from new
+            open_pages.append((page, stale))
+            finish_pages()
+
+    writer = embedding_writer_from_env(upload)
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+    try:
+        stats = writer.write(new_chunks())
+    finally:
+        stop.set()
+        producer.join()
+    summary["embedded"] = stats["rows"]
+    finish_pages()
+
+    # Pages that no longer exist in the document
+    delete_rows(set().union(*(ids for page, ids in existing.items() if page not in seen)))
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    if summary["added"] or summary["removed"]:
+        summary["changed_protocols"].add(protocol)
+    print(f"  {source}: {summary['pages']} pages, +{summary['added']} added, "
+          f"={summary['unchanged']} unchanged, -{summary['removed']} removed "
+          f"({stats['tokens']:,} tokens in {stats['embed_batches']} embedding requests)")
+    return summary
+
+def ingest_to_local_index(chunks: List[Dict], index_path: str):
+    """Embeds chunks and writes them into a local VectorIndex file (.npz).
+
+    Rows already in the file for the same protocol and source document are replaced;
+    vectors for chunks whose content hash is already in the file are reused, not re-embedded.
+    """
+    existing = VectorIndex.load(index_path) if os.path.exists(index_path) else None
+    known = {}
+    if existing is not None:
+        known = {r["metadata"].get("content_hash"): existing.matrix[i] for i, r in enumerate(existing.records)}
+
+    missing = [c for c in chunks if c["metadata"]["content_hash"] not in known]
+    if missing:
+        embeddings = OpenAIEmbeddings(model="text-embedding-ada-002")
+        vectors = embeddings.embed_documents([chunk["text"] for chunk in missing])
+        known.update((c["metadata"]["content_hash"], v) for c, v in zip(missing, vectors))
+
+    index = VectorIndex.from_chunks(chunks, [known[c["metadata"]["content_hash"]] for c in chunks])
+    if existing is not None:
+        index = existing.merge(index)
+    index.save(index_path)
+    print(f"  Wrote {len(chunks)} chunks to {index_path} ({len(index)} total, {len(missing)} embedded)")
+
+def ingest_to_bm25_index(chunks: List[Dict], index_path: str):
+    """Adds chunks to the BM25 index used by RETRIEVAL_MODE=hybrid (no embedding calls)."""
+    index = BM25Index.from_chunks(chunks)
+    if os.path.exists(index_path):
+        index = BM25Index.load(index_path).merge(index)
+    index.save(index_path)
+    print(f"  Wrote {len(chunks)} chunks to {index_path} ({len(index)} total)")
+
+def invalidate_answer_cache(api_url: str, protocol: str):
+    """Tells a running API server to drop cached answers for a re-ingested protocol.
+    Sends ADMIN_TOKEN, which must match the server's."""
+    request = urllib.request.Request(
+        f"{api_url.rstrip('/')}/api/cache/invalidate",
+        data=json.dumps({"protocol": protocol}).encode(),
+        headers={"Content-Type": "application/json", "X-Admin-Token": os.environ.get("ADMIN_TOKEN", "")},
+        method="POST"
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            removed = json.load(response).get("invalidated", 0)
+        print(f"  Invalidated {removed} cached answers for '{protocol}'")
+    except Exception as e:
+        print(f"  Warning: could not invalidate answer cache at {api_url}: {e}")
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.md', '.txt')
+
+def load_document(file_path: str, protocol: str) -> Dict:
+    """Extracts and chunks one file. Runs in a worker process in directory mode."""
+    start = time.perf_counter()
+    ext = os.path.splitext(file_path)[1].lower()
+    pages = extract_text_from_pdf(file_path) if ext == '.pdf' else extract_text_from_markdown(file_path)
+    extracted = time.perf_counter()
+    chunks = chunk_text(pages, protocol)
+    return {
+        "file": file_path,
+        "protocol": protocol,
+        "pages": len(pages),
+        "chunks": chunks,
+        "extract_s": extracted - start,
+        "chunk_s": time.perf_counter() - extracted,
+    }
+
+def infer_protocol(file_path: str, root: str) -> str:
+    """Protocol for a file in directory mode: its top-level subdirectory under `root`
+    (data/aave/*.pdf), else the filename prefix (Aave_V3_Technical_Paper.pdf -> aave)."""
+    relative = os.path.relpath(file_path, root)
+    parts = relative.split(os.sep)
+    if len(parts) > 1:
+        return parts[0].lower()
+    return os.path.basename(file_path).split('_')[0].split('-')[0].split('.')[0].lower()
+
+def discover_files(directory: str) -> List[Tuple[str, str]]:
+    files = []
+    for dirpath, _, filenames in os.walk(directory):
+        for name in sorted(filenames):
+            if name.lower().endswith(SUPPORTED_EXTENSIONS):
+                path = os.path.join(dirpath, name)
+                files.append((path, infer_protocol(path, directory)))
+    return sorted(files)
+
+def read_manifest(manifest_path: str) -> List[Tuple[str, str]]:
+    """Reads a manifest mapping files to protocols. Accepts either
+    {"path/to/file.pdf": "aave", ...} or [{"file": "...", "protocol": "..."}, ...];
+    relative paths are resolved against the manifest's directory."""
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    entries = manifest.items() if isinstance(manifest, dict) else ((e["file"], e["protocol"]) for e in manifest)
+    base = os.path.dirname(os.path.abspath(manifest_path))
+    return [(os.path.join(base, path), protocol.lower()) for path, protocol in entries]
+
+def load_documents(files: List[Tuple[str, str]], workers: int) -> List[Dict]:
+    """Extracts and chunks files in a process pool (PyMuPDF extraction is CPU-bound)."""
+    if workers <= 1 or len(files) == 1:
+        return [load_document(path, protocol) for path, protocol in files]
+    with ProcessPoolExecutor(max_workers=min(workers, len(files))) as pool:
+        return list(pool.map(load_document, *zip(*files)))
+
+def print_throughput(stage: str, count: int, unit: str, seconds: float):
+    rate = count / seconds if seconds > 0 else float('inf')
+    print(f"  {stage:<10} {count:>7} {unit:<7} in {seconds:7.2f}s  ({rate:,.1f} {unit}/sec)")
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def stream_documents(files: List[Tuple[str, str]], args):
+    """--stream mode: files are processed one after another, each through stream_ingest_to_supabase."""
+    totals = {"pages": 0, "added": 0, "unchanged": 0, "removed": 0}
+    changed_protocols = set()
+    start = time.perf_counter()
+    for file_path, protocol in files:
+        print(f"\nStreaming {os.path.basename(file_path)} to Supabase...")
+        summary = stream_ingest_to_supabase(file_path, protocol, checkpoint_path_for(file_path, protocol, args.checkpoint_dir))
+        for key in totals:
+            totals[key] += summary[key]
+        changed_protocols |= summary["changed_protocols"]
+    ensure_protocol_indexes(p for _, p in files)
+    elapsed = time.perf_counter() - start
+
+    if args.api_url:
+        for protocol in sorted(changed_protocols):
+            invalidate_answer_cache(args.api_url, protocol)
+
+    print(f"\nDiff: +{totals['added']} added, ={totals['unchanged']} unchanged, -{totals['removed']} removed")
+    print(f"\nThroughput (streaming):")
+    print_throughput("pipeline", totals["pages"], "pages", elapsed)
+    print(f"  Peak RSS: {peak_rss_mb():.0f} MB")
+    print(f"\n✅ Ingestion complete for {', '.join(sorted({p for _, p in files}))}!")
 
 def main():
     parser = argparse.ArgumentParser(description='Ingest documents into Supabase vector store')
-    parser.add_argument('--protocol', required=True, help='Protocol name (aave, compound, uniswap)')
-    parser.add_argument('--file', required=True, help='Path to the document file (PDF or MD)')
+    parser.add_argument('--protocol', help='Protocol name (aave, compound, uniswap); required with --file')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--file', help='Path to the document file (PDF or MD)')
+    source.add_argument('--dir', help='Ingest every PDF/MD/TXT under this directory; the protocol comes from '
+                                      'the subdirectory name or the filename prefix')
+    source.add_argument('--manifest', help='JSON manifest mapping files to protocols')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Processes used to extract and chunk documents (default: all cores)')
+    parser.add_argument('--api-url', default=os.environ.get("CRYPTOGUIDE_API_URL"),
+                        help='Running API server whose answer cache should be invalidated after ingest')
+    parser.add_argument('--index-out', help='Also write chunks + embeddings to a local vector index (.npz) '
+                                            'for RETRIEVER_BACKEND=local')
+    parser.add_argument('--bm25-out', help='Also add chunks to a BM25 lexical index (.json) for RETRIEVAL_MODE=hybrid')
+    parser.add_argument('--skip-supabase', action='store_true',
+                        help='Do not upload to Supabase (use with --index-out for offline builds)')
+    parser.add_argument('--stream', action='store_true',
+                        help='Upload each file page by page through a bounded extract/embed/upload pipeline '
+                             '(flat memory use, resumable after interruption)')
+    parser.add_argument('--checkpoint-dir', default=CHECKPOINT_DIR,
+                        help='Where --stream records the last uploaded page of each file')
     args = parser.parse_args()
 
-    protocol = args.protocol.lower()
-    file_path = args.file
+    if args.stream and (args.skip_supabase or args.index_out or args.bm25_out):
+        parser.error("--stream uploads to Supabase only; build local indexes without it")
+
+    if args.file:
+        if not args.protocol:
+            parser.error("--protocol is required with --file")
+        files = [(args.file, args.protocol.lower())]
+    elif args.dir:
+        files = discover_files(args.dir)
+    else:
+        files = read_manifest(args.manifest)
 
-    if not os.path.exists(file_path):
-        print(f"Error: File not found at {file_path}")
+    for file_path, _ in files:
+        if not os.path.exists(file_path):
+            print(f"Error: File not found at {file_path}")
+            sys.exit(1)
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext not in SUPPORTED_EXTENSIONS:
+            print(f"Error: Unsupported file type '{ext}'. Use .pdf, .md, or .txt")
+            sys.exit(1)
+    if not files:
+        print("Error: No documents found")
         sys.exit(1)
 
+    protocols = sorted({protocol for _, protocol in files})
     print(f"\n{'='*50}")
-    print(f"Ingesting: {os.path.basename(file_path)}")
-    print(f"Protocol: {protocol}")
+    print(f"Ingesting: {len(files)} file(s)")
+    for file_path, protocol in files:
+        print(f"  {protocol:<10} {os.path.basename(file_path)}")
     print(f"{'='*50}")
 
-    # Extract text based on file type
-    ext = os.path.splitext(file_path)[1].lower()
-    if ext == '.pdf':
-        pages = extract_text_from_pdf(file_path)
-    elif ext in ['.md', '.txt']:
-        pages = extract_text_from_markdown(file_path)
-    else:
-        print(f"Error: Unsupported file type '{ext}'. Use .pdf, .md, or .txt")
-        sys.exit(1)
+    if args.stream:
+        stream_documents(files, args)
+        return
+
+    # Extract + chunk
+    start = time.perf_counter()
+    documents = load_documents(files, args.workers)
+    load_time = time.perf_counter() - start
+    chunks = [chunk for doc in documents for chunk in doc["chunks"]]
 
-    # Chunk
-    chunks = chunk_text(pages, protocol)
-    
     # Upload
-    print(f"\nUploading {len(chunks)} chunks to Supabase...")
-    ingest_to_supabase(chunks)
-    print(f"\n✅ Ingestion complete for '{protocol}'!")
+    timings = []
+    changed_protocols = set(protocols)
+    if not args.skip_supabase:
+        print(f"\nSyncing {len(chunks)} chunks to Supabase...")
+        start = time.perf_counter()
+        summary = ingest_to_supabase(chunks)
+        timings.append(("upload", summary["added"], "chunks", time.perf_counter() - start))
+        print(f"\nDiff: +{summary['added']} added, ={summary['unchanged']} unchanged, "
+              f"-{summary['removed']} removed ({summary['embedded']} chunks embedded)")
+        changed_protocols = summary["changed_protocols"]
+        ensure_protocol_indexes(protocols)
+    if args.index_out:
+        print(f"\nBuilding local vector index...")
+        start = time.perf_counter()
+        ingest_to_local_index(chunks, args.index_out)
+        timings.append(("index", len(chunks), "chunks", time.perf_counter() - start))
+    if args.bm25_out:
+        print(f"\nBuilding BM25 index...")
+        ingest_to_bm25_index(chunks, args.bm25_out)
+    if args.api_url:
+        for protocol in sorted(changed_protocols):
+            invalidate_answer_cache(args.api_url, protocol)
+
+    # Per-stage throughput. Extract/chunk are summed per-file CPU time across workers;
+    # "wall" is the elapsed time of the whole extract+chunk stage.
+    pages = sum(doc["pages"] for doc in documents)
+    print(f"\nThroughput ({min(args.workers, len(files))} worker(s)):")
+    print_throughput("extract", pages, "pages", sum(doc["extract_s"] for doc in documents))
+    print_throughput("chunk", len(chunks), "chunks", sum(doc["chunk_s"] for doc in documents))
+    print_throughput("wall", pages, "pages", load_time)
+    for stage, count, unit, seconds in timings:
+        print_throughput(stage, count, unit, seconds)
+    print(f"  Peak RSS: {peak_rss_mb():.0f} MB")
+    print(f"\n✅ Ingestion complete for {', '.join(protocols)}!")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,171 @@
+"""
+Checks the query caches offline: the SQLite tier of the embedding cache stays
+bounded by size and age, both caches' files are read and written off the
+event loop, answer-cache lookups skip expired entries, and the default
+threshold does not serve one parameter's answer for another's.
+
+    python scripts/test_caches.py
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import sqlite3
+import tempfile
+import threading
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from cache import EmbeddingCache, CachedEmbeddings, SemanticAnswerCache, answer_cache_from_env
+from calibrate_answer_cache import OfflineEmbeddings, load_pairs, RESULTS_PATH
+
+MODEL = "stub-embedding"
+
+
+def disk_rows(path: str) -> int:
+    with sqlite3.connect(path) as db:
+        return db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+def check_embedding_disk_bounds(workdir: str):
+    print("\n--- Embedding cache file bounds ---")
+    path = os.path.join(workdir, "embeddings.sqlite3")
+
+    # Writes past max_size are cut back to the newest rows every prune_interval writes
+    cache = EmbeddingCache(max_size=50, path=path, prune_interval=10)
+    for i in range(200):
+        cache.put_vector(f"question {i}", MODEL, [float(i), 1.0])
+    rows = disk_rows(path)
+    print(f"200 writes, max_size=50, prune_interval=10: {rows} rows on disk, "
+          f"{cache.stats()['disk_pruned']} pruned")
+    assert rows <= 50 + 10, "the file should not grow past max_size plus one prune interval"
+    reopened = EmbeddingCache(max_size=50, path=path)
+    assert reopened.get_vector("question 199", MODEL) == [199.0, 1.0], "the newest rows should survive"
+    assert reopened.get_vector("question 0", MODEL) is None, "the oldest rows should be gone"
+
+    # Expired rows are deleted when the file is opened, not just skipped on read
+    with sqlite3.connect(path) as db:
+        db.execute("UPDATE embeddings SET stored_at = ? WHERE key != ?",
+                   (time.time() - 3600, EmbeddingCache.make_key("question 199", MODEL)))
+    expiring = EmbeddingCache(max_size=50, ttl=60, path=path)
+    rows = disk_rows(path)
+    print(f"Opened with ttl=60 after aging all but one row: {rows} rows left")
+    assert rows == 1 and expiring.stats()["disk_pruned"] == 49
+
+
+class StubEmbeddings:
+    model = MODEL
+
+    async def aembed_query(self, text):
+        return [float(len(text)), 1.0]
+
+    async def aembed_documents(self, texts):
+        return [[float(len(t)), 1.0] for t in texts]
+
+
+def record_threads(cache, *methods, calls=None) -> list:
+    """Wraps cache methods so each call records whether it ran on the main (event loop) thread."""
+    calls = [] if calls is None else calls
+    for name in methods:
+        method = getattr(cache, name)
+        def wrapped(*args, method=method, name=name):
+            calls.append((name, threading.current_thread() is threading.main_thread()))
+            return method(*args)
+        setattr(cache, name, wrapped)
+    return calls
+
+
+def check_embedding_offload(workdir: str):
+    print("\n--- Embedding cache file I/O off the event loop ---")
+    path = os.path.join(workdir, "offload.sqlite3")
+    EmbeddingCache(path=path).put_vector("stored earlier", MODEL, [1.0, 2.0])
+    cache = EmbeddingCache(path=path)
+    calls = record_threads(cache, "_read_rows", "_write_rows")
+    embeddings = CachedEmbeddings(StubEmbeddings(), cache)
+
+    async def run():
+        assert await embeddings.aembed_query("stored earlier") == [1.0, 2.0]
+        await embeddings.aembed_query("new question")
+        await embeddings.aembed_queries(["stored earlier", "a", "bb", "new question"])
+    asyncio.run(run())
+    print(f"file reads/writes: {[name for name, _ in calls]}, on the event loop thread: "
+          f"{sum(inline for _, inline in calls)}")
+    assert calls and not any(inline for _, inline in calls)
+    assert [name for name, _ in calls].count("_write_rows") == 2, "a batch's misses should be written together"
+    assert disk_rows(path) == 4
+
+
+def check_answer_offload(workdir: str):
+    print("\n--- Answer cache file I/O off the event loop ---")
+    path = os.path.join(workdir, "answers.sqlite3")
+    writer, reader = SemanticAnswerCache(path=path), SemanticAnswerCache(path=path)  # two worker processes
+    calls = record_threads(writer, "_sync", "_persist", "_invalidate_shared")
+    record_threads(reader, "_sync", calls=calls)
+
+    async def run():
+        assert await reader.alookup("aave", [1.0, 0.0]) is None
+        await writer.astore("aave", [1.0, 0.0], "answer", [])
+        hit = await reader.alookup("aave", [1.0, 0.01])
+        assert hit is not None and hit["answer"] == "answer", "the other worker's answer should be loaded"
+        assert await writer.ainvalidate("aave") == 1
+        assert await reader.alookup("aave", [1.0, 0.0]) is None, "the invalidation should reach the other worker"
+    asyncio.run(run())
+    print(f"file reads/writes: {[name for name, _ in calls]}, on the event loop thread: "
+          f"{sum(inline for _, inline in calls)}")
+    assert calls and not any(inline for _, inline in calls)
+
+
+def check_answer_expiry():
+    print("\n--- Answer cache expiry ---")
+    cache = SemanticAnswerCache(threshold=0.9, ttl=60)
+    cache.store("aave", [1.0, 0.0, 0.0], "stale answer", [])
+    cache.store("aave", [0.96, 0.28, 0.0], "fresh answer", [])
+    # Age the closer entry past the TTL
+    next(iter(cache._entries.values()))["stored_at"] -= 3600
+    cache._matrices.clear()
+
+    hit = cache.lookup("aave", [1.0, 0.05, 0.0])
+    print(f"Closest entry expired: {'hit ' + repr(hit['answer']) if hit else 'miss'}")
+    assert hit is not None and hit["answer"] == "fresh answer", "a valid runner-up should still hit"
+    assert len(cache._entries) == 1, "the expired entry should be dropped"
+
+
+def check_answer_threshold():
+    print("\n--- Answer cache threshold ---")
+    embeddings = OfflineEmbeddings()
+    cache = answer_cache_from_env()
+    _, negatives = load_pairs()
+    hard = [p for p in negatives if p["hard"]]
+    false_hits = 0
+    for pair in hard:
+        cache.invalidate()
+        vector_a, vector_b = embeddings.embed_documents([pair["a"], pair["b"]])
+        cache.store(pair["protocol"], vector_a, f"answer to {pair['a']}", [])
+        assert cache.lookup(pair["protocol"], vector_a) is not None, "the same question should hit"
+        false_hits += cache.lookup(pair["protocol"], vector_b) is not None
+    print(f"threshold {cache.threshold}: {false_hits} of {len(hard)} different-parameter questions served "
+          f"another's answer")
+    assert false_hits == 0
+
+    # Calibrations run with the production embedding model must not ask for a stricter threshold
+    with open(RESULTS_PATH) as f:
+        runs = json.load(f)["runs"]
+    for model, run in runs.items():
+        if run["calibrates_default"]:
+            assert cache.threshold >= run["recommended_threshold"], f"{model} calibration needs a higher default"
+
+
+def main():
+    with tempfile.TemporaryDirectory() as workdir:
+        check_embedding_disk_bounds(workdir)
+        check_embedding_offload(workdir)
+        check_answer_offload(workdir)
+    check_answer_expiry()
+    check_answer_threshold()
+    print("✅ Cache files stay bounded, expired answers are skipped and near-miss questions are not served.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import os
+import sys
+import time
+import json
+import asyncio
+import tempfile
+import threading
+from types import SimpleNamespace
+
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+from pydantic import ValidationError
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from rag import RAGPipeline
+from compare import ComparisonEngine, DOCS_PER_PROTOCOL
+from admission import LLMScheduler, Overloaded
+from providers import DeadlineExceeded, Providers
+from retrievers import LocalRetriever
+from vector_index import QuantizedIndex, load_index
+from main import BatchQueryRequest
+from lexical import reciprocal_rank_fusion
+from context import ContextPacker
+
+# Simulated provider latencies (seconds)
+EMBED_DELAY = 0.05
+RPC_DELAY = 0.05
+LLM_DELAY = 0.3
+
+
+class StubEmbeddings:
+    """Stands in for OpenAIEmbeddings with a fixed network delay."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def embed_query(self, text):
+        self.calls += 1
+        time.sleep(EMBED_DELAY)
+        return [0.0] * 1536
+
+    async def aembed_query(self, text):
+        self.calls += 1
+        await asyncio.sleep(EMBED_DELAY)
+        return [0.0] * 1536
+
+    async def aembed_documents(self, texts):
+        self.calls += 1
+        await asyncio.sleep(EMBED_DELAY)
+        return [[0.0] * 1536 for _ in texts]
+
+
+RPC_CALLS = 0
+
+
+def _stub_matches(name, params):
+    global RPC_CALLS
+    RPC_CALLS += 1
+    # match_documents_multi returns every protocol's rows, tagged with the protocol
+    multi = name == 'match_documents_multi'
+    protocols = params['protocols'] if multi else [params['filter']['protocol']]
+    if "broken" in protocols:
+        raise RuntimeError("stub retrieval failure")
+    return SimpleNamespace(data=[
+        {
+            **({'protocol': protocol} if multi else {}),
+            'content': f"{protocol} documentation chunk {i}",
+            'metadata': {'source': f"{protocol}.pdf", 'page': i + 1, 'protocol': protocol},
+            'similarity': 0.9,
+        }
+        for protocol in protocols
+        for i in range(params['match_count'])
+    ])
+
+
+class StubRPC:
+    def __init__(self, name, params):
+        self.name = name
+        self.params = params
+
+    def execute(self):
+        time.sleep(RPC_DELAY)
+        return _stub_matches(self.name, self.params)
+
+
+class StubAsyncRPC(StubRPC):
+    async def execute(self):
+        await asyncio.sleep(RPC_DELAY)
+        return _stub_matches(self.name, self.params)
+
+
+class StubSupabase:
+    def rpc(self, name, params):
+        return StubRPC(name, params)
+
+
+class StubAsyncSupabase:
+    def rpc(self, name, params):
+        return StubAsyncRPC(name, params)
+
+
+LLM_CALLS = 0
+
+
+async def _fake_llm(prompt_value):
+    global LLM_CALLS
+    LLM_CALLS += 1
+    await asyncio.sleep(LLM_DELAY)
+    return AIMessage(content="Stub answer [1].")
+
+
+def build_stub_pipeline() -> RAGPipeline:
+    return RAGPipeline(
+        supabase=StubSupabase(),
+        embeddings=StubEmbeddings(),
+        llm=RunnableLambda(lambda _: AIMessage(content="Stub answer [1]."), afunc=_fake_llm),
+        async_supabase=StubAsyncSupabase(),
+    )
+
+
+async def time_concurrent(label: str, make_call, n: int):
+    start = time.perf_counter()
+    await make_call(-1)
+    single = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(make_call(i) for i in range(n)))
+    concurrent = time.perf_counter() - start
+
+    assert all(r["answer"] for r in results)
+    print(f"{label}: 1 call {single:.2f}s | {n} concurrent calls {concurrent:.2f}s "
+          f"(serial would be ~{single * n:.2f}s)")
+    # Concurrent calls should overlap rather than serialize.
+    assert concurrent < single * 2, f"{label} calls did not run concurrently"
+
+
+async def check_coalescing(label: str, inflight, make_call, n: int):
+    """N identical requests in flight at once should cost one upstream computation."""
+    llm_before, coalesced_before = LLM_CALLS, inflight.coalesced
+    start = time.perf_counter()
+    results = await asyncio.gather(*(make_call() for _ in range(n)))
+    elapsed = time.perf_counter() - start
+
+    llm_calls = LLM_CALLS - llm_before
+    coalesced = inflight.coalesced - coalesced_before
+    print(f"{label} coalescing: {n} identical requests -> {llm_calls} LLM call(s), "
+          f"{coalesced} coalesced, {elapsed:.2f}s")
+    assert llm_calls == 1, f"identical {label} requests should share one generation"
+    assert coalesced == n - 1 and sum(r["metadata"]["coalesced"] for r in results) == n - 1
+    assert len({r["answer"] for r in results}) == 1, "every caller should receive the shared answer"
+
+
+async def check_admission(rag: RAGPipeline, engine: ComparisonEngine):
+    """With 2 LLM slots and room for 4 waiters, 6 comparisons followed by 3 queries:
+    queries displace queued comparisons and are served first, the displaced get a fast 429."""
+    default = rag.scheduler
+    rag.scheduler = LLMScheduler(slots=2, max_queue=4, queue_timeout=5)
+    finished = []
+
+    async def run(kind: str, i: int, delay: float):
+        await asyncio.sleep(delay)
+        try:
+            if kind == "compare":
+                await engine.acompare_protocols(f"Compare fees ({i})", ["aave", "compound"])
+            else:
+                await rag.agenerate_answer(f"What is a flash loan? ({i})", "aave")
+            finished.append(kind)
+        except Overloaded as e:
+            finished.append(f"{kind}:{e.status_code}")
+            assert e.retry_after >= 1
+
+    try:
+        await asyncio.gather(*(run("compare", i, 0) for i in range(6)),
+                             *(run("query", i, 0.05) for i in range(3)))
+        stats = rag.scheduler.stats()
+    finally:
+        rag.scheduler = default
+
+    served = [kind for kind in finished if ":" not in kind]
+    print(f"admission (2 slots, queue 4): served {served}, shed {finished.count('compare:429')} compare(s) with 429")
+    assert finished.count("compare:429") == 3, "queries should displace queued comparisons"
+    assert served == ["compare", "compare", "query", "query", "query", "compare"], "queries should go first"
+    assert stats["in_use"] == 0 and sum(stats["queue_depth"].values()) == 0
+
+
+async def check_compare_retrieval(engine: ComparisonEngine, protocols):
+    stub = engine.rag.embeddings.embeddings
+    calls_before, rpcs_before = stub.calls, RPC_CALLS
+
+    start = time.perf_counter()
+    docs = await engine.aretrieve_all("How are interest rates set?", protocols)
+    elapsed = time.perf_counter() - start
+
+    embeds, rpcs = stub.calls - calls_before, RPC_CALLS - rpcs_before
+    print(f"compare retrieval ({len(protocols)} protocols): {embeds} embedding call(s), {rpcs} RPC(s), {elapsed:.2f}s "
+          f"(serial would be ~{EMBED_DELAY * len(protocols) + RPC_DELAY * len(protocols):.2f}s)")
+    assert all(docs), "every protocol should return context"
+    assert [d[0]['metadata']['protocol'] for d in docs] == protocols, "results should follow the requested order"
+    assert embeds == 1, "the question should be embedded once per compare"
+    assert rpcs == 1, "every protocol should be retrieved in one RPC"
+    assert elapsed < EMBED_DELAY + RPC_DELAY * 2, "compare retrieval took more than one round trip"
+
+
+def check_compare_context(engine: ComparisonEngine):
+    # Ingestion-sized chunks (1000 characters), distinct pages, distinct wording
+    def chunks(protocol):
+        return [{"content": " ".join(f"{protocol}{page}w{w}" for w in range(110))[:1000],
+                 "metadata": {"source": f"{protocol}.pdf", "page": page, "protocol": protocol},
+                 "similarity": 0.9 - page / 100}
+                for page in range(DOCS_PER_PROTOCOL)]
+
+    for protocols in (["aave", "compound"], ["aave", "compound", "uniswap"]):
+        _, sources = engine._build_context(protocols, [chunks(p) for p in protocols])
+        kept = [sum(s["protocol"] == p for s in sources) for p in protocols]
+        print(f"compare context ({len(protocols)} protocols): {kept} blocks per protocol")
+        assert kept == [DOCS_PER_PROTOCOL] * len(protocols), "a comparison should keep every protocol's top chunks"
+
+
+def check_hybrid_relevance():
+    # Vector hits carry cosines; the BM25-only hit "d" has none. After fusion all four share one scale.
+    def doc(name, **extra):
+        return {"content": f"{name} " * 50, "metadata": {"source": "x.pdf", "page": name, "protocol": "aave"}, **extra}
+    vector = [doc("a", similarity=0.82), doc("b", similarity=0.80), doc("c", similarity=0.78)]
+    lexical = [doc("d", bm25=9.0), doc("a", bm25=7.0), doc("b", bm25=5.0)]
+    fused = reciprocal_rank_fusion([vector, lexical], 4)
+    order = [d["metadata"]["page"] for d in fused]
+    blocks, _ = ContextPacker(mmr_lambda=1.0).pack(fused, 4)
+    print(f"hybrid relevance: fused {order}, scores {[round(d['similarity'], 3) for d in fused]}, "
+          f"packed {[b['metadata']['page'] for b in blocks]}")
+    assert fused[0]["similarity"] == 1.0 and all(0 < d["similarity"] <= 1.0 for d in fused)
+    assert [b["metadata"]["page"] for b in blocks] == order, "packing should keep the fused order"
+
+
+async def check_batch(rag: RAGPipeline, n: int):
+    protocols = ["aave", "compound", "uniswap"]
+    # Every fifth question repeats an earlier one, and one item is made to fail
+    items = [{"question": f"Question {i - i % 5 if i % 5 == 4 else i}?", "protocol": protocols[i % 3]}
+             for i in range(n)]
+    items.append({"question": "Question 0?", "protocol": "broken"})
+    stub = rag.embeddings.embeddings
+
+    start = time.perf_counter()
+    for item in items[:-1]:
+        await rag.agenerate_answer(item["question"] + " (loop)", item["protocol"])
+    looped = time.perf_counter() - start
+
+    calls_before = stub.calls
+    start = time.perf_counter()
+    results = await rag.abatch_generate(items)
+    batched = time.perf_counter() - start
+    embeds = stub.calls - calls_before
+
+    print(f"batch ({len(items)} items): {embeds} embedding call(s), {batched:.2f}s "
+          f"(looping over single queries: {looped:.2f}s, {looped / batched:.1f}x)")
+    assert len(results) == len(items)
+    assert all(r["answer"] for r in results[:-1]) and "error" in results[-1], "errors should stay per item"
+    assert embeds == 1, "a batch should be embedded in one call"
+    assert batched * 4 < looped, "batch should be several times faster than a loop of single queries"
+
+    # Each item gets the single-query deadline: a stalled generation fails that item with a 504
+    deadline, rag.providers.request_deadline = rag.providers.request_deadline, LLM_DELAY / 3
+    start = time.perf_counter()
+    results = await rag.abatch_generate([{"question": f"Slow question {i}?", "protocol": "aave"} for i in range(3)])
+    elapsed = time.perf_counter() - start
+    rag.providers.request_deadline = deadline
+    print(f"batch past the request deadline: {[type(r.get('exception')).__name__ for r in results]} "
+          f"in {elapsed:.2f}s")
+    assert all(isinstance(r.get("exception"), DeadlineExceeded) for r in results)
+    assert elapsed < LLM_DELAY, "items should stop at the deadline instead of waiting for the LLM"
+
+    # Out-of-range concurrency is a 422 at the API; the pipeline clamps whatever reaches it
+    for concurrency in (0, -1, 10_000):
+        try:
+            BatchQueryRequest(queries=[], concurrency=concurrency)
+            raise AssertionError(f"concurrency={concurrency} should be rejected")
+        except ValidationError:
+            pass
+    results = await rag.abatch_generate(items[:3], concurrency=-1)
+    print(f"batch with concurrency=-1 called directly: {sum('answer' in r for r in results)} of 3 answered")
+    assert all("answer" in r for r in results)
+
+
+async def check_provider_timeouts():
+    providers = Providers()
+    providers.stage_timeouts = {"embed": 0.05, "llm": 0.05}
+    providers.retry_base_delay = 0.01
+
+    for stage, expected_retries in (("llm", 0), ("embed", providers.max_retries)):
+        start = time.perf_counter()
+        try:
+            await providers.call(stage, lambda: asyncio.sleep(1))
+            raise AssertionError("a call past its stage timeout should fail")
+        except DeadlineExceeded:
+            pass
+        elapsed = time.perf_counter() - start
+        retries = providers.counters[stage]["retries"]
+        print(f"{stage} stage timeout: {retries} retries, failed after {elapsed:.2f}s")
+        assert retries == expected_retries, "only embed/retrieve timeouts should be retried"
+
+
+class SlowIndex:
+    """Stands in for a large VectorIndex: search blocks for `delay` seconds, like a long NumPy scan."""
+
+    def __init__(self, partitions, delay: float):
+        self.partitions = partitions
+        self.delay = delay
+        self.threads = []
+
+    def __len__(self):
+        return max(end for _, end in self.partitions.values())
+
+    def search(self, query_vector, protocol, k):
+        self.threads.append(threading.get_ident())
+        time.sleep(self.delay)
+        return []
+
+
+async def check_local_offload():
+    index = SlowIndex({"aave": (0, 200_000), "compound": (200_000, 200_100)}, delay=0.2)
+    retriever = LocalRetriever(index, thread_rows=10_000)
+    ticks = 0
+
+    async def heartbeat():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    beat = asyncio.create_task(heartbeat())
+    await retriever.asearch([0.0], "aave")
+    large_ticks = ticks
+    await retriever.asearch_multi([0.0], ["aave", "compound"])
+    ticks = 0
+    await retriever.asearch([0.0], "compound")
+    beat.cancel()
+    loop_thread = threading.get_ident()
+    print(f"local search: 200k-row scan let the event loop tick {large_ticks} times, "
+          f"100-row scan {ticks} (inline: {index.threads[-1] == loop_thread})")
+    assert large_ticks >= 5, "large scans should run off the event loop"
+    assert index.threads[0] != loop_thread and index.threads[1] != loop_thread
+    assert index.threads[-1] == loop_thread, "small scans should stay inline"
+
+    # An export with no rows yet (no protocols ingested) loads and searches to nothing
+    with tempfile.TemporaryDirectory() as workdir:
+        path = os.path.join(workdir, "documents.json")
+        with open(path, "w") as f:
+            json.dump([], f)
+        for index in (load_index(path), QuantizedIndex.build(load_index(path), os.path.join(workdir, "int8"))):
+            retriever = LocalRetriever(index, thread_rows=0)
+            results = await retriever.asearch([1.0, 0.0], "aave"), await retriever.asearch_multi([1.0, 0.0], ["aave"])
+            print(f"empty {type(index).__name__}: {results}")
+            assert results == ([], {"aave": []})
+
+
+async def main(n: int = 20):
+    rag = build_stub_pipeline()
+    # Enough LLM slots that the N concurrent calls below are not queued (check_admission covers queueing)
+    rag.scheduler = LLMScheduler(slots=n, max_queue=n)
+    engine = ComparisonEngine(rag)
+
+    print(f"\n--- Concurrency check with stubbed providers (N={n}) ---")
+    await time_concurrent("query", lambda i: rag.agenerate_answer(f"What is eMode? ({i})", "aave"), n)
+    await time_concurrent(
+        "compare",
+        lambda i: engine.acompare_protocols(f"Compare liquidations ({i})", ["aave", "compound", "uniswap"]),
+        n,
+    )
+    await check_coalescing(
+        "query", rag.inflight, lambda: rag.agenerate_answer("  What is the Health Factor? ", "aave"), n
+    )
+    await check_coalescing(
+        "compare", engine.inflight,
+        lambda: engine.acompare_protocols("Compare oracle design", ["aave", "compound"]), n
+    )
+    await check_admission(rag, engine)
+    await check_compare_retrieval(engine, ["aave", "compound", "uniswap"])
+    check_compare_context(engine)
+    check_hybrid_relevance()
+    await check_batch(rag, 2 * n)
+    await check_provider_timeouts()
+    await check_local_offload()
+    print("✅ Concurrent requests completed in roughly the time of one.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,200 @@
+"""
+Checks conversation sessions offline: context reuse across follow-ups, and that
+the prompt layout lets a provider prompt cache serve each turn's prefix.
+
+The stub chat model keeps a prefix cache the way Anthropic's works: every
+cache_control breakpoint stores the prompt up to it, and a request reads the
+longest stored prefix ending at a content block boundary before its last
+breakpoint. It reports cache_read / cache_creation tokens like ChatAnthropic
+(no minimum prefix length here, unlike the real API).
+
+    python scripts/test_sessions.py
+"""
+
+import os
+import sys
+import asyncio
+import hashlib
+from typing import List, Tuple
+
+import numpy as np
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+from pydantic import Field
+
+# Add backend directory to path
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag import RAGPipeline
+from retrievers import LocalRetriever
+from vector_index import VectorIndex
+from lexical import tokenize
+from tokens import count_tokens
+from sessions import SessionNotFound
+
+DIM = 256
+
+PAGES = {
+    "aave": [
+        "The health factor measures the safety of a borrow position against liquidation",
+        "Liquidation happens when the health factor drops below one and a liquidator repays debt",
+        "Aave V3 computes the health factor with eMode categories and isolation mode caps",
+        "Governance proposals are voted on by AAVE token holders through the governance contracts",
+        "Interest rates follow a utilization curve with a kink at the optimal utilization",
+        "Governance votes weigh AAVE and stkAAVE balances delegated to a voter",
+        "The short executor queues approved governance proposals behind a one day timelock",
+        "Guardians can cancel governance proposals that threaten the protocol",
+        "Oracle prices come from Chainlink aggregators with fallback sources",
+        "Flash loans must be repaid within the same transaction plus a premium",
+        "The safety module stakes AAVE to cover shortfall events",
+        "Supply caps and borrow caps limit exposure to each listed asset",
+    ],
+    "compound": [
+        "Compound accounts borrow against collateral factors per market",
+        "Compound governance uses COMP delegation and a timelock for proposals",
+    ],
+}
+
+
+class WordEmbeddings:
+    """Bag-of-words vectors (hashed terms), so texts sharing terms are close."""
+
+    def _vector(self, text: str) -> List[float]:
+        vector = np.zeros(DIM, dtype=np.float32)
+        for term in tokenize(text):
+            vector[int.from_bytes(hashlib.sha256(term.encode()).digest()[:4], "little") % DIM] += 1
+        return vector.tolist()
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+    async def aembed_query(self, text):
+        return self._vector(text)
+
+    async def aembed_documents(self, texts):
+        return [self._vector(t) for t in texts]
+
+
+def _blocks(messages: List[BaseMessage]) -> List[Tuple[str, bool]]:
+    """The prompt as (text, has cache breakpoint) content blocks, in order."""
+    blocks = []
+    for message in messages:
+        if isinstance(message.content, str):
+            blocks.append((f"{message.type}:{message.content}", False))
+        else:
+            blocks += [(f"{message.type}:{b['text']}", "cache_control" in b) for b in message.content]
+    return blocks
+
+
+class PrefixCachingChat(BaseChatModel):
+    """Stub chat model with an Anthropic-style prompt prefix cache."""
+
+    cached_prefixes: set = Field(default_factory=set)
+
+    @property
+    def _llm_type(self) -> str:
+        return "prefix-caching-stub"
+
+    def _generate(self, messages: List[BaseMessage], stop=None, run_manager=None, **kwargs) -> ChatResult:
+        blocks = _blocks(messages)
+        prefixes = [hashlib.sha256("\x00".join(t for t, _ in blocks[:i]).encode()).hexdigest()
+                    for i in range(len(blocks) + 1)]
+        tokens = np.cumsum([0] + [count_tokens(t) for t, _ in blocks])
+        breakpoints = [i + 1 for i, (_, marked) in enumerate(blocks) if marked]
+        last = max(breakpoints, default=0)
+        read = max((i for i in range(1, last + 1) if prefixes[i] in self.cached_prefixes), default=0)
+        self.cached_prefixes.update(prefixes[i] for i in breakpoints)
+
+        answer = f"Answer to: {blocks[-1][0].split(':', 1)[1]} [1]"
+        usage = {"input_tokens": int(tokens[-1]), "output_tokens": count_tokens(answer),
+                 "total_tokens": int(tokens[-1]) + count_tokens(answer),
+                 "input_token_details": {"cache_read": int(tokens[read]),
+                                         "cache_creation": int(tokens[last] - tokens[read])}}
+        message = AIMessage(content=answer, usage_metadata=usage, response_metadata={"model_name": "stub"})
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def build_pipeline() -> RAGPipeline:
+    embeddings = WordEmbeddings()
+    chunks = [{"content": text, "metadata": {"protocol": protocol, "source": f"{protocol}.pdf", "page": page + 1}}
+              for protocol, texts in PAGES.items() for page, text in enumerate(texts)]
+    vectors = [embeddings.embed_query(c["content"]) for c in chunks]
+    index = VectorIndex(np.asarray(vectors, dtype=np.float32),
+                        [{"id": i, **c} for i, c in enumerate(chunks)])
+    rag = RAGPipeline(retriever=LocalRetriever(index), embeddings=embeddings, llm=PrefixCachingChat())
+    # Bag-of-words similarities run lower than ada-002's
+    rag.sessions.reuse_similarity = 0.6
+    return rag
+
+
+async def main():
+    rag = build_pipeline()
+    conversation = [
+        ("What is the health factor?", "aave"),
+        ("And how does V3 compute the health factor?", "aave"),
+        ("How do governance proposals get voted on?", "aave"),
+        ("What about governance votes there?", "aave"),
+        ("How is governance done?", "compound"),
+    ]
+
+    print("\n--- Session turns with stubbed providers ---")
+    print(f"{'turn':<5}{'retrieval':<11}{'reused':>7}{'new':>5}{'blocks':>8}{'input':>7}{'cached':>8}  question")
+    turns, session_id = [], None
+    for question, protocol in conversation:
+        if session_id is None:
+            # The first question takes the normal path (answer cache, coalescing) and opens the session
+            result = await rag.agenerate_answer(question, protocol, start_session=True)
+            session_id = result["metadata"]["session"]["id"]
+        else:
+            result = await rag.asession_answer(session_id, question, protocol)
+        turn = result["metadata"]["session"]
+        turns.append(turn)
+        tokens = result["metadata"]["tokens"]["input"]
+        print(f"{turn['turn']:<5}{turn['retrieval']:<11}{turn['reused_chunks']:>7}{turn['new_chunks']:>5}"
+              f"{turn['context_blocks']:>8}{tokens:>7}{turn['cached_tokens']:>8}  {question}")
+        assert [s["id"] for s in result["sources"]] == sorted(s["id"] for s in result["sources"])
+
+    assert len(session_id) >= 40, "session ids should be long random tokens"
+    assert turns[0]["retrieval"] == "vector" and turns[0]["new_chunks"] > 0, "the first answer should seed the context"
+    assert turns[1]["retrieval"] == "reused", "a follow-up on the same topic should reuse the held blocks"
+    assert turns[2]["retrieval"] == "retrieved" and turns[2]["new_chunks"] > 0, "a new topic should retrieve"
+    assert turns[2]["cached_tokens"] > 0, "adding context should keep the cached instructions + old context"
+    assert turns[4]["retrieval"] == "retrieved" and turns[4]["history_turns"] == 4
+    assert turns[4]["reused_chunks"] == 0, "switching protocol should drop the held context"
+
+    # Streaming follow-up and the session limits
+    events = [event async for event, _ in rag.astream_session_answer(session_id, "Who can propose?", "compound")]
+    assert events[0] == "sources" and events[-1] == "done"
+    stats = rag.sessions.stats()
+    assert stats["turns"] == len(conversation) + 1
+    assert len(rag.sessions.get(session_id).turns) <= stats["max_turns"]
+    rag.sessions.drop(session_id)
+    for call in (lambda: rag.sessions.drop(session_id), lambda: rag.sessions.get("chosen-by-the-client")):
+        try:
+            call()
+            raise AssertionError("ids the server did not issue (or dropped) should be rejected")
+        except SessionNotFound:
+            pass
+
+    # Asking the first question again is served by the answer cache, streamed, and still opens a session
+    events = [(event, data) async for event, data in
+              rag.astream_answer(conversation[0][0], "aave", start_session=True)]
+    done = events[-1][1]
+    assert done["retrieval"] == "cache" and done["session"]["new_chunks"] == 0
+    cached_session = rag.sessions.get(done["session"]["id"])
+    assert cached_session.next_source_id == len(events[0][1]) + 1, "cached citations keep their numbers"
+
+    # Over the context budget, the oldest turn's blocks go first
+    rag.sessions.context_budget = 200
+    result = await rag.agenerate_answer("When does liquidation happen?", "aave", start_session=True)
+    session_id = result["metadata"]["session"]["id"]
+    await rag.asession_answer(session_id, "How do governance proposals get voted on?", "aave")
+    session = rag.sessions.get(session_id)
+    assert len(session.sections) == 1 and session.blocks[0]["source_id"] > 5
+    print(f"Sessions: {stats['reused_retrievals']} of {stats['turns']} turns skipped retrieval, "
+          f"{stats['cached_tokens']} prompt tokens read from cache")
+    print("✅ Sessions reuse context and keep a cacheable prompt prefix.")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,202 @@
+import os
+import asyncio
+import secrets
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+
+from cache import LRUCache
+
+# Conversation sessions for follow-up questions.
+#
+# A conversation starts with an ordinary request (POST /api/query with
+# "start_session": true), answered through the answer cache, coalescing and
+# the lexical path like any other. The server then issues a random session id,
+# returned in metadata.session.id, and seeds the session with that turn.
+# Follow-ups send the id back; ids the server did not issue are rejected.
+#
+# A session keeps its recent turns and the context blocks they were answered
+# from. A follow-up is embedded together with the previous question; when
+# that vector is close to the one the held blocks were retrieved with, the
+# blocks are reused as they are and no retrieval runs. Otherwise retrieval
+# runs and only blocks the session does not hold yet are added.
+#
+# The prompt is laid out for provider-side prompt caching: instructions, then
+# the held blocks (one system content block per turn that added some, never
+# rewritten), then the earlier turns, then the new question. Cache breakpoints
+# go on the last context block and the last earlier answer, so each turn
+# re-reads the previous turn's prefix from the cache (Anthropic only caches
+# prefixes above a model minimum, 2048 tokens for Claude 3 Haiku).
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+class SessionNotFound(Exception):
+    """The session id was never issued by this server, or the session expired (mapped to HTTP 404)."""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        super().__init__("Unknown or expired session; start a new one")
+
+
+class Session:
+    """One conversation: recent turns and the context blocks they were answered from."""
+
+    def __init__(self, session_id: str, protocol: str):
+        self.id = session_id
+        self.protocol = protocol
+        self.turns: List[Dict[str, str]] = []
+        # Context blocks in prompt order, grouped by the turn that added them
+        self.sections: List[List[Dict[str, Any]]] = []
+        self.retrieval_vector: Optional[np.ndarray] = None
+        self.next_source_id = 1
+        self.turn_count = 0
+        # Turns of one session run one at a time
+        self.lock = asyncio.Lock()
+
+    @property
+    def blocks(self) -> List[Dict[str, Any]]:
+        return [block for section in self.sections for block in section]
+
+    def reset_context(self, protocol: str):
+        """Drops the held blocks (the conversation moved to another protocol); turns are kept."""
+        self.protocol = protocol
+        self.sections = []
+        self.retrieval_vector = None
+
+    def can_reuse(self, vector: List[float], min_similarity: float) -> bool:
+        """Whether the held blocks were retrieved for a query this close to `vector`."""
+        if self.retrieval_vector is None or not self.sections:
+            return False
+        unit = np.asarray(vector, dtype=np.float32)
+        unit /= np.linalg.norm(unit) or 1.0
+        return float(unit @ self.retrieval_vector) >= min_similarity
+
+    def add_blocks(self, docs: List[Dict], vector: Optional[List[float]], format_block: Callable[[Dict, int], str],
+                   block_tokens: Callable[[Dict], int], token_budget: int) -> Tuple[int, int]:
+        """Adds the retrieved blocks the session does not hold yet, then evicts the oldest
+        sections beyond `token_budget`. `vector` is the query they were retrieved for
+        (None when it was not embedded, e.g. a lexical match: the next turn retrieves).
+        Returns (blocks already held, blocks added)."""
+        held = {_block_key(block["doc"]) for block in self.blocks}
+        reused, section = 0, []
+        for doc in docs:
+            if _block_key(doc) in held:
+                reused += 1
+                continue
+            held.add(_block_key(doc))
+            section.append({"doc": doc, "source_id": self.next_source_id,
+                            "text": format_block(doc, self.next_source_id), "tokens": block_tokens(doc)})
+            self.next_source_id += 1
+        if section:
+            self.sections.append(section)
+        while len(self.sections) > 1 and sum(b["tokens"] for b in self.blocks) > token_budget:
+            self.sections.pop(0)
+
+        if vector is None:
+            self.retrieval_vector = None
+        else:
+            unit = np.asarray(vector, dtype=np.float32)
+            self.retrieval_vector = unit / (np.linalg.norm(unit) or 1.0)
+        return reused, len(section)
+
+    def messages(self, instructions: str, question: str, max_turns: int, cache: bool) -> List[BaseMessage]:
+        """The prompt for `question`: instructions + held context, earlier turns, the question."""
+        system = [{"type": "text", "text": instructions}]
+        system += [{"type": "text", "text": "\n\n".join(b["text"] for b in section)} for section in self.sections]
+        if cache:
+            system[-1]["cache_control"] = CACHE_CONTROL
+
+        messages: List[BaseMessage] = [SystemMessage(content=system)]
+        history = self.turns[-max_turns:]
+        for i, turn in enumerate(history):
+            messages.append(HumanMessage(content=turn["question"]))
+            if cache and i == len(history) - 1:
+                messages.append(AIMessage(content=[{"type": "text", "text": turn["answer"],
+                                                    "cache_control": CACHE_CONTROL}]))
+            else:
+                messages.append(AIMessage(content=turn["answer"]))
+        messages.append(HumanMessage(content=question))
+        return messages
+
+    def record_turn(self, question: str, answer: str, max_turns: int):
+        self.turns = (self.turns + [{"question": question, "answer": answer}])[-max_turns:]
+        self.turn_count += 1
+
+
+def _block_key(doc: Dict) -> Tuple:
+    meta = doc.get("metadata", {})
+    return meta.get("protocol"), meta.get("source"), meta.get("page")
+
+
+class SessionStore:
+    """In-memory sessions, bounded in number (least recently used dropped first) and
+    expired after `ttl` seconds without a turn. Each session holds at most
+    `max_turns` turns and `context_budget` tokens of context blocks.
+
+    Sessions live in one worker process: with several workers, route a session's
+    requests to the same worker (sticky sessions) or they start over.
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl: float = 1800.0, max_turns: int = 6,
+                 context_budget: int = 3000, reuse_similarity: float = 0.9, prompt_cache: bool = True):
+        self.max_turns = max_turns
+        self.context_budget = context_budget
+        self.reuse_similarity = reuse_similarity
+        self.prompt_cache = prompt_cache
+        self._sessions = LRUCache(max_size=max_sessions, ttl=ttl)
+        self.counters = {"turns": 0, "reused_retrievals": 0, "reused_chunks": 0, "new_chunks": 0,
+                         "cached_tokens": 0}
+
+    def start(self, protocol: str) -> Session:
+        """A new session under an unguessable server-issued id."""
+        session = Session(secrets.token_urlsafe(32), protocol)
+        self._sessions.put(session.id, session)
+        return session
+
+    def get(self, session_id: str) -> Session:
+        """The session with this id; SessionNotFound if it was never issued or has expired."""
+        session = self._sessions.get(session_id)
+        if session is None:
+            raise SessionNotFound(session_id)
+        return session
+
+    def touch(self, session: Session):
+        """Restarts the session's idle timer (after each turn)."""
+        self._sessions.put(session.id, session)
+
+    def drop(self, session_id: str):
+        if self._sessions.pop(session_id) is None:
+            raise SessionNotFound(session_id)
+
+    def count_turn(self, turn: Dict[str, Any]):
+        self.counters["turns"] += 1
+        self.counters["reused_retrievals"] += turn["retrieval"] == "reused"
+        self.counters["reused_chunks"] += turn["reused_chunks"]
+        self.counters["new_chunks"] += turn["new_chunks"]
+        self.counters["cached_tokens"] += turn["cached_tokens"]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": len(self._sessions),
+            "max_sessions": self._sessions.max_size,
+            "ttl_s": self._sessions.ttl,
+            "max_turns": self.max_turns,
+            "context_budget": self.context_budget,
+            "reuse_similarity": self.reuse_similarity,
+            "prompt_cache": self.prompt_cache,
+            **self.counters,
+        }
+
+
+def session_store_from_env() -> SessionStore:
+    """SESSION_* environment variables bound the session store; PROMPT_CACHE=0 drops the cache breakpoints."""
+    return SessionStore(
+        max_sessions=int(os.environ.get("SESSION_MAX", "1000")),
+        ttl=float(os.environ.get("SESSION_TTL", "1800")),
+        max_turns=int(os.environ.get("SESSION_MAX_TURNS", "6")),
+        context_budget=int(os.environ.get("SESSION_CONTEXT_BUDGET", "3000")),
+        reuse_similarity=float(os.environ.get("SESSION_REUSE_SIMILARITY", "0.9")),
+        prompt_cache=os.environ.get("PROMPT_CACHE", "1").lower() in ("1", "true", "yes"),
+    )
@@ -0,0 +1,137 @@
+import os
+import json
+import time
+import fcntl
+import shutil
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+
+from vector_index import QuantizedIndex, load_index
+
+# Multi-worker serving (uvicorn main:app --workers N, or WEB_CONCURRENCY=N).
+#
+# Every worker builds its own RAGPipeline, so without help each one would load
+# its own copy of the local index and start with cold, private caches. With
+# SHARED_STATE_DIR set, workers instead share:
+# - the local vector index, converted once into a memory-mapped directory
+#   (QuantizedIndex layout, float32) that all workers map from the page cache;
+# - the embedding and answer caches, through SQLite files in that directory
+#   (EMBEDDING_CACHE_PATH / ANSWER_CACHE_PATH default to them);
+# - one index pre-fault: the first worker reads the mapped index into the
+#   page cache; the others wait for it instead of repeating it. Provider
+#   probes (WARMUP=1) still run in every worker, whose connection pools are
+#   its own.
+#
+# Coordination is an flock on SHARED_STATE_DIR/.lock, so it works the same
+# under uvicorn, gunicorn or a process manager.
+
+
+def shared_state_dir() -> Optional[str]:
+    return os.environ.get("SHARED_STATE_DIR") or None
+
+
+@contextmanager
+def exclusive(directory: str):
+    """Holds the directory's lock file exclusively (blocks until other workers release it)."""
+    with open(os.path.join(directory, ".lock"), "w") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_json(path: str) -> Dict[str, Any]:
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_json(path: str, data: Dict[str, Any]):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError:
+        return False
+
+
+def _shared_index(directory: str, source: str) -> str:
+    """Memory-mapped copy of the index at `source`, rebuilt when the source file changes."""
+    target = os.path.join(directory, "index")
+    stamp = {"source": os.path.abspath(source), "mtime": os.path.getmtime(source), "bytes": os.path.getsize(source)}
+    if _read_json(os.path.join(directory, "index.json")) == stamp and os.path.isdir(target):
+        return target
+
+    start = time.perf_counter()
+    tmp_path = target + f".build-{os.getpid()}"
+    QuantizedIndex.build(load_index(source), tmp_path, dtype="float32")
+    # Workers still mapping the old files keep them until they exit
+    old_path = target + f".old-{os.getpid()}"
+    if os.path.isdir(target):
+        os.rename(target, old_path)
+    os.rename(tmp_path, target)
+    shutil.rmtree(old_path, ignore_errors=True)
+    _write_json(os.path.join(directory, "index.json"), stamp)
+    print(f"Shared index built from {source} in {time.perf_counter() - start:.1f}s: {target}")
+    return target
+
+
+def prepare_shared_state() -> Optional[Dict[str, str]]:
+    """Points this worker's caches and local index at SHARED_STATE_DIR (before RAGPipeline is built).
+    Returns the paths in use, or None when multi-worker sharing is off."""
+    directory = shared_state_dir()
+    if directory is None:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    os.environ.setdefault("EMBEDDING_CACHE_PATH", os.path.join(directory, "embeddings.sqlite"))
+    os.environ.setdefault("ANSWER_CACHE_PATH", os.path.join(directory, "answers.sqlite"))
+
+    source = os.environ.get("VECTOR_INDEX_PATH")
+    if os.environ.get("RETRIEVER_BACKEND", "supabase").lower() == "local" and source and not os.path.isdir(source):
+        with exclusive(directory):
+            os.environ["VECTOR_INDEX_PATH"] = _shared_index(directory, source)
+
+    return {
+        "dir": directory,
+        "embedding_cache": os.environ["EMBEDDING_CACHE_PATH"],
+        "answer_cache": os.environ["ANSWER_CACHE_PATH"],
+        "vector_index": os.environ.get("VECTOR_INDEX_PATH"),
+    }
+
+
+async def coordinated_warm_up(rag, probe_providers: bool) -> Dict[str, Any]:
+    """Warms this worker up, pre-faulting the shared index only once per server.
+
+    The first worker of this server pre-faults the memory-mapped index into
+    the page cache and records that in SHARED_STATE_DIR/warmup.json. Its
+    siblings (same parent process, with that worker still alive) block on the
+    lock until then and skip the pre-fault. Then, if `probe_providers`, every
+    worker runs RAGPipeline.awarm_up itself: provider connection pools are
+    per process, so a worker is only warm once its own are open.
+    """
+    directory = shared_state_dir()
+    path = os.path.join(directory, "warmup.json")
+    start = time.perf_counter()
+    with exclusive(directory):
+        state = _read_json(path)
+        if state.get("supervisor") == os.getppid() and _alive(state.get("pid", -1)) and state.get("pid") != os.getpid():
+            rag.warmup["index_prefault_shared_from_pid"] = state["pid"]
+        else:
+            index = getattr(rag.retriever, "index", None)
+            if hasattr(index, "prefault"):
+                rag.warmup["index_prefault_mb"] = round(index.prefault() / 2 ** 20, 1)
+            _write_json(path, {"supervisor": os.getppid(), "pid": os.getpid(), "at": time.time(),
+                               "index_prefault_mb": rag.warmup.get("index_prefault_mb")})
+    if probe_providers:
+        await rag.awarm_up()
+    rag.warmup["total_s"] = round(time.perf_counter() - start, 3)
+    return rag.warmup
@@ -1,25 +1,103 @@
 -- Reset: Drop existing objects
+-- (existing deployments: run migrations/001_protocol_column.sql instead, it keeps the rows)
 DROP FUNCTION IF EXISTS match_documents(vector(1536), int, jsonb);
+DROP FUNCTION IF EXISTS match_documents_multi(vector(1536), text[], int);
+DROP FUNCTION IF EXISTS ensure_protocol_index(text);
 DROP TABLE IF EXISTS documents;
+DROP FUNCTION IF EXISTS documents_set_protocol();
 
 -- Enable extensions
 CREATE EXTENSION IF NOT EXISTS vector;
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
--- Create documents table (simplified to match LangChain's SupabaseVectorStore defaults)
+-- Create documents table (compatible with LangChain's SupabaseVectorStore defaults)
 -- LangChain only writes: id, content, embedding, metadata
--- Protocol, source, page etc. are stored inside the metadata JSONB column
+-- Source, page etc. are stored inside the metadata JSONB column. The protocol is
+-- also a column of its own, so searches can use a per-protocol vector index.
 CREATE TABLE documents (
   id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
   content TEXT,
   embedding VECTOR(1536),
-  metadata JSONB DEFAULT '{}'
+  metadata JSONB DEFAULT '{}',
+  protocol TEXT NOT NULL
 );
 
--- Create index for fast similarity search
-CREATE INDEX ON documents 
-USING ivfflat (embedding vector_cosine_ops)
-WITH (lists = 100);
+-- ingest_documents.py writes the protocol column; rows from other writers
+-- (e.g. LangChain) take it from metadata->>'protocol'
+CREATE FUNCTION documents_set_protocol()
+RETURNS TRIGGER
+LANGUAGE plpgsql
+AS $$
+BEGIN
+  IF NEW.protocol IS NULL THEN
+    NEW.protocol := COALESCE(NEW.metadata->>'protocol', '');
+  END IF;
+  RETURN NEW;
+END;
+$$;
+
+CREATE TRIGGER documents_set_protocol
+BEFORE INSERT OR UPDATE ON documents
+FOR EACH ROW EXECUTE FUNCTION documents_set_protocol();
+
+-- Lookup of existing chunks per document for incremental ingestion
+-- (ingest_documents.py keys rows on a hash of source, page and text).
+-- Also serves exact search for protocols that have no vector index yet.
+CREATE INDEX documents_protocol_source_idx ON documents (protocol, (metadata->>'source'));
+
+-- One vector index per protocol, restricted to that protocol's rows
+-- (HNSW where pgvector >= 0.5 provides it, ivfflat otherwise).
+-- A single global index would be searched first and filtered after, so a
+-- small protocol's rows get crowded out by everyone else's neighbours.
+-- ingest_documents.py calls this for every protocol it ingests; it does
+-- nothing when the index exists.
+CREATE OR REPLACE FUNCTION ensure_protocol_index(p TEXT)
+RETURNS TEXT
+LANGUAGE plpgsql
+SECURITY DEFINER
+SET search_path = public
+AS $$
+DECLARE
+  method TEXT := CASE WHEN EXISTS (SELECT 1 FROM pg_am WHERE amname = 'hnsw') THEN 'hnsw' ELSE 'ivfflat' END;
+  index_name TEXT := format('documents_%s_%s_%s',
+                            left(regexp_replace(lower(p), '[^a-z0-9]+', '_', 'g'), 32), left(md5(p), 8), method);
+  n_rows BIGINT;
+BEGIN
+  -- Only protocols that have rows, under a plain name: callers cannot build
+  -- indexes for arbitrary values
+  IF p IS NULL OR p !~ '^[a-z0-9][a-z0-9_.-]{0,63}$' THEN
+    RAISE EXCEPTION 'invalid protocol name: %', p;
+  END IF;
+  IF NOT EXISTS (SELECT 1 FROM documents WHERE protocol = p) THEN
+    RAISE EXCEPTION 'no documents for protocol %', p;
+  END IF;
+  IF method = 'hnsw' THEN
+    EXECUTE format(
+      'CREATE INDEX IF NOT EXISTS %I ON documents USING hnsw (embedding vector_cosine_ops) WHERE protocol = %L',
+      index_name, p);
+  ELSE
+    -- ivfflat learns its lists from the rows present, so build it after loading
+    SELECT count(*) INTO n_rows FROM documents WHERE protocol = p;
+    EXECUTE format(
+      'CREATE INDEX IF NOT EXISTS %I ON documents USING ivfflat (embedding vector_cosine_ops) '
+      'WITH (lists = %s) WHERE protocol = %L',
+      index_name, GREATEST(1, n_rows / 1000), p);
+  END IF;
+  RETURN index_name;
+END;
+$$;
+
+-- It runs DDL as its owner, so only the service role may call it (Supabase
+-- otherwise exposes every public function to anon and authenticated over /rpc)
+REVOKE EXECUTE ON FUNCTION ensure_protocol_index(TEXT) FROM PUBLIC;
+DO $$
+BEGIN
+  IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'service_role') THEN
+    REVOKE EXECUTE ON FUNCTION ensure_protocol_index(TEXT) FROM anon, authenticated;
+    GRANT EXECUTE ON FUNCTION ensure_protocol_index(TEXT) TO service_role;
+  END IF;
+END
+$$;
 
 -- Create similarity search function
 CREATE OR REPLACE FUNCTION match_documents(
@@ -34,22 +112,66 @@ RETURNS TABLE (
   similarity FLOAT
 )
 LANGUAGE plpgsql
+STABLE
+AS $$
+BEGIN
+  IF filter ? 'protocol' THEN
+    -- The protocol goes into the statement as a literal: the planner can only
+    -- use a partial index when it sees the value, not a cached plan's parameter
+    RETURN QUERY EXECUTE format(
+      'SELECT d.id, d.content, d.metadata, 1 - (d.embedding <=> $1) AS similarity
+       FROM documents d
+       WHERE d.protocol = %L
+       ORDER BY d.embedding <=> $1
+       LIMIT $2',
+      filter->>'protocol')
+    USING query_embedding, match_count;
+  ELSE
+    -- No protocol: exact search over every row (the API always passes one)
+    RETURN QUERY
+    SELECT
+      d.id,
+      d.content,
+      d.metadata,
+      1 - (d.embedding <=> query_embedding) AS similarity
+    FROM documents d
+    ORDER BY d.embedding <=> query_embedding
+    LIMIT match_count;
+  END IF;
+END;
+$$;
+
+-- Top-k for each of several protocols in one call (comparisons): one round
+-- trip instead of one match_documents RPC per protocol. Each protocol runs
+-- the same per-protocol index search as match_documents; rows come back
+-- tagged with their protocol, best match first within each protocol.
+CREATE OR REPLACE FUNCTION match_documents_multi(
+  query_embedding VECTOR(1536),
+  protocols TEXT[],
+  match_count INT DEFAULT 3
+)
+RETURNS TABLE (
+  protocol TEXT,
+  id UUID,
+  content TEXT,
+  metadata JSONB,
+  similarity FLOAT
+)
+LANGUAGE plpgsql
+STABLE
 AS $$
+DECLARE
+  p TEXT;
 BEGIN
-  RETURN QUERY
-  SELECT
-    documents.id,
-    documents.content,
-    documents.metadata,
-    1 - (documents.embedding <=> query_embedding) AS similarity
-  FROM documents
-  WHERE 
-    CASE 
-      WHEN filter ? 'protocol' THEN 
-        documents.metadata->>'protocol' = filter->>'protocol'
-      ELSE TRUE
-    END
-  ORDER BY documents.embedding <=> query_embedding
-  LIMIT match_count;
+  FOREACH p IN ARRAY protocols LOOP
+    RETURN QUERY EXECUTE format(
+      'SELECT d.protocol, d.id, d.content, d.metadata, 1 - (d.embedding <=> $1) AS similarity
+       FROM documents d
+       WHERE d.protocol = %L
+       ORDER BY d.embedding <=> $1
+       LIMIT $2',
+      p)
+    USING query_embedding, match_count;
+  END LOOP;
 END;
 $$;
@@ -0,0 +1,31 @@
+from functools import lru_cache
+from typing import Callable, Optional
+
+# cl100k_base is the tokenizer of text-embedding-ada-002 (and a close enough
+# estimate for Claude prompts when budgeting context).
+ENCODING = "cl100k_base"
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=1)
+def _encoder() -> Optional[Callable[..., list]]:
+    """Returns tiktoken's encode function, or None if the encoding cannot be loaded
+    (tiktoken downloads its BPE file on first use, which fails offline)."""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding(ENCODING).encode
+    except Exception as e:
+        print(f"Warning: tiktoken encoding '{ENCODING}' unavailable ({type(e).__name__}); "
+              f"estimating {CHARS_PER_TOKEN} characters per token")
+        return None
+
+
+def count_tokens(text: str) -> int:
+    encode = _encoder()
+    if encode is None:
+        return max(1, -(-len(text) // CHARS_PER_TOKEN)) if text else 0
+    return len(encode(text, disallowed_special=()))
+
+
+def tokenizer_name() -> str:
+    return ENCODING if _encoder() is not None else f"estimate ({CHARS_PER_TOKEN} chars/token)"
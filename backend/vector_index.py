@@ -0,0 +1,362 @@
+import os
+import json
+import mmap
+from typing import List, Dict, Any, Optional, Iterable
+
+import numpy as np
+
+
+def parse_embedding(value) -> List[float]:
+    """Accepts an embedding as a list or as pgvector's text form ("[0.1,0.2,...]")."""
+    if isinstance(value, str):
+        return json.loads(value)
+    return list(value)
+
+
+class VectorIndex:
+    """Exact in-process vector index over the `documents` corpus.
+
+    All chunk embeddings live in one contiguous float32 matrix, L2-normalized and
+    sorted by protocol so each protocol is a contiguous row slice. A search is a
+    single matrix-vector product over that slice plus `argpartition` for top-k,
+    and returns rows shaped like the `match_documents` RPC output
+    (id, content, metadata, similarity).
+    """
+
+    def __init__(self, embeddings: np.ndarray, records: List[Dict[str, Any]], dim: Optional[int] = None):
+        if len(records) != len(embeddings):
+            raise ValueError("embeddings and records must have the same length")
+
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        if records:
+            matrix = matrix.reshape(len(records), -1)
+        else:
+            # An empty corpus (e.g. an export with no protocols yet) searches to no results
+            matrix = matrix.reshape(0, dim if dim is not None else (matrix.shape[1] if matrix.ndim == 2 else 0))
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        matrix = matrix / np.where(norms == 0, 1.0, norms)
+
+        protocols = [r.get("metadata", {}).get("protocol") or "" for r in records]
+        order = np.argsort(np.asarray(protocols, dtype=object), kind="stable") if records else np.arange(0)
+
+        self.matrix = np.ascontiguousarray(matrix[order], dtype=np.float32)
+        self.records = [records[i] for i in order]
+        self.partitions: Dict[str, tuple] = {}
+        for row, i in enumerate(order):
+            protocol = protocols[i]
+            start, _ = self.partitions.get(protocol, (row, row))
+            self.partitions[protocol] = (start, row + 1)
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def dim(self) -> int:
+        return self.matrix.shape[1]
+
+    def protocols(self) -> List[str]:
+        return sorted(self.partitions)
+
+    def search(self, query_vector: List[float], protocol: Optional[str] = None, k: int = 5) -> List[Dict]:
+        """Exact cosine top-k within one protocol (or the whole corpus if protocol is None)."""
+        if protocol is None:
+            start, end = 0, len(self.records)
+        elif protocol in self.partitions:
+            start, end = self.partitions[protocol]
+        else:
+            return []
+        if end <= start or k <= 0:
+            return []
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self.matrix[start:end] @ query
+
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k] if k < len(scores) else np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [{**self.records[start + i], "similarity": float(scores[i])} for i in top]
+
+    # --- Building ---
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[Dict[str, Any]]) -> "VectorIndex":
+        """Builds an index from `documents` rows (id, content, metadata, embedding)."""
+        records, vectors = [], []
+        for i, row in enumerate(rows):
+            metadata = row.get("metadata") or {}
+            if isinstance(metadata, str):
+                metadata = json.loads(metadata)
+            records.append({"id": row.get("id", i), "content": row.get("content", ""), "metadata": metadata})
+            vectors.append(parse_embedding(row["embedding"]))
+        return cls(np.asarray(vectors, dtype=np.float32), records)
+
+    @classmethod
+    def from_chunks(cls, chunks: List[Dict], vectors: List[List[float]]) -> "VectorIndex":
+        """Builds an index from ingest_documents.chunk_text output and its embeddings."""
+        return cls.from_rows(
+            {"id": i, "content": c["text"], "metadata": c["metadata"], "embedding": v}
+            for i, (c, v) in enumerate(zip(chunks, vectors))
+        )
+
+    @classmethod
+    def from_export(cls, path: str) -> "VectorIndex":
+        """Builds an index from a JSON array or JSON-lines export of the `documents` table."""
+        with open(path, "r") as f:
+            if path.endswith(".jsonl"):
+                rows = [json.loads(line) for line in f if line.strip()]
+            else:
+                rows = json.load(f)
+        return cls.from_rows(rows)
+
+    def merge(self, other: "VectorIndex") -> "VectorIndex":
+        """Returns a new index with `other`'s rows replacing any rows for the same (protocol, source)."""
+        if not other.records:
+            return self
+        replaced = {(r["metadata"].get("protocol"), r["metadata"].get("source")) for r in other.records}
+        keep = [i for i, r in enumerate(self.records)
+                if (r["metadata"].get("protocol"), r["metadata"].get("source")) not in replaced]
+        return VectorIndex(
+            np.concatenate([self.matrix[keep], other.matrix]) if keep else other.matrix,
+            [self.records[i] for i in keep] + other.records
+        )
+
+    # --- Persistence ---
+
+    def save(self, path: str):
+        """Saves the index as a .npz file (float32 matrix + JSON records)."""
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "wb") as f:
+            np.savez(f, embeddings=self.matrix, records=np.array(json.dumps(self.records)))
+
+    @classmethod
+    def load(cls, path: str) -> "VectorIndex":
+        with np.load(path, allow_pickle=False) as data:
+            return cls(data["embeddings"], json.loads(str(data["records"])))
+
+
+PAGE_BYTES = 4096
+
+
+class RecordTable:
+    """Read-only sequence over a records.jsonl side table, decoded row by row on access.
+
+    The file is memory-mapped, so worker processes share it through the page
+    cache instead of each holding every chunk as Python objects. Line offsets
+    come from records.offsets.npy when present, else one scan at open.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        offsets_path = self.offsets_path(path)
+        if os.path.exists(offsets_path):
+            self.offsets = np.load(offsets_path, mmap_mode="r")
+        else:
+            self.offsets = self.line_offsets(self._data)
+
+    @staticmethod
+    def offsets_path(path: str) -> str:
+        return os.path.splitext(path)[0] + ".offsets.npy"
+
+    @staticmethod
+    def line_offsets(data) -> np.ndarray:
+        """Start of every line plus the end of the last one (n + 1 entries)."""
+        newlines = np.flatnonzero(np.frombuffer(data, dtype=np.uint8) == ord("\n")) if len(data) else []
+        return np.concatenate([[0], np.asarray(newlines, dtype=np.int64) + 1])
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return json.loads(self._data[int(self.offsets[i]):int(self.offsets[i + 1])])
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def prefault(self) -> int:
+        return prefault(self.offsets) + (prefault(np.frombuffer(self._data, dtype=np.uint8)) if len(self._data) else 0)
+
+
+def prefault(array: Optional[np.ndarray]) -> int:
+    """Reads one value per page of a memory-mapped array so later searches don't fault pages in.
+    Returns the bytes covered."""
+    if array is None or not array.size:
+        return 0
+    flat = array.reshape(-1)
+    step = max(1, PAGE_BYTES // flat.itemsize)
+    flat[::step].sum()
+    return flat.nbytes
+
+
+class QuantizedIndex:
+    """Memory-mapped, quantized on-disk version of VectorIndex.
+
+    Layout of an index directory:
+        meta.json             dtype, dim, row count, protocol partitions
+        vectors.npy           float32 (exact copy), float16, or int8 with one float32 scale per row
+        scales.npy            per-row scales (int8 only)
+        rescore.npy           float16 rows, used to re-score the top int8 candidates (int8 only, on by default)
+        records.jsonl         chunk metadata side table (id, content, metadata), one row per line
+        records.offsets.npy   byte offset of every records.jsonl line (optional)
+
+    The .npy files are opened with mmap_mode="r" and records are decoded from the
+    mapped file on access (RecordTable), so several worker processes serving the
+    same index share one copy in the OS page cache. Searches score a protocol's
+    slice at stored precision and, if the directory keeps re-scoring rows,
+    re-rank the best `k * rescore_factor` candidates against them. A float32
+    directory is just the VectorIndex matrix on disk, for sharing an exact
+    index between workers.
+
+    int8 is the format to use: scored in about 1.4x float32's time, and with
+    its float16 re-scoring rows three quarters of float32's size (a quarter
+    without them). NumPy has no fast float16 kernels, so float16 directories
+    only save space and are several times slower to search. Directories
+    written with float32 re-scoring rows (full.npy) still open.
+    """
+
+    DTYPES = ("float16", "int8")
+    BUILD_DTYPES = ("float32",) + DTYPES
+    BLOCK_ROWS = 512  # rows widened to float32 at a time; the buffer stays in cache
+
+    def __init__(self, path: str, rescore_factor: int = 4):
+        self.path = path
+        self.rescore_factor = rescore_factor
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.dtype = self.meta["dtype"]
+        self.partitions = {p: tuple(r) for p, r in self.meta["partitions"].items()}
+        self.vectors = np.load(os.path.join(path, "vectors.npy"), mmap_mode="r")
+        self.scales = np.load(os.path.join(path, "scales.npy"), mmap_mode="r") if self.dtype == "int8" else None
+        self.rescore_rows = None
+        for name in ("rescore.npy", "full.npy"):
+            if os.path.exists(os.path.join(path, name)):
+                self.rescore_rows = np.load(os.path.join(path, name), mmap_mode="r")
+                break
+        self.records = RecordTable(os.path.join(path, "records.jsonl"))
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def dim(self) -> int:
+        return self.meta["dim"]
+
+    def protocols(self) -> List[str]:
+        return sorted(self.partitions)
+
+    @classmethod
+    def build(cls, index: VectorIndex, path: str, dtype: str = "int8",
+              rescore: bool = True) -> "QuantizedIndex":
+        """Writes `index` to `path` in quantized (or float32) form and opens it.
+        For int8, `rescore` also writes float16 rows to re-rank the top
+        candidates with (3 KB per 1536-d vector on top of int8's 1.5 KB)."""
+        if dtype not in cls.BUILD_DTYPES:
+            raise ValueError(f"dtype must be one of {cls.BUILD_DTYPES}")
+        os.makedirs(path, exist_ok=True)
+
+        matrix = index.matrix
+        if dtype == "float32":
+            np.save(os.path.join(path, "vectors.npy"), matrix)
+        elif dtype == "float16":
+            np.save(os.path.join(path, "vectors.npy"), matrix.astype(np.float16))
+        else:
+            # Symmetric per-row scalar quantization: v ~= scale * q, q in [-127, 127]
+            scales = np.abs(matrix).max(axis=1, initial=0.0) / 127.0
+            scales[scales == 0] = 1.0
+            quantized = np.clip(np.rint(matrix / scales[:, None]), -127, 127).astype(np.int8)
+            np.save(os.path.join(path, "vectors.npy"), quantized)
+            np.save(os.path.join(path, "scales.npy"), scales.astype(np.float32))
+        # float32 and float16 rows would re-score a float16 candidate to the score it already has
+        rescore = rescore and dtype == "int8"
+        if rescore:
+            np.save(os.path.join(path, "rescore.npy"), matrix.astype(np.float16))
+
+        offsets = [0]
+        with open(os.path.join(path, "records.jsonl"), "wb") as f:
+            for record in index.records:
+                offsets.append(offsets[-1] + f.write((json.dumps(record) + "\n").encode()))
+        np.save(RecordTable.offsets_path(os.path.join(path, "records.jsonl")), np.asarray(offsets, dtype=np.int64))
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump({
+                "format_version": 1,
+                "dtype": dtype,
+                "dim": index.dim,
+                "count": len(index),
+                "partitions": index.partitions,
+                "rescore_dtype": "float16" if rescore else None,
+            }, f, indent=2)
+        return cls(path)
+
+    def prefault(self) -> int:
+        """Pulls the mapped files into the page cache (once per host, see shared.py). Returns bytes read."""
+        return sum(prefault(a) for a in (self.vectors, self.scales, self.rescore_rows)) + self.records.prefault()
+
+    def _approx_scores(self, start: int, end: int, query: np.ndarray) -> np.ndarray:
+        """Dot products of rows start:end with `query` at stored precision (int8 scaled per row)."""
+        scores = np.empty(end - start, dtype=np.float32)
+        if self.dtype == "float32":
+            np.matmul(self.vectors[start:end], query, out=scores)
+            return scores
+        # Widening block by block into one reused buffer keeps the conversion in cache
+        # instead of materializing a float32 copy of the slice.
+        buffer = np.empty((min(self.BLOCK_ROWS, end - start), self.dim), dtype=np.float32)
+        for block in range(start, end, self.BLOCK_ROWS):
+            stop = min(block + self.BLOCK_ROWS, end)
+            rows = buffer[:stop - block]
+            np.copyto(rows, self.vectors[block:stop], casting="unsafe")
+            np.matmul(rows, query, out=scores[block - start:stop - start])
+        if self.scales is not None:
+            scores *= self.scales[start:end]
+        return scores
+
+    def search(self, query_vector: List[float], protocol: Optional[str] = None, k: int = 5,
+               rescore: bool = True) -> List[Dict]:
+        """Approximate top-k at reduced precision, re-ranked against the re-scoring rows when present."""
+        if protocol is None:
+            start, end = 0, len(self.records)
+        elif protocol in self.partitions:
+            start, end = self.partitions[protocol]
+        else:
+            return []
+        if end <= start or k <= 0:
+            return []
+
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / (np.linalg.norm(query) or 1.0)
+        scores = self._approx_scores(start, end, query)
+
+        rescore = rescore and self.rescore_rows is not None
+        n_candidates = min(k * self.rescore_factor if rescore else k, len(scores))
+        if n_candidates < len(scores):
+            candidates = np.argpartition(-scores, n_candidates - 1)[:n_candidates]
+        else:
+            candidates = np.arange(len(scores))
+
+        if rescore:
+            # Sorted row order keeps the reads from the memory-mapped file sequential.
+            candidates = np.sort(candidates)
+            candidate_scores = self.rescore_rows[start + candidates].astype(np.float32) @ query
+        else:
+            candidate_scores = scores[candidates]
+
+        order = np.argsort(-candidate_scores, kind="stable")[:k]
+        return [{**self.records[start + candidates[i]], "similarity": float(candidate_scores[i])} for i in order]
+
+
+def load_index(path: str):
+    """Opens a quantized index directory, a .npz VectorIndex, or a .json/.jsonl table export."""
+    if os.path.isdir(path):
+        return QuantizedIndex(path)
+    if path.endswith(".npz"):
+        return VectorIndex.load(path)
+    return VectorIndex.from_export(path)
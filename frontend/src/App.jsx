@@ -18,6 +18,8 @@ function App() {
   const [messages, setMessages] = useState([])
   const [isLoading, setIsLoading] = useState(false)
   const [inputValue, setInputValue] = useState('')
+  // Issued by the server with the first answer; follow-ups send it back so they reuse its context
+  const [sessionId, setSessionId] = useState(null)
 
   const handleSubmit = useCallback(async (question) => {
     if (!question.trim() || isLoading) return
@@ -32,37 +34,74 @@ function App() {
       let url, body
 
       if (compareMode) {
-        url = `${API_BASE}/api/compare`
+        url = `${API_BASE}/api/compare/stream`
         body = {
           question,
           protocols: [selectedProtocol, compareProtocol],
         }
       } else {
-        url = `${API_BASE}/api/query`
-        body = {
-          question,
-          protocol: selectedProtocol,
-        }
+        url = `${API_BASE}/api/query/stream`
+        body = sessionId
+          ? { question, protocol: selectedProtocol, session_id: sessionId }
+          : { question, protocol: selectedProtocol, start_session: true }
       }
 
-      const response = await fetch(url, {
+      const send = () => fetch(url, {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
         body: JSON.stringify(body),
       })
+      let response = await send()
+      if (response.status === 404 && body.session_id) {
+        // The conversation expired on the server: start a new one
+        setSessionId(null)
+        body = { question, protocol: selectedProtocol, start_session: true }
+        response = await send()
+      }
 
       if (!response.ok) throw new Error(`API error: ${response.status}`)
 
-      const data = await response.json()
-      const assistantMessage = {
-        role: 'assistant',
-        content: data.answer,
-        sources: data.sources || [],
-        metadata: data.metadata || {},
-        isComparison: compareMode,
-        protocols: compareMode ? data.protocols : undefined,
+      // Server-sent events: `sources` first, then `token`s, then `done` with timing metadata
+      const updateAssistant = (update) => {
+        setMessages(prev => [...prev.slice(0, -1), { ...prev[prev.length - 1], ...update(prev[prev.length - 1]) }])
+      }
+      let started = false
+      const handleEvent = (event, data) => {
+        if (event === 'sources') {
+          setMessages(prev => [...prev, {
+            role: 'assistant',
+            content: '',
+            sources: data,
+            metadata: {},
+            isComparison: compareMode,
+            protocols: compareMode ? body.protocols : undefined,
+          }])
+          started = true
+        } else if (event === 'token') {
+          updateAssistant(msg => ({ content: msg.content + data }))
+        } else if (event === 'done') {
+          updateAssistant(() => ({ metadata: data }))
+          if (data.session?.id) setSessionId(data.session.id)
+        } else if (event === 'error') {
+          throw new Error(data.detail)
+        }
+      }
+
+      const reader = response.body.pipeThrough(new TextDecoderStream()).getReader()
+      let buffer = ''
+      while (true) {
+        const { value, done } = await reader.read()
+        if (done) break
+        buffer += value
+        const frames = buffer.split('\n\n')
+        buffer = frames.pop()
+        for (const frame of frames) {
+          const event = frame.match(/^event: (.*)$/m)?.[1]
+          const data = frame.match(/^data: (.*)$/m)?.[1]
+          if (event && data) handleEvent(event, JSON.parse(data))
+        }
       }
-      setMessages(prev => [...prev, assistantMessage])
+      if (!started) throw new Error('Stream ended before any sources were received')
     } catch (error) {
       console.error('Query failed:', error)
       const errorMessage = {
@@ -74,7 +113,7 @@ function App() {
     } finally {
       setIsLoading(false)
     }
-  }, [isLoading, selectedProtocol, compareProtocol, compareMode])
+  }, [isLoading, selectedProtocol, compareProtocol, compareMode, sessionId])
 
   const handleSuggestedQuestion = useCallback((question) => {
     setInputValue(question)
@@ -101,7 +140,10 @@ function App() {
           <ProtocolSelector
             protocols={PROTOCOLS}
             selected={selectedProtocol}
-            onChange={setSelectedProtocol}
+            onChange={(protocol) => {
+              setSelectedProtocol(protocol)
+              setSessionId(null)
+            }}
             compareMode={compareMode}
             compareProtocol={compareProtocol}
             onCompareProtocolChange={setCompareProtocol}
@@ -138,7 +180,7 @@ function App() {
         ) : (
           <ChatInterface
             messages={messages}
-            isLoading={isLoading}
+            isLoading={isLoading && messages[messages.length - 1]?.role === 'user'}
           />
         )}
       </main>